@@ -8,7 +8,7 @@ import shortuuid
 import hashlib
 import requests
 import urllib
-from typing import Any, Dict, List, cast
+from typing import Any, Dict, List, Tuple, cast
 from datetime import datetime, timedelta
 import dateutil.parser
 from dateutil.tz import tzutc, tzoffset
@@ -157,15 +157,16 @@ class RateLimit(object):
 
         key = "rate-%s:%s" % (uid, datetime.now().minute)
 
-        cnt = rdb.get(key)
-        if cnt is not None and int(cnt) >= USER_LIMIT:
+        # counting and checking in one round trip also counts refused
+        # requests, which only keeps a client over the limit refused until
+        # the minute is up
+        cnt, _ = rdb.pipeline().incr(key).expire(key, 59).execute()
+        if cnt > USER_LIMIT:
             raise falcon.HTTPTooManyRequests(
                 title="Request limit exceeded",
                 description="This client has exceeded the number of allowed requests. Please wait and try again later.",
             )
 
-        rdb.pipeline().incr(key).expire(key, 59).execute()
-
 
 allowedpaths = [
     re.compile(r"^/api/links/"),
@@ -1794,6 +1795,7 @@ class PurgeQueues(object):
 
         if t == "f":
             db.execute("""delete from funnelqueue where cid = any(%s)""", doc)
+            db.execute("""delete from funneldue where cid = any(%s)""", doc)
             for cid in doc:
                 user_log(
                     req, "pencil", "purged funnels for customer ", "companies", cid, "."
@@ -1981,6 +1983,7 @@ class BanCompanies(object):
         )
         db.execute("""delete from cookies where cid = any(%s)""", doc)
         db.execute("""delete from funnelqueue where cid = any(%s)""", doc)
+        db.execute("""delete from funneldue where cid = any(%s)""", doc)
         db.execute("""delete from txnqueue where cid = any(%s)""", doc)
         db.execute("""delete from campqueue where cid = any(%s)""", doc)
 
@@ -2511,9 +2514,9 @@ class CustomerDashboard(object):
                                     else 0
                                     end
                                  )
-                                 from hourstats
-                                 left join campaigns on campaigns.id = hourstats.campid
-                                 left join messages on messages.id = hourstats.campid
+                                 from campstats_hourly
+                                 left join campaigns on campaigns.id = campstats_hourly.campid
+                                 left join messages on messages.id = campstats_hourly.campid
                                  where campcid = %s and ts >= %s
                                  group by hourbucket
                                  order by hourbucket""",
@@ -2550,6 +2553,34 @@ class CustomerDashboard(object):
         }
 
 
+def campstats_range(start: datetime, end: datetime) -> Tuple[str, List[Any]]:
+    """Returns a query for the per-campaign summary rows covering the
+    hourstats rows with start <= ts <= end, and its parameters. Whole days are
+    read from campstats_daily and the part days at either end from
+    campstats_hourly."""
+    columns = """cid, campcid, campid, ts, open, send, delivered_rows, delivered_open,
+                 delivered_complaint, delivered_send, delivered_hard, delivered_soft"""
+
+    firstday = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    if firstday < start:
+        firstday += timedelta(days=1)
+    lastday = end.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if firstday >= lastday:
+        return f"select {columns} from campstats_hourly where ts >= %s and ts <= %s", [
+            start,
+            end,
+        ]
+    return (
+        f"""select {columns} from campstats_hourly where ts >= %s and ts < %s
+            union all
+            select {columns} from campstats_daily where ts >= %s and ts < %s
+            union all
+            select {columns} from campstats_hourly where ts >= %s and ts <= %s""",
+        [start, firstday, firstday, lastday, lastday, end],
+    )
+
+
 class CompanyCampaigns(object):
 
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
@@ -2564,15 +2595,19 @@ class CompanyCampaigns(object):
         end = req.get_param("end", required=True)
 
         try:
-            start = (
+            startts = (
                 dateutil.parser.parse(start).astimezone(tzutc()).replace(tzinfo=None)
             )
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
             )
 
+        # only the hourstats rows with deliveries count, which the summaries
+        # keep in the delivered_ columns
+        summaries, summaryparams = campstats_range(startts, endts)
+
         req.context["result"] = [
             {
                 "cid": row[0],
@@ -2585,34 +2620,33 @@ class CompanyCampaigns(object):
             }
             for row in db.execute(
                 """select
-               case when substring(hourstats.campid from 1 for 3) = 'tx-' then substring(hourstats.campid from 4)
+               case when substring(s.campid from 1 for 3) = 'tx-' then substring(s.campid from 4)
                else
                coalesce(campaigns.cid, funnels.cid)
                end ccid,
-               case when substring(hourstats.campid from 1 for 3) = 'tx-' then 'Transactional'
+               case when substring(s.campid from 1 for 3) = 'tx-' then 'Transactional'
                else
                coalesce(campaigns.data->>'name', (funnels.data->>'name')::text || ' (' || (messages.data->>'subject')::text || ')')
                end campname,
-               sum(open::decimal)/nullif(sum(send), 0),
-               sum(complaint::decimal)/nullif(sum(send), 0),
-               sum(hard::decimal)/nullif(sum(send), 0),
-               sum(soft::decimal)/nullif(sum(send), 0),
-               hourstats.campid
-               from hourstats
-               left join campaigns on campaigns.id = hourstats.campid
-               left join messages on messages.id = hourstats.campid
-               left join funnels on funnels.id = messages.data->>'funnel'
-               where hourstats.cid = %s
-               and (campaigns.data is null or (campaigns.data->>'sent_at' >= %s and campaigns.data->>'sent_at' <= %s))
-               and send+soft+hard+defercnt > 0
-               and ts >= %s and ts <= %s
-               group by hourstats.campid, ccid, campname
-               """,
+               sum(delivered_open::decimal)/nullif(sum(delivered_send), 0),
+               sum(delivered_complaint::decimal)/nullif(sum(delivered_send), 0),
+               sum(delivered_hard::decimal)/nullif(sum(delivered_send), 0),
+               sum(delivered_soft::decimal)/nullif(sum(delivered_send), 0),
+               s.campid
+               from (%s) s
+               left join campaigns on campaigns.id = s.campid
+               left join messages on messages.id = s.campid
+               left join funnels on funnels.id = messages.data_funnel
+               where s.cid = %%s
+               and (campaigns.data is null or (campaigns.data_sent_at >= %%s and campaigns.data_sent_at <= %%s))
+               and delivered_rows > 0
+               group by s.campid, ccid, campname
+               """
+                % summaries,
+                *summaryparams,
                 mycid,
-                start.isoformat() + "Z",
-                end.isoformat() + "Z",
-                start,
-                end,
+                startts.isoformat() + "Z",
+                endts.isoformat() + "Z",
             )
         ]
 
@@ -2631,15 +2665,17 @@ class CompanyCampaignStats(object):
         end = req.get_param("end", required=True)
 
         try:
-            start = (
+            startts = (
                 dateutil.parser.parse(start).astimezone(tzutc()).replace(tzinfo=None)
             )
-            end = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
+            endts = dateutil.parser.parse(end).astimezone(tzutc()).replace(tzinfo=None)
         except:
             raise falcon.HTTPBadRequest(
                 title="Invalid parameter", description="invalid date parameter"
             )
 
+        summaries, summaryparams = campstats_range(startts, endts)
+
         req.context["result"] = [
             {
                 "cid": row[0],
@@ -2658,27 +2694,27 @@ class CompanyCampaignStats(object):
                max(soft::decimal/nullif(send, 0))
                from (
                  select
-                 case when substring(hourstats.campid from 1 for 3) = 'tx-' then substring(hourstats.campid from 4)
+                 case when substring(s.campid from 1 for 3) = 'tx-' then substring(s.campid from 4)
                  else
                  coalesce(campaigns.cid, messages.cid)
                  end as ccid,
-                 hourstats.campid id, sum(complaint) as complaint,
-                 sum(open) as open, sum(send) as send, sum(hard) as hard, sum(soft) as soft
-                 from hourstats
-                 left join campaigns on campaigns.id = hourstats.campid
-                 left join messages on messages.id = hourstats.campid
-                 where hourstats.cid = %s
-                 and (campaigns.data is null or (campaigns.data->>'sent_at' >= %s and campaigns.data->>'sent_at' <= %s))
-                 and send+soft+hard+defercnt > 0
-                 and ts >= %s and ts <= %s
-                 group by ccid, hourstats.campid
+                 s.campid id, sum(delivered_complaint) as complaint,
+                 sum(delivered_open) as open, sum(delivered_send) as send,
+                 sum(delivered_hard) as hard, sum(delivered_soft) as soft
+                 from (%s) s
+                 left join campaigns on campaigns.id = s.campid
+                 left join messages on messages.id = s.campid
+                 where s.cid = %%s
+                 and (campaigns.data is null or (campaigns.data_sent_at >= %%s and campaigns.data_sent_at <= %%s))
+                 and delivered_rows > 0
+                 group by ccid, s.campid
                ) tbl
-               group by cid""",
+               group by cid"""
+                % summaries,
+                *summaryparams,
                 mycid,
-                start.isoformat() + "Z",
-                end.isoformat() + "Z",
-                start,
-                end,
+                startts.isoformat() + "Z",
+                endts.isoformat() + "Z",
             )
         ]
 
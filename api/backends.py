@@ -3,10 +3,10 @@ import re
 import dateutil.parser
 import requests
 import shortuuid
-from typing import Dict, List
+from typing import Any, Dict, List
 from netaddr import IPAddress, IPNetwork, IPRange, IPSet
 from dateutil.tz import tzutc
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, time
 from Crypto.PublicKey import RSA
 from .shared import config as _  # noqa: F401
 from .shared.db import open_db, statlogs_iter, DB, JsonObj
@@ -32,6 +32,57 @@ from .shared.log import get_logger
 log = get_logger()
 
 
+STAT_FIELDS = ("send", "soft", "hard", "err", "open", "defercnt")
+
+
+def rollup_series(
+    db: DB, buckets: List[datetime], interval: timedelta, filters: str, *args: Any
+) -> Dict[str, JsonObj]:
+    """Sums the delivery rollups into width_bucket buckets, keyed by each
+    bucket's ISO timestamp. filters is an "and ..." clause with args as its
+    parameters. When the buckets fall on UTC midnight whole days come from
+    deliverystats_daily, everything else from deliverystats_hourly."""
+    lower = buckets[0] - interval
+    if interval == timedelta(days=1) and buckets[0] == datetime.combine(
+        buckets[0].date(), time()
+    ):
+        source = (
+            "select ts, send, soft, hard, err, open, defercnt from deliverystats_daily where ts >= %s"
+            + filters
+            + " union all select ts, send, soft, hard, err, open, defercnt from deliverystats_hourly where ts > %s and ts < %s"
+            + filters
+        )
+        params = [buckets[0], *args, lower, buckets[0], *args]
+    else:
+        source = (
+            "select ts, send, soft, hard, err, open, defercnt from deliverystats_hourly where ts > %s"
+            + filters
+        )
+        params = [lower, *args]
+
+    result: Dict[str, JsonObj] = {}
+    for row in db.execute(
+        """select width_bucket(ts, %s) bucket,
+           sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
+           from ("""
+        + source
+        + """) s
+           group by bucket
+           order by bucket""",
+        buckets,
+        *params,
+    ):
+        if row[0] >= len(buckets):
+            break
+        ts = buckets[row[0]].isoformat() + "Z"
+        result[ts] = {"ts": ts, **dict(zip(STAT_FIELDS, row[1:]))}
+    for b in buckets:
+        ts = b.isoformat() + "Z"
+        if ts not in result:
+            result[ts] = {"ts": ts, **{f: 0 for f in STAT_FIELDS}}
+    return result
+
+
 @tasks.task(priority=HIGH_PRIORITY)
 def update_sinks(cid: str, force: List[JsonObj] | None) -> None:
     with open_db() as db:
@@ -338,85 +389,11 @@ class SettingsSumStats(object):
         for i in range(24):
             hourarray.append(now - timedelta(hours=23 - i))
 
-        stats = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) hourbucket,
-                                 sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-                                 from hourstats
-                                 where cid = %%s and settingsid = %%s and ts > %%s
-                                 %s
-                                 group by hourbucket
-                                 order by hourbucket"""
-            % (domainfilter,),
-            hourarray,
-            db.get_cid(),
-            id,
-            hourarray[0] - timedelta(hours=1),
-        ):
-            if row[0] >= len(hourarray):
-                break
-            ts = hourarray[row[0]].isoformat() + "Z"
-            stats[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in hourarray:
-            t = ts.isoformat() + "Z"
-            if t not in stats:
-                stats[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
-
-        days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and settingsid = %%s and ts > %%s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter,),
-            dayarray,
-            db.get_cid(),
-            id,
-            dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
-            days[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in dayarray:
-            t = ts.isoformat() + "Z"
-            if t not in days:
-                days[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
+        filters = " and cid = %s and settingsid = %s" + domainfilter
+        stats = rollup_series(
+            db, hourarray, timedelta(hours=1), filters, db.get_cid(), id
+        )
+        days = rollup_series(db, dayarray, timedelta(days=1), filters, db.get_cid(), id)
 
         req.context["result"] = {
             "hours": sorted(iter(stats.values()), key=lambda s: s["ts"], reverse=True),
@@ -1032,85 +1009,9 @@ class AllStats(object):
         for i in range(24):
             hourarray.append(now - timedelta(hours=23 - i))
 
-        stats = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) hourbucket,
-                                 sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-                                 from hourstats
-                                 where cid = %%s and ts > %%s
-                                 %s
-                                 %s
-                                 group by hourbucket
-                                 order by hourbucket"""
-            % (domainfilter, serverfilter),
-            hourarray,
-            db.get_cid(),
-            hourarray[0] - timedelta(hours=1),
-        ):
-            if row[0] >= len(hourarray):
-                break
-            ts = hourarray[row[0]].isoformat() + "Z"
-            stats[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in hourarray:
-            t = ts.isoformat() + "Z"
-            if t not in stats:
-                stats[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
-
-        days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and ts > %%s
-            %s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter, serverfilter),
-            dayarray,
-            db.get_cid(),
-            dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
-            days[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in dayarray:
-            t = ts.isoformat() + "Z"
-            if t not in days:
-                days[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
+        filters = " and cid = %s" + domainfilter + serverfilter
+        stats = rollup_series(db, hourarray, timedelta(hours=1), filters, db.get_cid())
+        days = rollup_series(db, dayarray, timedelta(days=1), filters, db.get_cid())
 
         req.context["result"] = {
             "hours": sorted(iter(stats.values()), key=lambda s: s["ts"], reverse=True),
@@ -1155,85 +1056,11 @@ class SinkSumStats(object):
         for i in range(24):
             hourarray.append(now - timedelta(hours=23 - i))
 
-        stats = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) hourbucket,
-                                 sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-                                 from hourstats
-                                 where cid = %%s and sinkid = %%s and ts > %%s
-                                 %s
-                                 group by hourbucket
-                                 order by hourbucket"""
-            % (domainfilter,),
-            hourarray,
-            db.get_cid(),
-            id,
-            hourarray[0] - timedelta(hours=1),
-        ):
-            if row[0] >= len(hourarray):
-                break
-            ts = hourarray[row[0]].isoformat() + "Z"
-            stats[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in hourarray:
-            t = ts.isoformat() + "Z"
-            if t not in stats:
-                stats[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
-
-        days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %%s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %%s and sinkid = %%s and ts > %%s
-            %s
-            group by daybucket
-            order by daybucket"""
-            % (domainfilter,),
-            dayarray,
-            db.get_cid(),
-            id,
-            dayarray[0] - timedelta(days=1),
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
-            days[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in dayarray:
-            t = ts.isoformat() + "Z"
-            if t not in days:
-                days[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
+        filters = " and cid = %s and sinkid = %s" + domainfilter
+        stats = rollup_series(
+            db, hourarray, timedelta(hours=1), filters, db.get_cid(), id
+        )
+        days = rollup_series(db, dayarray, timedelta(days=1), filters, db.get_cid(), id)
 
         req.context["result"] = {
             "hours": sorted(iter(stats.values()), key=lambda s: s["ts"], reverse=True),
@@ -1298,89 +1125,10 @@ class SinkStats(object):
         for i in range(24):
             hourarray.append(end - timedelta(hours=23 - i))
 
-        hours = {}
-        for row in db.execute(
-            """select width_bucket(ts, %s) hourbucket,
-                                 sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-                                 from hourstats
-                                 where cid = %s and sinkid = %s and ts > %s and domaingroupid = %s
-                                 and settingsid = %s and ip = %s
-                                 group by hourbucket
-                                 order by hourbucket""",
-            hourarray,
-            db.get_cid(),
-            id,
-            hourarray[0] - timedelta(hours=1),
-            domaingroupid,
-            settingsid,
-            ip,
-        ):
-            if row[0] >= len(hourarray):
-                break
-            ts = hourarray[row[0]].isoformat() + "Z"
-            hours[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in hourarray:
-            t = ts.isoformat() + "Z"
-            if t not in hours:
-                hours[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
-
-        days = {}
-        for row in db.execute(
-            """select width_bucket(ts, %s) daybucket,
-            sum(send), sum(soft), sum(hard), sum(err), sum(open), sum(defercnt)
-            from hourstats
-            where cid = %s and sinkid = %s and ts > %s and domaingroupid = %s
-            and settingsid = %s and ip = %s
-            group by daybucket
-            order by daybucket""",
-            dayarray,
-            db.get_cid(),
-            id,
-            dayarray[0] - timedelta(days=1),
-            domaingroupid,
-            settingsid,
-            ip,
-        ):
-            if row[0] >= len(dayarray):
-                break
-            ts = dayarray[row[0]].isoformat() + "Z"
-            days[ts] = {
-                "ts": ts,
-                "send": row[1],
-                "soft": row[2],
-                "hard": row[3],
-                "err": row[4],
-                "open": row[5],
-                "defercnt": row[6],
-            }
-        for ts in dayarray:
-            t = ts.isoformat() + "Z"
-            if t not in days:
-                days[t] = {
-                    "ts": t,
-                    "send": 0,
-                    "soft": 0,
-                    "hard": 0,
-                    "err": 0,
-                    "open": 0,
-                    "defercnt": 0,
-                }
+        filters = " and cid = %s and sinkid = %s and domaingroupid = %s and settingsid = %s and ip = %s"
+        args = (db.get_cid(), id, domaingroupid, settingsid, ip)
+        hours = rollup_series(db, hourarray, timedelta(hours=1), filters, *args)
+        days = rollup_series(db, dayarray, timedelta(days=1), filters, *args)
 
         stats = list(
             statlogs_iter(
@@ -1501,7 +1249,7 @@ class IPMsgs(object):
                 raise falcon.HTTPBadRequest()
             it = db.execute(
                 """
-                select message, sinkid, ip, sum(count) cnt from statmsgs
+                select message, sinkid, ip, sum(count) cnt from deliverymsgs_hourly
                 where ts >= %s and ts <= %s
                 and domaingroupid = %s and ip = %s and settingsid = %s and sinkid = %s
                 and msgtype = %s
@@ -1575,7 +1323,7 @@ class IPStats(object):
                                sum(complaint), sum(open), sum(err), sum(defercnt),
                                p.id, (p.data->>'discard')::boolean,
                                l.sendlimit, q.queue
-                               from hourstats h
+                               from deliverystats_hourly h
                                left join iplimits l on
                                  h.domaingroupid = l.domain and
                                  h.ip            = l.ip and
@@ -9,13 +9,14 @@ import hashlib
 import random
 import json
 import zipfile
+import tempfile
 import email.utils
 import shortuuid
 from abc import abstractmethod
 from typing import Any, List, Tuple, Dict, Set, cast, Iterable
 from fnmatch import fnmatch
 from datetime import datetime, timedelta
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 
 from .shared import config as config_module_side_effects  # noqa: F401
 from .shared.db import open_db, json_iter, json_obj, JsonObj, DB
@@ -29,6 +30,8 @@ from .shared.crud import (
 from .shared.utils import (
     run_task,
     run_tasks,
+    run_task_delay,
+    redis_connect,
     generate_html,
     gather_init,
     gather_check,
@@ -48,15 +51,17 @@ from .shared.utils import (
     set_onboarding,
     fix_sink_url,
     check_plan_limits,
+    ExternalSorter,
 )
 from .shared.segments import (
     segment_get_params,
     get_segment_rows,
+    stream_segment_rows,
     segment_eval_parts,
     segment_get_segments,
     segment_get_campaignids,
     get_segment_sentrows,
-    supp_rows,
+    supp_digests,
     Cache,
 )
 from .shared.tasks import tasks, HIGH_PRIORITY, LOW_PRIORITY
@@ -71,6 +76,9 @@ from .shared.send import (
     sink_get_ips,
     fix_headers,
     update_sink_camp,
+    campaign_canceled,
+    set_campaign_canceled,
+    sink_complete,
     check_send_limit,
     check_test_limit,
     client_domain,
@@ -89,6 +97,44 @@ from .shared.log import get_logger
 
 log = get_logger()
 
+# bytes of recipient rows a list generation task sorts in memory before it
+# spills sorted runs to disk
+LIST_SORT_BUDGET = int(os.environ.get("list_sort_budget_mb", 256)) * 1024 * 1024
+# rows checked against the suppression lists per query
+LIST_SUPP_BATCH = 10000
+
+# campaigns are archived this many days after they were sent
+ARCHIVE_AFTER_DAYS = 365
+# campaigns archived at the same time, each by its own chain of tasks
+ARCHIVE_CONCURRENCY = int(os.environ.get("archive_concurrency", 2))
+# seconds a chain waits before moving on to its next campaign, so archival
+# doesn't crowd out other work
+ARCHIVE_PAUSE_SECS = int(os.environ.get("archive_pause_secs", 5))
+# a claimed campaign or chain not heard from in this long is assumed to
+# belong to a worker that died and is taken over
+ARCHIVE_LEASE_SECS = 3 * 60 * 60
+# camplogs rows removed per statement once an archive is verified
+ARCHIVE_DELETE_BATCH = 10000
+# exports of a campaign that fail verification before its archival is
+# abandoned and its logs are left to the usual retention
+ARCHIVE_MAX_ATTEMPTS = 3
+
+# archive_stage holds the next stage to run for a campaign being archived, so
+# a rerun continues where the last one stopped
+ARCHIVE_EXPORT = "export"
+ARCHIVE_VERIFY = "verify"
+ARCHIVE_DELETE = "delete"
+
+# csv file in a campaign export for each camplogs cmd
+EXPORT_CMD_FILES = {
+    "open": "opened",
+    "click": "clicked",
+    "unsub": "unsubscribed",
+    "complaint": "complained",
+    "bounce": "bounced",
+    "soft": "softbounced",
+}
+
 
 class _CSVWriter:
     @abstractmethod
@@ -134,28 +180,9 @@ def write_campaign_lists(
                 db, segment["cid"], campaignids, hashval, hashlimit
             )
 
-            rows = get_segment_rows(db, segment["cid"], hashval, listfactors, hashlimit)
-
             cache = Cache()
 
-            r2 = []
             segcounts: Dict[str, int] = {}
-            numrows = len(rows)
-            for row in rows:
-                if segment_eval_parts(
-                    segment["parts"],
-                    segment["operator"],
-                    row,
-                    segcounts,
-                    numrows,
-                    segments,
-                    sentrows,
-                    segment,
-                    hashlimit,
-                    cache,
-                ):
-                    r2.append(row)
-            rows = r2
 
             def most_recent(row: JsonObj) -> int:
                 maxts = 0
@@ -170,12 +197,13 @@ def write_campaign_lists(
             def newest_data(row: JsonObj) -> int:
                 return cast(int, row.get("!!added", 0))
 
-            if not randomize and not newestfirst:
-                rows.sort(key=most_recent, reverse=True)
-            elif newestfirst:
-                rows.sort(key=newest_data, reverse=True)
-            else:
-                random.shuffle(rows)
+            def sort_key(row: JsonObj) -> Any:
+                if newestfirst:
+                    return newest_data(row)
+                elif randomize:
+                    return random.random()
+                else:
+                    return most_recent(row)
 
             allprops = set()
 
@@ -191,10 +219,10 @@ def write_campaign_lists(
                             if v:
                                 for tag in v.split(","):
                                     fixedrow[prop].add(tag)
+                    elif prop == "!!hash":
+                        fixedrow[prop] = r[prop][0]
                 return fixedrow
 
-            rows = [fix_row(row) for row in rows]
-
             def eval_dg(dg: JsonObj | None, email: str) -> bool:
                 if dg is None:
                     return True
@@ -215,90 +243,124 @@ def write_campaign_lists(
                 if found != len(domaingroups) - 1:
                     return False
 
-                pct = djb2(email) % 100
+                pct: int = r["!!hash"] % 100
                 return pct >= domainstartpct and pct < domainendpct
 
-            rows = [row for row in rows if filter_result(row)]
-
-            if len(rows):
-                supprows = supp_rows(
-                    db, segment["cid"], hashval, hashlimit, suppfactors
-                )
-
-                def eval_suppress(r: JsonObj) -> bool:
-                    if is_true(r.get("Unsubscribed", "")):
-                        return False
-                    if is_true(r.get("Complained", "")):
-                        return False
-                    if is_true(r.get("Bounced", "")):
-                        return False
-
-                    if "!!tags" in r and (r["!!tags"] & supptags):
-                        return False
-                    if len(supprows):
-                        md5 = hashlib.md5(r["Email"].encode("utf-8")).hexdigest()
-                        if md5 in supprows:
-                            return False
-                    return True
-
-                rows = [row for row in rows if eval_suppress(row)]
-
-            if len(rows):
+            def eval_suppress(r: JsonObj, md5: str, supprows: Set[str]) -> bool:
+                if is_true(r.get("Unsubscribed", "")):
+                    return False
+                if is_true(r.get("Complained", "")):
+                    return False
+                if is_true(r.get("Bounced", "")):
+                    return False
 
-                def filter_policy(r: JsonObj) -> bool:
-                    for domain in policydomains:
-                        if fnmatch(r["Email"].split("@")[1], domain):
-                            return True
+                if "!!tags" in r and (r["!!tags"] & supptags):
                     return False
+                if md5 in supprows:
+                    return False
+                return True
 
-                rows = [row for row in rows if filter_policy(row)]
+            def filter_policy(r: JsonObj) -> bool:
+                for domain in policydomains:
+                    if fnmatch(r["Email"].split("@")[1], domain):
+                        return True
+                return False
 
-            for row in rows:
-                row.pop("!!tags", None)
+            # filtering doesn't change the relative order of rows, so sorting
+            # what is left gives the same list as sorting first. Ties keep
+            # the bucket's djb2 order.
+            rows = ExternalSorter(
+                LIST_SORT_BUDGET, reverse=newestfirst or not randomize
+            )
+            pending: List[Tuple[Any, JsonObj]] = []
+
+            def flush_pending() -> None:
+                digests = [
+                    hashlib.md5(r["Email"].encode("utf-8")).hexdigest()
+                    for _, r in pending
+                ]
+                supprows = supp_digests(db, segment["cid"], suppfactors, digests)
+                for (key, row), md5 in zip(pending, digests):
+                    if eval_suppress(row, md5, supprows) and filter_policy(row):
+                        row.pop("!!tags", None)
+                        row.pop("!!hash", None)
+                        rows.add(key, row)
+                pending.clear()
+
+            with open_db() as rowdb:
+                with rowdb.transaction():
+                    for row, numrows in stream_segment_rows(
+                        rowdb, segment["cid"], hashval, listfactors, hashlimit
+                    ):
+                        if not segment_eval_parts(
+                            segment["parts"],
+                            segment["operator"],
+                            row,
+                            segcounts,
+                            numrows,
+                            segments,
+                            sentrows,
+                            segment,
+                            hashlimit,
+                            cache,
+                        ):
+                            continue
+                        key = sort_key(row)
+                        fixedrow = fix_row(row)
+                        if not filter_result(fixedrow):
+                            continue
+                        pending.append((key, fixedrow))
+                        if len(pending) >= LIST_SUPP_BATCH:
+                            flush_pending()
+            if pending:
+                flush_pending()
 
             sendid = shortuuid.uuid()
             countbydomain[sendid] = {}
 
-            if len(rows):
+            if rows.count:
+                numrows = rows.count
+                rowiter = iter(rows)
                 pct = 0
                 cnt = 0
                 for obj in sinkobjs:
                     pct += obj["pct"]
 
-                    outfile = BytesIO()
-                    writer = MPDictWriter(outfile, list(allprops))
-                    writer.writeheader()
-
-                    listcnt = 0
-
-                    while (
-                        cnt < len(rows)
-                        and ((float(cnt) / float(len(rows))) * 100) < pct
-                    ):
-                        writer.writerow(rows[cnt])
-                        em = rows[cnt]["Email"]
-                        domain = em.split("@")[1]
-                        if domain not in countbydomain[sendid]:
-                            countbydomain[sendid][domain] = 1
-                        else:
-                            countbydomain[sendid][domain] = (
-                                countbydomain[sendid][domain] + 1
-                            )
-                        cnt += 1
-                        listcnt += 1
-                        logsize += len(em) + 1
+                    with tempfile.TemporaryFile() as outfile:
+                        writer = MPDictWriter(outfile, list(allprops))
+                        writer.writeheader()
+
+                        listcnt = 0
+
+                        while (
+                            cnt < numrows
+                            and ((float(cnt) / float(numrows)) * 100) < pct
+                        ):
+                            row = next(rowiter)
+                            writer.writerow(row)
+                            em = row["Email"]
+                            domain = em.split("@")[1]
+                            if domain not in countbydomain[sendid]:
+                                countbydomain[sendid][domain] = 1
+                            else:
+                                countbydomain[sendid][domain] = (
+                                    countbydomain[sendid][domain] + 1
+                                )
+                            cnt += 1
+                            listcnt += 1
+                            logsize += len(em) + 1
 
-                    listfile = "lists/%s-%s/%s-%s-%s-%08d.blk" % (
-                        campid,
-                        gatherid,
-                        obj["id"],
-                        sendid,
-                        listcnt,
-                        hashval,
-                    )
-                    outfile.seek(0, 0)
+                        listfile = "lists/%s-%s/%s-%s-%s-%08d.blk" % (
+                            campid,
+                            gatherid,
+                            obj["id"],
+                            sendid,
+                            listcnt,
+                            hashval,
+                        )
+                        outfile.seek(0, 0)
 
-                    s3_write_stream(databucket, listfile, outfile)
+                        s3_write_stream(databucket, listfile, outfile)
 
                     if pct >= 100:
                         break
@@ -340,10 +402,7 @@ def write_campaign_lists(
                     },
                 )
                 if mainres is not None:
-                    if db.single(
-                        "select (data->>'canceled')::boolean from campaigns where id = %s",
-                        campid,
-                    ):
+                    if campaign_canceled(db, campid):
                         return
 
                     c = 0
@@ -862,7 +921,7 @@ def campaign_calculate_segment(
                             hashlib.md5(row["Email"][0].encode("utf-8")).hexdigest()
                         )
 
-            supprows = supp_rows(db, segment["cid"], hashval, hashlimit, suppfactors)
+            supprows = supp_digests(db, segment["cid"], suppfactors, segrows)
 
             diff = segrows - supprows
 
@@ -1179,6 +1238,7 @@ class CampaignCancel(object):
             )
 
         db.campaigns.patch(id, {"canceled": True})
+        set_campaign_canceled(id)
 
         db.execute(
             "delete from campqueue where cid = %s and campid = %s", camp["cid"], id
@@ -1212,77 +1272,80 @@ class CampaignCancel(object):
         )
 
 
+def write_campaign_export(
+    db: DB, campid: str, cid: str, exportid: str
+) -> Tuple[str, Dict[str, int]]:
+    """Writes the campaign's recipients and events to a zip of csv files in
+    /tmp, returning its path and the number of rows in each file."""
+    files = {
+        "delivered": "/tmp/delivered-%s.csv" % exportid,
+        "opened": "/tmp/opened-%s.csv" % exportid,
+        "clicked": "/tmp/clicked-%s.csv" % exportid,
+        "unsubscribed": "/tmp/unsubscribed-%s.csv" % exportid,
+        "complained": "/tmp/complained-%s.csv" % exportid,
+        "bounced": "/tmp/bounced-%s.csv" % exportid,
+        "softbounced": "/tmp/softbounced-%s.csv" % exportid,
+    }
+    fps = {}
+    writers: Dict[str, _CSVWriter | "csv.DictWriter[str]"] = {}
+    counts: Dict[str, int] = {}
+
+    for (contact_email,) in db.execute(
+        f"""select c.email
+                            from contacts."contacts_{cid}" c
+                            join contacts."contact_send_logs_{cid}" s on s.contact_id = c.contact_id
+                            where s.campid = %s""",
+        campid,
+    ):
+        key = "delivered"
+        if key not in fps:
+            fps[key] = open(files[key], "w")
+            dw = csv.DictWriter(fps[key], ["Email"])
+            writers[key] = dw
+            dw.writeheader()
+        dw = cast("csv.DictWriter[str]", writers[key])
+        dw.writerow({"Email": contact_email})
+        counts[key] = counts.get(key, 0) + 1
+
+    for contact_email, cmd, ts, code in db.execute(
+        "select email, cmd, ts, code from camplogs where campid = %s", campid
+    ):
+        key = EXPORT_CMD_FILES[cmd]
+        if key not in fps:
+            fps[key] = open(files[key], "w")
+            w = cast(_CSVWriter, csv.writer(fps[key]))
+            writers[key] = w
+            if cmd in ("bounce", "soft"):
+                w.writerow(("Email", "Date", "Msg"))
+            else:
+                w.writerow(("Email", "Date"))
+        if cmd in ("bounce", "soft"):
+            w = cast(_CSVWriter, writers[key])
+            w.writerow((contact_email, ts.isoformat() + "Z", code))
+        else:
+            w = cast(_CSVWriter, writers[key])
+            w.writerow((contact_email, ts.isoformat() + "Z"))
+        counts[key] = counts.get(key, 0) + 1
+
+    zipname = "/tmp/%s.zip" % exportid
+    outzip = zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED)
+    for key, fp in fps.items():
+        fp.close()
+        outzip.write(files[key], "%s.csv" % key)
+        os.unlink(files[key])
+    outzip.close()
+
+    return zipname, counts
+
+
 @tasks.task(priority=HIGH_PRIORITY)
 def export_campaign(
     campid: str, cid: str, exportid: str, path: str, totransfer: bool
 ) -> None:
     with open_db() as db:
         try:
-            cnt = 0
-
-            files = {
-                "delivered": "/tmp/delivered-%s.csv" % exportid,
-                "opened": "/tmp/opened-%s.csv" % exportid,
-                "clicked": "/tmp/clicked-%s.csv" % exportid,
-                "unsubscribed": "/tmp/unsubscribed-%s.csv" % exportid,
-                "complained": "/tmp/complained-%s.csv" % exportid,
-                "bounced": "/tmp/bounced-%s.csv" % exportid,
-                "softbounced": "/tmp/softbounced-%s.csv" % exportid,
-            }
-            fps = {}
-            writers: Dict[str, _CSVWriter | "csv.DictWriter[str]"] = {}
-
-            cmdtokey = {
-                "open": "opened",
-                "click": "clicked",
-                "unsub": "unsubscribed",
-                "complaint": "complained",
-                "bounce": "bounced",
-                "soft": "softbounced",
-            }
-
-            for (contact_email,) in db.execute(
-                f"""select c.email
-                                    from contacts."contacts_{cid}" c
-                                    join contacts."contact_send_logs_{cid}" s on s.contact_id = c.contact_id
-                                    where s.campid = %s""",
-                campid,
-            ):
-                key = "delivered"
-                if key not in fps:
-                    fps[key] = open(files[key], "w")
-                    dw = csv.DictWriter(fps[key], ["Email"])
-                    writers[key] = dw
-                    dw.writeheader()
-                dw = cast("csv.DictWriter[str]", writers[key])
-                dw.writerow({"Email": contact_email})
-                cnt += 1
-
-            for contact_email, cmd, ts, code in db.execute(
-                "select email, cmd, ts, code from camplogs where campid = %s", campid
-            ):
-                key = cmdtokey[cmd]
-                if key not in fps:
-                    fps[key] = open(files[key], "w")
-                    w = cast(_CSVWriter, csv.writer(fps[key]))
-                    writers[key] = w
-                    if cmd in ("bounce", "soft"):
-                        w.writerow(("Email", "Date", "Msg"))
-                    else:
-                        w.writerow(("Email", "Date"))
-                if cmd in ("bounce", "soft"):
-                    w = cast(_CSVWriter, writers[key])
-                    w.writerow((contact_email, ts.isoformat() + "Z", code))
-                else:
-                    w = cast(_CSVWriter, writers[key])
-                    w.writerow((contact_email, ts.isoformat() + "Z"))
-
-            zipname = "/tmp/%s.zip" % exportid
-            outzip = zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED)
-            for key, fp in fps.items():
-                fp.close()
-                outzip.write(files[key], "%s.csv" % key)
-            outzip.close()
+            zipname, counts = write_campaign_export(db, campid, cid, exportid)
+            cnt = counts.get("delivered", 0)
 
             size = os.path.getsize(zipname)
             outfp = open(zipname, "rb")
@@ -1308,6 +1371,237 @@ def export_campaign(
                 db.exports.patch(exportid, {"error": str(e)})
 
 
+def _archive_slot_key(slot: int) -> str:
+    return "archive-slot-%s" % slot
+
+
+def start_archival(db: DB) -> None:
+    """Queues campaigns old enough to be archived and starts any archival
+    chains that aren't already running."""
+    ts = datetime.utcnow()
+    camps = list(
+        json_iter(
+            db.execute(
+                "select id, cid, data - 'parts' - 'rawText' from campaigns where data->>'sent_at' < %s and not coalesce((data->>'archived')::boolean, false)",
+                (ts - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat() + "Z",
+            )
+        )
+    )
+    for camp in camps:
+        name = re.sub(r"[^A-Za-z0-9 \-_.]", "", camp["name"])
+
+        path = "exports/%s/%s-%s.zip" % (
+            shortuuid.uuid(),
+            name,
+            ts.strftime("%Y%m%d-%H%M%SZ"),
+        )
+
+        # events are no longer recorded for archived campaigns, so nothing
+        # changes underneath the export
+        db.campaigns.patch(
+            camp["id"],
+            {"archived": True, "archive_stage": ARCHIVE_EXPORT, "archive_path": path},
+        )
+
+    rdb = redis_connect()
+    for slot in range(ARCHIVE_CONCURRENCY):
+        if rdb.set(_archive_slot_key(slot), "1", nx=True, ex=ARCHIVE_LEASE_SECS):
+            run_task(archive_campaigns, slot)
+
+
+def claim_archive(db: DB) -> str | None:
+    """Claims the oldest campaign with archival stages left to run that no
+    other chain is working on."""
+    now = datetime.utcnow()
+    return cast(
+        str | None,
+        db.single(
+            """update campaigns set data = data || jsonb_build_object('archive_claimed_at', %s::text)
+               where id = (
+                   select id from campaigns
+                   where data ? 'archive_stage' and coalesce(data->>'archive_claimed_at', '') < %s
+                   order by data->>'sent_at' limit 1
+                   for update skip locked
+               )
+               returning id""",
+            now.isoformat() + "Z",
+            (now - timedelta(seconds=ARCHIVE_LEASE_SECS)).isoformat() + "Z",
+        ),
+    )
+
+
+def verify_archive(camp: JsonObj) -> str | None:
+    """Checks the stored archive against the checksum and the row counts
+    recorded when it was written. Returns what is wrong with it, or None if it
+    can be relied on."""
+    bucket = os.environ["s3_databucket"]
+    path = camp["archive_path"]
+    counts = camp["archive_counts"]
+
+    h = hashlib.md5()
+    with s3_read_stream(bucket, path) as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(chunk)
+    if h.hexdigest() != camp["archive_md5"]:
+        return "checksum mismatch"
+
+    with s3_read_stream(bucket, path) as fp:
+        with zipfile.ZipFile(fp) as z:
+            bad = z.testzip()
+            if bad is not None:
+                return "%s is corrupt" % bad
+            names = set(z.namelist())
+            if names != set("%s.csv" % key for key in counts):
+                return "archive holds %s" % ", ".join(sorted(names))
+            for key, cnt in counts.items():
+                with z.open("%s.csv" % key) as csvfp:
+                    # less the header
+                    rows = sum(1 for _ in csv.reader(TextIOWrapper(csvfp, "utf-8"))) - 1
+                if rows != cnt:
+                    return "%s.csv has %s rows, expected %s" % (key, rows, cnt)
+
+    return None
+
+
+def abandon_archive(db: DB, campid: str, problem: str) -> None:
+    """Stops archiving a campaign whose exports keep failing. Its logs are no
+    longer held back for an archive that isn't going to be made."""
+    log.error("giving up on archiving campaign %s", campid)
+    db.execute(
+        """update campaigns set data = data - 'archive_stage' - 'archive_claimed_at' - 'archive_path'
+               - 'archive_counts' - 'archive_md5' - 'archive_pending_size'
+               || jsonb_build_object('archive_error', %s::text)
+           where id = %s""",
+        problem,
+        campid,
+    )
+
+
+def archive_campaign(db: DB, campid: str) -> None:
+    """Runs the archival stages the campaign has left, recording each as it
+    completes."""
+    camp = json_obj(
+        db.row(
+            "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
+            campid,
+        )
+    )
+    if camp is None:
+        return
+
+    stage = camp.get("archive_stage")
+    bucket = os.environ["s3_databucket"]
+
+    if stage == ARCHIVE_EXPORT:
+        # the attempt is recorded before the export starts, so exports that
+        # raise count towards the limit too
+        if camp.get("archive_attempts", 0) >= ARCHIVE_MAX_ATTEMPTS:
+            abandon_archive(db, campid, camp.get("archive_error") or "export failed")
+            return
+        camp["archive_attempts"] = camp.get("archive_attempts", 0) + 1
+        db.campaigns.patch(campid, {"archive_attempts": camp["archive_attempts"]})
+
+        zipname, counts = write_campaign_export(
+            db, campid, camp["cid"], "archive-%s" % campid
+        )
+        try:
+            h = hashlib.md5()
+            with open(zipname, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    h.update(chunk)
+            size = os.path.getsize(zipname)
+            with open(zipname, "rb") as fp:
+                s3_write_stream(bucket, camp["archive_path"], fp)
+        finally:
+            os.unlink(zipname)
+
+        camp["archive_counts"] = counts
+        camp["archive_md5"] = h.hexdigest()
+        camp["archive_pending_size"] = size
+        db.campaigns.patch(
+            campid,
+            {
+                "archive_stage": ARCHIVE_VERIFY,
+                "archive_counts": counts,
+                "archive_md5": camp["archive_md5"],
+                "archive_pending_size": size,
+            },
+        )
+        stage = ARCHIVE_VERIFY
+
+    if stage == ARCHIVE_VERIFY:
+        problem = verify_archive(camp)
+        if problem is not None:
+            log.error("archive of campaign %s failed verification: %s", campid, problem)
+            if camp.get("archive_attempts", 0) >= ARCHIVE_MAX_ATTEMPTS:
+                abandon_archive(db, campid, problem)
+            else:
+                # the claim is released so the next export doesn't wait for
+                # the lease to run out
+                db.execute(
+                    """update campaigns set data = data - 'archive_claimed_at'
+                           || jsonb_build_object('archive_stage', %s::text, 'archive_error', %s::text)
+                       where id = %s""",
+                    ARCHIVE_EXPORT,
+                    problem,
+                    campid,
+                )
+            return
+
+        # exports of the campaign are served from the archive from now on
+        db.campaigns.patch(
+            campid,
+            {
+                "archive_stage": ARCHIVE_DELETE,
+                "archive_count": camp["archive_counts"].get("delivered", 0),
+                "archive_size": camp["archive_pending_size"],
+                "archive_key": camp["archive_path"],
+            },
+        )
+        stage = ARCHIVE_DELETE
+
+    if stage == ARCHIVE_DELETE:
+        while (
+            db.execute(
+                """delete from camplogs where ctid = any(array(
+                       select ctid from camplogs where campid = %s limit %s))""",
+                campid,
+                ARCHIVE_DELETE_BATCH,
+            ).rowcount
+            >= ARCHIVE_DELETE_BATCH
+        ):
+            pass
+
+        db.execute(
+            """update campaigns set data = data - 'archive_stage' - 'archive_claimed_at' - 'archive_path'
+                   - 'archive_counts' - 'archive_md5' - 'archive_pending_size' - 'archive_error'
+                   - 'archive_attempts'
+               where id = %s""",
+            campid,
+        )
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def archive_campaigns(slot: int) -> None:
+    rdb = redis_connect()
+    with open_db() as db:
+        campid = claim_archive(db)
+        if campid is None:
+            rdb.delete(_archive_slot_key(slot))
+            return
+        rdb.expire(_archive_slot_key(slot), ARCHIVE_LEASE_SECS)
+
+        try:
+            archive_campaign(db, campid)
+        except Exception as e:
+            # the claim is left to lapse, so the campaign is retried once its
+            # lease runs out rather than straight away
+            log.exception("error archiving campaign %s", campid)
+            db.campaigns.patch(campid, {"archive_error": str(e)})
+
+    run_task_delay(archive_campaigns, ARCHIVE_PAUSE_SECS, slot)
+
+
 class CampaignUpdate(object):
 
     def on_post(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
@@ -1975,7 +2269,7 @@ class RecentCampaigns(object):
         ret = list(
             json_iter(
                 db.execute(
-                    "select id, cid, data - 'parts' - 'rawText' from campaigns where cid = %s and data->>'sent_at' is not null and data->>'hidden' is null order by data->>'sent_at' desc limit 150",
+                    "select id, cid, data - 'parts' - 'rawText' from campaigns where cid = %s and data_sent_at is not null and data_hidden is null order by data_sent_at desc limit 150",
                     db.get_cid(),
                 )
             )
@@ -1984,8 +2278,8 @@ class RecentCampaigns(object):
             r["is_bc"] = True
 
         for mid, mcid, mdata, fname in db.execute(
-            """select m.id, m.cid, m.data - 'parts' - 'rawText', f.data->>'name' from messages m inner join funnels f on m.data->>'funnel' = f.id
-                                            where m.cid = %s order by m.data->>'modified' desc limit 150""",
+            """select m.id, m.cid, m.data - 'parts' - 'rawText', f.data->>'name' from messages m inner join funnels f on m.data_funnel = f.id
+                                            where m.cid = %s order by m.data_modified desc limit 150""",
             db.get_cid(),
         ):
             msg = json_obj((mid, mcid, mdata))
@@ -2356,8 +2650,8 @@ class Campaigns(CRUDCollection):
                 return json_iter(
                     db.execute(
                         """select id, cid, data - 'parts' - 'rawText'
-                                               from campaigns where cid = %%s and data->>'sent_at' is not null and data->>'hidden' is null %s %s
-                                               order by data->>'sent_at' %s limit 100"""
+                                               from campaigns where cid = %%s and data_sent_at is not null and data_hidden is null %s %s
+                                               order by data_sent_at %s limit 100"""
                         % (q, searchquery, sort),
                         *([cid] + qparams + searchparams),
                     )
@@ -2367,8 +2661,8 @@ class Campaigns(CRUDCollection):
                     id
                     for id, in db.execute(
                         """select id from campaigns
-                                                   where cid = %%s and data->>'sent_at' is not null and data->>'hidden' is null %s %s
-                                                   order by data->>'sent_at' %s limit 100"""
+                                                   where cid = %%s and data_sent_at is not null and data_hidden is null %s %s
+                                                   order by data_sent_at %s limit 100"""
                         % (q, searchquery, sort),
                         *([cid] + qparams + searchparams),
                     )
@@ -2449,16 +2743,16 @@ class Campaigns(CRUDCollection):
                 )
 
         if older is not None:
-            ret.extend(load_campaigns(" and data->>'sent_at' < %s", [older], "desc"))
+            ret.extend(load_campaigns(" and data_sent_at < %s", [older], "desc"))
             cnt = db.single(
-                "select count(id) from campaigns where cid = %%s and data->>'sent_at' is not null and data->>'hidden' is null and data->>'sent_at' < %%s %s"
+                "select count(id) from campaigns where cid = %%s and data_sent_at is not null and data_hidden is null and data_sent_at < %%s %s"
                 % searchquery,
                 *([cid, older] + searchparams),
             )
         elif newer is not None:
-            ret.extend(load_campaigns(" and data->>'sent_at' > %s", [newer], "asc"))
+            ret.extend(load_campaigns(" and data_sent_at > %s", [newer], "asc"))
             cnt = db.single(
-                "select count(id) from campaigns where cid = %%s and data->>'sent_at' is not null and data->>'hidden' is null and data->>'sent_at' > %%s %s"
+                "select count(id) from campaigns where cid = %%s and data_sent_at is not null and data_hidden is null and data_sent_at > %%s %s"
                 % searchquery,
                 *([cid, newer] + searchparams),
             )
@@ -2467,7 +2761,7 @@ class Campaigns(CRUDCollection):
             ret.extend(
                 json_iter(
                     db.execute(
-                        "select id, cid, data - 'parts' - 'rawText' from campaigns where cid = %s and data->>'sent_at' is null order by data->>'modified' desc",
+                        "select id, cid, data - 'parts' - 'rawText' from campaigns where cid = %s and data_sent_at is null order by data_modified desc",
                         cid,
                     )
                 )
@@ -2477,7 +2771,7 @@ class Campaigns(CRUDCollection):
             ret.extend(load_campaigns("", [], "desc"))
 
             cnt = db.single(
-                "select count(id) from campaigns where cid = %%s and data->>'sent_at' is not null and data->>'hidden' is null %s"
+                "select count(id) from campaigns where cid = %%s and data_sent_at is not null and data_hidden is null %s"
                 % searchquery,
                 *([cid] + searchparams),
             )
@@ -3048,33 +3342,9 @@ def check_camps() -> None:
                                                     )
                                                     == 0
                                                 ):
-                                                    db.execute(
-                                                        "update campaigns set data = data || jsonb_build_object('sinkstatus', (data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)) where id = %s",
-                                                        data["sinkid"],
-                                                        campid,
-                                                    )
-
-                                                    camp = json_obj(
-                                                        db.row(
-                                                            "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                                                            campid,
-                                                        )
+                                                    sink_complete(
+                                                        db, campid, data["sinkid"]
                                                     )
-
-                                                    if (
-                                                        camp is not None
-                                                        and False
-                                                        not in list(
-                                                            camp["sinkstatus"].values()
-                                                        )
-                                                    ):
-                                                        db.campaigns.patch(
-                                                            campid,
-                                                            {
-                                                                "finished_at": datetime.utcnow().isoformat()
-                                                                + "Z"
-                                                            },
-                                                        )
                                             else:
                                                 db.execute(
                                                     "update campqueue set remaining = remaining - %s where cid = %s and campid = %s and sendid = %s and domain = %s",
@@ -3234,10 +3504,7 @@ def send_queued_camp(
             outfile.seek(0, 0)
             s3_write_stream(os.environ["s3_transferbucket"], newlistkey, outfile)
 
-            if db.single(
-                "select (data->>'canceled')::boolean from campaigns where id = %s",
-                campid,
-            ):
+            if campaign_canceled(db, campid):
                 return
 
             if policytype == "mailgun":
@@ -3332,10 +3599,7 @@ def send_queued_camp(
 
                 db.sinks.patch(obj["id"], {"failed_update": False})
 
-                if db.single(
-                    "select (data->>'canceled')::boolean from campaigns where id = %s",
-                    campid,
-                ):
+                if campaign_canceled(db, campid):
                     return
 
                 webroot = get_webroot()
@@ -3382,14 +3646,28 @@ class SavedRows(CRUDCollection):
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
         CRUDCollection.on_get(self, req, resp)
 
-        has_footer = False
-        for row in req.context["result"]:
-            if (
-                row.get("rowJson", {}).get("metadata", {}).get("type")
-                == "sticky-footer"
-            ):
-                has_footer = True
-                break
+        rows = req.context["result"]
+        if isinstance(rows, dict):
+            # a page of rows: the default footer goes at the end of the last
+            # page, if none is saved on any page
+            if rows["next"] is not None:
+                return
+            has_footer = (
+                req.context["db"].savedrows.find_one(
+                    {"rowJson": {"metadata": {"type": "sticky-footer"}}}
+                )
+                is not None
+            )
+            rows = rows["records"]
+        else:
+            has_footer = False
+            for row in rows:
+                if (
+                    row.get("rowJson", {}).get("metadata", {}).get("type")
+                    == "sticky-footer"
+                ):
+                    has_footer = True
+                    break
 
         if not has_footer:
             year = str(datetime.now().year)
@@ -3409,7 +3687,7 @@ class SavedRows(CRUDCollection):
             pageJson = pageJson.replace("{{COMPANYNAME}}", companyname)
             pageJson = pageJson.replace("{{YEAR}}", year)
 
-            req.context["result"].append(
+            rows.append(
                 {
                     "rowHtml": rowHtml,
                     "rowJson": json.loads(rowJson),
@@ -1,13 +1,11 @@
 import os
-import re
-import shortuuid
 import time
 from datetime import datetime, timedelta
 
 from .shared import config as _  # noqa: F401
-from .campaigns import export_campaign
-from .shared.db import open_db, json_iter
-from .shared.utils import run_task
+from .campaigns import start_archival
+from .shared.db import open_db
+from .shared import partitions
 from .shared.s3 import s3_delete_all
 from .shared.log import get_logger
 
@@ -17,30 +15,8 @@ log = get_logger()
 def cleanup_db() -> None:
     with open_db() as db:
         try:
-            db.execute(
-                "delete from statlogs2 where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)).isoformat() + "Z",
-            )
-            db.execute(
-                "delete from hourstats where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)),
-            )
-            db.execute(
-                "delete from statmsgs where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)),
-            )
-            db.execute(
-                "delete from txnstats where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)),
-            )
-            db.execute(
-                "delete from txnstatmsgs where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)),
-            )
-            db.execute(
-                "delete from txnsends where ts < %s",
-                (datetime.utcnow() - timedelta(days=90)),
-            )
+            partitions.ensure_partitions(db)
+            partitions.drop_expired_partitions(db)
 
             db.execute(
                 "delete from exports where data->>'started_at' < %s",
@@ -70,57 +46,9 @@ def cleanup_db() -> None:
                 (datetime.utcnow() - timedelta(days=30)).isoformat() + "Z",
             )
 
-            camps = list(
-                json_iter(
-                    db.execute(
-                        "select id, cid, data from campaigns where data->>'sent_at' < %s and not coalesce((data->>'archived')::boolean, false)",
-                        (datetime.utcnow() - timedelta(days=365)).isoformat() + "Z",
-                    )
-                )
-            )
-            for camp in camps:
-                uuid = shortuuid.uuid()
-
-                name = re.sub(r"[^A-Za-z0-9 \-_.]", "", camp["name"])
-
-                path = "exports/%s/%s-%s.zip" % (
-                    uuid,
-                    name,
-                    datetime.utcnow().strftime("%Y%m%d-%H%M%SZ"),
-                )
-
-                db.campaigns.patch(camp["id"], {"archived": True})
+            start_archival(db)
 
-                run_task(export_campaign, camp["id"], camp["cid"], uuid, path, False)
-
-            db.execute(
-                "delete from camplogs where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from txnlogs where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from mgtracking where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from sesmessages where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from sptracking where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from eltracking where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
-            db.execute(
-                "delete from smtptracking where ts < %s",
-                (datetime.utcnow() - timedelta(days=367)),
-            )
+            partitions.delete_expired_rows(db)
 
             db.execute(
                 "delete from sparkpost_events where ts < %s",
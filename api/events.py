@@ -6,16 +6,17 @@ import falcon
 import shortuuid
 import dateutil.parser
 import redis
-from typing import Tuple, List, Dict, Any, Callable
+from typing import Tuple, List, Dict, Set, Any, Callable
 from netaddr import IPAddress
 from datetime import datetime, timedelta
 
 from .shared import config as _  # noqa: F401
-from .shared.db import open_db, json_obj, statlogs_obj, DB, JsonObj
+from .shared.db import open_db, json_obj, json_iter, statlogs_obj, DB, JsonObj
 from .shared.utils import (
     fix_tag,
     get_contact_id,
     redis_connect,
+    pop_batch,
     get_txn,
     get_os,
     get_browser,
@@ -32,7 +33,12 @@ from .shared.utils import (
     unsubletters,
     viewletters,
 )
-from .shared.send import unencrypt, handle_soft_event
+from .shared.send import (
+    unencrypt,
+    handle_soft_event,
+    record_sink_queues,
+    sink_complete,
+)
 from .shared.crud import check_noadmin
 from .shared.s3 import s3_read, s3_delete
 from .shared import contacts
@@ -275,6 +281,7 @@ def write_txn(
     linktrack: bool,
     clientip: str,
     useragent: str,
+    webhooks: List[JsonObj] | None = None,
 ) -> None:
     campcid = c[3:]
 
@@ -399,7 +406,11 @@ def write_txn(
         elif ct == "bounce":
             webhookev["code"] = code
             webhookev["bouncetype"] = "hard"
-        send_webhooks(db, campcid, [webhookev])
+        # a caller writing in a transaction sends the event once it commits
+        if webhooks is not None:
+            webhooks.append(webhookev)
+        else:
+            send_webhooks(db, campcid, [webhookev])
 
     elif ct in ("open", "click"):
         opens, clicks = 0, 0
@@ -1149,17 +1160,7 @@ class Queue(object):
             if sink["accesskey"] != doc["accesskey"]:
                 raise falcon.HTTPUnauthorized()
 
-            db.sinks.patch(sinkid, {"queue": doc["queue"]})
-            db.execute("delete from sinkdomainqueues where sinkid = %s", sinkid)
-
-            if doc.get("domainqueues", None) is not None:
-                for domain, cnt in doc["domainqueues"].items():
-                    db.execute(
-                        "insert into sinkdomainqueues (sinkid, domain, queue) values (%s, %s, %s)",
-                        sinkid,
-                        domain,
-                        cnt,
-                    )
+            record_sink_queues(db, sinkid, doc["queue"], doc.get("domainqueues"))
 
             if doc.get("completecampaigns", None) is None:
                 return
@@ -1175,23 +1176,7 @@ class Queue(object):
                 ):
                     continue
 
-                db.execute(
-                    "update campaigns set data = data || jsonb_build_object('sinkstatus', (data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)) where id = %s",
-                    sinkid,
-                    campid,
-                )
-
-                camp = json_obj(
-                    db.row(
-                        "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                        campid,
-                    )
-                )
-
-                if camp is not None and False not in list(camp["sinkstatus"].values()):
-                    db.campaigns.patch(
-                        campid, {"finished_at": datetime.utcnow().isoformat() + "Z"}
-                    )
+                sink_complete(db, campid, sinkid)
 
 
 class Stats(object):
@@ -1661,11 +1646,12 @@ class Track(object):
                     log.info("event error: no tracking id")
                 else:
                     row = db.row(
-                        "select settingsid, ip, ts from mgtracking where id = %s", tr
+                        "select settingsid, ip, ts from mgtracking where id = %s",
+                        tr,
                     )
                     if row is None:
                         row = db.row(
-                            "select settingsid, ts from sesmessages where trackingid = %s",
+                            "select settingsid, ts from sesmessages where trackingid = %s order by ts desc limit 1",
                             tr,
                         )
                         if row is None:
@@ -1675,12 +1661,12 @@ class Track(object):
                             )
                             if row is None:
                                 row = db.row(
-                                    "select settingsid, ts from eltracking where id = %s",
+                                    "select settingsid, ts from eltracking where id = %s order by ts desc limit 1",
                                     tr,
                                 )
                                 if row is None:
                                     row = db.row(
-                                        "select settingsid, ts from smtptracking where id = %s",
+                                        "select settingsid, ts from smtptracking where id = %s order by ts desc limit 1",
                                         tr,
                                     )
                                     if row is None:
@@ -1850,6 +1836,7 @@ class SESWebHook(object):
         if eventtype not in ("Bounce", "Complaint", "Delivery"):
             return
 
+        pending = []
         for email in event["mail"]["destination"]:
             emailmatch = emailre.search(email)
             if emailmatch:
@@ -1874,10 +1861,7 @@ class SESWebHook(object):
 
             messageid = event["mail"]["messageId"]
 
-            rdb = redis_connect()
-
-            rdb.lpush(
-                "webhooks-pending",
+            pending.append(
                 json.dumps(
                     {
                         "type": "ses",
@@ -1891,11 +1875,643 @@ class SESWebHook(object):
                         "msg": msg,
                         "messageid": messageid,
                     }
-                ),
+                )
+            )
+
+        if pending:
+            redis_connect().lpush("webhooks-pending", *pending)
+
+
+# provider webhooks taken off webhooks-pending per round
+PENDING_BATCH_SIZE = 500
+
+# times a batch whose counters failed to commit is put back on the queue
+# before its webhooks are dropped
+WEBHOOK_MAX_ATTEMPTS = 5
+
+
+class WebhookBatch(object):
+    """Lookups and writes shared by a batch of provider webhooks. The rows
+    the events refer to are loaded with one query per table up front, where
+    the batch also claims its Sparkpost event ids, so everything from load()
+    to flush() has to run in one transaction. The stats and campaign
+    counters the events produce are summed and written once per key by
+    flush(), along with the bounces, complaints and soft bounces, which are
+    applied to the contacts a set at a time. Webhooks, the sends and the
+    tracking events that were waiting for a delivery are handled by finish()
+    once that has committed."""
+
+    def __init__(self, db: DB, rdb: redis.StrictRedis) -> None:  # type: ignore
+        self.db = db
+        self.rdb = rdb
+
+        self.companies: Dict[str, JsonObj] = {}
+        self.camps: Dict[str, JsonObj] = {}
+        self.msgs: Dict[str, JsonObj] = {}
+        self.txns: Dict[str, Tuple[str, str, str] | Tuple[None, None, None]] = {}
+        self.sesmessages: Dict[str, Tuple[Any, ...]] = {}
+        self.new_sp_events: Set[str] = set()
+        # (table, trackingid) -> (ip, ts) of the tracking row
+        self.tracking: Dict[Tuple[str, str], Tuple[str, datetime]] = {}
+
+        # table -> trackingid -> (ip, settingsid, ts)
+        self.trackinginserts: Dict[str, Dict[str, Tuple[str, str, datetime]]] = {
+            "sptracking": {},
+            "mgtracking": {},
+        }
+        # trackingid -> (sinkid, settingsid, ip, ts)
+        self.delivered: Dict[str, Tuple[str, str, str, datetime]] = {}
+        self.sends: Dict[Tuple[str, str | None], List[str]] = {}
+        self.hourstats: Dict[
+            Tuple[str, str, datetime, str, str, str, str, str], List[int]
+        ] = {}
+        self.txnstats: Dict[Tuple[str, datetime, str, str], List[int]] = {}
+        self.statmsgs: Dict[
+            Tuple[str, datetime, str, str, str, str, str, str, str], int
+        ] = {}
+        self.txnmsgs: Dict[Tuple[str, datetime, str, str, str, str], int] = {}
+        self.campcounts: Dict[Tuple[str, bool], List[int]] = {}
+        # (campcid, campid, is_camp, email, cmd, code, hourstats key)
+        self.contactevents: List[
+            Tuple[
+                str,
+                str,
+                bool,
+                str,
+                str,
+                str | None,
+                Tuple[str, str, datetime, str, str, str, str, str] | None,
+            ]
+        ] = []
+        self.complaints: Dict[Tuple[str, str, datetime, str, str, str, str, str], int] = {}
+        self.campprops: Dict[Tuple[str, bool], Dict[str, int]] = {}
+        self.list_deltas = False
+        # (cid, event) in the order they were raised
+        self.webhooks: List[Tuple[str, JsonObj]] = []
+        # what discard() undoes for the event being processed
+        self.item: Tuple[int, int, str | None] = (0, 0, None)
+
+    def load(self, objs: List[JsonObj]) -> None:
+        db = self.db
+
+        sesids = [obj["messageid"] for obj in objs if obj["type"] == "ses"]
+        for row in db.execute(
+            "select id, settingsid, cid, campid, is_camp, trackingid, ts from sesmessages where id = any(%s)",
+            sesids,
+        ).fetchall():
+            self.sesmessages[row[0]] = row[1:]
+
+        refs = [
+            (obj["usercid"], obj["campid"], obj["is_camp"])
+            for obj in objs
+            if obj["type"] != "ses"
+        ] + [(row[1], row[2], row[3]) for row in self.sesmessages.values()]
+
+        for company in json_iter(
+            db.execute(
+                "select id, cid, data from companies where id = any(%s)",
+                list(set(ref[0] for ref in refs)),
             )
+        ):
+            self.companies[company["id"]] = company
+        for table, cache, is_camp in (
+            ("campaigns", self.camps, True),
+            ("messages", self.msgs, False),
+        ):
+            ids = set(
+                ref[1]
+                for ref in refs
+                if ref[2] == is_camp and ref[1] != "test" and len(ref[1]) <= 30
+            )
+            for camp in json_iter(
+                db.execute(
+                    "select id, cid, data - 'parts' - 'rawText' from %s where id = any(%%s)"
+                    % table,
+                    list(ids),
+                )
+            ):
+                cache[camp["id"]] = camp
+
+        # of two consumers given the same event only the one that claims its
+        # id processes it. The claims roll back with a batch that fails, and
+        # are taken in id order so that consumers waiting on each other's
+        # claims can't deadlock.
+        spids = sorted(
+            set(
+                obj["event_id"]
+                for obj in objs
+                if obj["type"] == "sp" and obj.get("event_id")
+            )
+        )
+        if spids:
+            self.new_sp_events = set(
+                id
+                for id, in db.execute(
+                    "insert into sparkpost_events (id) select unnest(%s::text[]) on conflict (id) do nothing returning id",
+                    spids,
+                )
+            )
+            if len(self.new_sp_events) < len(spids):
+                log.info(
+                    "%s Sparkpost events were already claimed",
+                    len(spids) - len(self.new_sp_events),
+                )
+
+        for table, t in (("sptracking", "sp"), ("mgtracking", "mg")):
+            ids = set(
+                obj["trackingid"]
+                for obj in objs
+                if obj["type"] == t
+                and obj["eventtype"] not in ("delivery", "delivered")
+            )
+            if not ids:
+                continue
+            for trackingid, ip, ts in db.execute(
+                "select id, ip, ts from %s where id = any(%%s)" % table,
+                list(ids),
+            ):
+                self.tracking[(table, trackingid)] = (ip, ts)
+
+    def company(self, usercid: str) -> JsonObj | None:
+        return self.companies.get(usercid)
+
+    def campaign(self, campid: str, is_camp: bool) -> JsonObj | None:
+        if is_camp:
+            return self.camps.get(campid)
+        return self.msgs.get(campid)
+
+    def txn(self, campid: str) -> Tuple[str, str, str] | Tuple[None, None, None]:
+        if campid not in self.txns:
+            self.txns[campid] = get_txn(self.db, campid)
+        return self.txns[campid]
+
+    def sesmessage(self, messageid: str) -> Tuple[Any, ...] | None:
+        return self.sesmessages.get(messageid)
+
+    def is_new_sp_event(self, event_id: str | None) -> bool:
+        if event_id in self.new_sp_events:
+            self.new_sp_events.remove(event_id)
+            return True
+        return False
+
+    def begin(self, obj: JsonObj) -> None:
+        """Marks the start of an event, for discard() to undo."""
+        event_id = obj.get("event_id") if obj["type"] == "sp" else None
+        if event_id not in self.new_sp_events:
+            event_id = None
+        self.item = (len(self.contactevents), len(self.webhooks), event_id)
+
+    def discard(self) -> None:
+        """Drops what the current event queued once its writes have been
+        rolled back, and releases its claim on its Sparkpost event id so that
+        it can be retried. The counters are the last thing an event adds and
+        sends and tracking rows are idempotent, so those are left."""
+        contactevents, webhooks, event_id = self.item
+        del self.contactevents[contactevents:]
+        del self.webhooks[webhooks:]
+        if event_id is not None:
+            self.new_sp_events.discard(event_id)
+            self.db.execute("delete from sparkpost_events where id = %s", event_id)
+
+    def add_webhooks(self, cid: str, events: List[JsonObj]) -> None:
+        self.webhooks.extend((cid, ev) for ev in events)
+
+    def add_contact_event(
+        self,
+        campcid: str,
+        campid: str,
+        is_camp: bool,
+        email: str,
+        cmd: str,
+        msg: str,
+        cid: str,
+        ts: datetime | int | None,
+        sinkid: str,
+        domain: str,
+        ip: str,
+        settingsid: str,
+    ) -> None:
+        """Queues a bounce, complaint or soft bounce for flush() to apply to
+        the contact with the others for the same tenant."""
+        code = msg or None
+        if campid.startswith("tx-"):
+            # transactional soft bounces only raise a webhook
+            self.add_webhooks(
+                campcid,
+                [
+                    {
+                        "type": "bounce",
+                        "source": {"tag": campcid},
+                        "email": email,
+                        "timestamp": datetime.utcnow().isoformat() + "Z",
+                        "code": code,
+                        "bouncetype": "soft",
+                    }
+                ],
+            )
+            return
+
+        hourkey = None
+        if cmd == "complaint" and settingsid and ip:
+            if not ts:
+                ts = datetime.utcnow()
+            elif not isinstance(ts, datetime):
+                ts = mailtimeepoch + timedelta(hours=ts)
+            hourkey = (cid, campcid, _hour(ts), sinkid, domain, ip, settingsid, campid)
+        self.contactevents.append((campcid, campid, is_camp, email, cmd, code, hourkey))
+
+    def last_tracking(self, table: str, trackingid: str) -> Tuple[str, datetime] | None:
+        return self.tracking.get((table, trackingid))
+
+    def add_tracking(
+        self,
+        table: str,
+        trackingid: str,
+        ip: str,
+        settingsid: str,
+        ts: datetime,
+        sinkid: str,
+    ) -> None:
+        # a later send event for the same message replaces the row, as the
+        # upsert in flush does
+        self.trackinginserts[table][trackingid] = (ip, settingsid, ts)
+        self.tracking[(table, trackingid)] = (ip, ts)
+        self.delivered[trackingid] = (sinkid, settingsid, ip, ts)
+
+    def add_send(self, campid: str, txntag: str | None, email: str) -> None:
+        self.sends.setdefault((campid, txntag), []).append(email)
+
+    def add_hourstats(
+        self,
+        cid: str,
+        campcid: str,
+        ts: datetime,
+        sinkid: str,
+        domain: str,
+        ip: str,
+        settingsid: str,
+        campid: str,
+        send: int,
+        soft: int,
+        hard: int,
+        err: int,
+        defercnt: int,
+    ) -> None:
+        key = (cid, campcid, _hour(ts), sinkid, domain, ip, settingsid, campid)
+        counts = self.hourstats.setdefault(key, [0, 0, 0, 0, 0])
+        for i, v in enumerate((send, soft, hard, err, defercnt)):
+            counts[i] += v
+
+    def add_txnstats(
+        self,
+        campcid: str,
+        ts: datetime,
+        txntag: str,
+        domain: str,
+        send: int,
+        soft: int,
+        hard: int,
+    ) -> None:
+        counts = self.txnstats.setdefault(
+            (campcid, _hour(ts), txntag, domain), [0, 0, 0]
+        )
+        for i, v in enumerate((send, soft, hard)):
+            counts[i] += v
+
+    def add_statmsg(
+        self,
+        cid: str,
+        ts: datetime,
+        sinkid: str,
+        domain: str,
+        ip: str,
+        settingsid: str,
+        campid: str,
+        msg: str,
+        msgtype: str,
+    ) -> None:
+        key = (cid, _hour(ts), sinkid, domain, ip, settingsid, campid, msg, msgtype)
+        self.statmsgs[key] = self.statmsgs.get(key, 0) + 1
+
+    def add_txnmsg(
+        self,
+        campcid: str,
+        ts: datetime,
+        txntag: str,
+        domain: str,
+        msg: str,
+        msgtype: str,
+    ) -> None:
+        key = (campcid, _hour(ts), txntag, domain, msg, msgtype)
+        self.txnmsgs[key] = self.txnmsgs.get(key, 0) + 1
+
+    def add_campcounts(
+        self, campid: str, is_camp: bool, send: int, soft: int, hard: int
+    ) -> None:
+        counts = self.campcounts.setdefault((campid, is_camp), [0, 0, 0])
+        for i, v in enumerate((send, soft, hard)):
+            counts[i] += v
+
+    def flush(self) -> None:
+        db = self.db
+
+        self.write_contact_events()
+
+        for table, rows in self.trackinginserts.items():
+            if not rows:
+                continue
+            ids = sorted(rows)
+            db.execute(
+                """insert into %s (id, ip, settingsid, ts)
+                   select * from unnest(%%s::text[], %%s::text[], %%s::text[], %%s::timestamp[])
+                   on conflict (id) do update set ip = excluded.ip, settingsid = excluded.settingsid, ts = excluded.ts"""
+                % table,
+                ids,
+                [rows[trackingid][0] for trackingid in ids],
+                [rows[trackingid][1] for trackingid in ids],
+                [rows[trackingid][2] for trackingid in ids],
+            )
+
+        # keys are written in sorted order so concurrent consumers lock rows
+        # in the same order
+        for hourkey in sorted(set(self.hourstats) | set(self.complaints)):
+            counts = self.hourstats.get(hourkey, [0, 0, 0, 0, 0])
+            complaints = self.complaints.get(hourkey, 0)
+            hourstats_insert(db, *hourkey, complaints, 0, 0, 0, *counts)
+        for (campcid, ts, txntag, domain), counts in sorted(self.txnstats.items()):
+            txnstats_insert(db, campcid, ts, txntag, domain, 0, 0, 0, 0, 0, 0, *counts)
+        for msgkey, cnt in sorted(self.statmsgs.items()):
+            statmsgs_insert(db, *msgkey, cnt)
+        for txnmsgkey, cnt in sorted(self.txnmsgs.items()):
+            txnmsgs_insert(db, *txnmsgkey, cnt)
+
+        for campid, is_camp in sorted(set(self.campcounts) | set(self.campprops)):
+            table = "campaigns" if is_camp else "messages"
+            if (campid, is_camp) in self.campcounts:
+                send, soft, hard = self.campcounts[(campid, is_camp)]
+                db.execute(
+                    """update %s set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %%s,
+                                                                       'send', (data->>'send')::int + %%s,
+                                                                       'hard', (data->>'hard')::int + %%s,
+                                                                       'soft', (data->>'soft')::int + %%s) where id = %%s"""
+                    % table,
+                    send + soft + hard,
+                    send,
+                    hard,
+                    soft,
+                    campid,
+                )
+            for prop, cnt in sorted(self.campprops.get((campid, is_camp), {}).items()):
+                db.execute(
+                    "update %s set data = data || jsonb_build_object(%%s, coalesce((data->>%%s)::int, 0) + %%s) where id = %%s"
+                    % table,
+                    prop,
+                    prop,
+                    cnt,
+                    campid,
+                )
+
+    def write_contact_events(self) -> None:
+        """Applies the queued bounces, complaints and soft bounces as
+        write_list and handle_soft_event would, but with one statement per
+        tenant and property rather than several per contact."""
+        db = self.db
+
+        if not self.contactevents:
+            return
+
+        # only the first log of an event for a contact and campaign counts
+        logged = set(
+            db.execute(
+                """insert into camplogs (campid, email, cmd, ts, code)
+                   select campid, email, cmd, %s, code from unnest(%s::text[], %s::text[], %s::text[], %s::text[]) as e(campid, email, cmd, code)
+                   on conflict (campid, email, cmd) do nothing
+                   returning campid, email, cmd""",
+                datetime.utcnow(),
+                [ev[1] for ev in self.contactevents],
+                [ev[3] for ev in self.contactevents],
+                [ev[4] for ev in self.contactevents],
+                [ev[5] for ev in self.contactevents],
+            )
+        )
+
+        props: Dict[Tuple[str, str], Set[str]] = {}
+        # campcid -> email -> [complained, bounced]
+        unsubs: Dict[str, Dict[str, List[bool]]] = {}
+        for campcid, campid, is_camp, email, cmd, code, hourkey in self.contactevents:
+            props.setdefault((campcid, contacts.cmdprops[cmd][0]), set()).add(email)
+
+            webhookev: JsonObj = {
+                "type": "bounce" if cmd == "soft" else cmd,
+                "source": {"broadcast": campid} if is_camp else {"funnelmsg": campid},
+                "email": email,
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+            }
+            if cmd == "soft":
+                webhookev["code"] = code
+                webhookev["bouncetype"] = "soft"
+                self.webhooks.append((campcid, webhookev))
+                continue
+
+            if (campid, email, cmd) not in logged:
+                continue
+            logged.remove((campid, email, cmd))
+
+            u = unsubs.setdefault(campcid, {}).setdefault(email, [False, False])
+            u[0 if cmd == "complaint" else 1] = True
+
+            propcounts = self.campprops.setdefault((campid, is_camp), {})
+            propcounts[campprops[cmd]] = propcounts.get(campprops[cmd], 0) + 1
+
+            if hourkey is not None:
+                self.complaints[hourkey] = self.complaints.get(hourkey, 0) + 1
+
+            if cmd == "bounce":
+                webhookev["code"] = code
+                webhookev["bouncetype"] = "hard"
+            self.webhooks.append((campcid, webhookev))
+
+        # the contacts are locked in id order so that concurrent batches
+        # don't deadlock on them
+        for (campcid, prop), emails in sorted(props.items()):
+            countprop = prop.lower().replace(" ", "_")
+            counts = ", ".join(
+                "count(w.contact_id)" if col == countprop else "0"
+                for col in ("bounced", "complained", "unsubscribed", "soft_bounced")
+            )
+            if db.execute(
+                f"""
+                with c as (
+                    select contact_id from contacts."contacts_{campcid}" where email = any(%s)
+                    order by contact_id for update
+                ), w as (
+                    update contacts."contacts_{campcid}" t set props = t.props || %s
+                    from c where t.contact_id = c.contact_id and (t.props->>%s is null or (t.props->%s in (
+                        '[""]'::jsonb, '["false"]'::jsonb, '["f"]'::jsonb, '["n"]'::jsonb, '["no"]'::jsonb
+                    )))
+                    returning t.contact_id
+                )
+                insert into list_deltas (list_id, property, active30, active60, active90, bounced, complained, unsubscribed, soft_bounced)
+                select l.list_id, %s, 0, 0, 0, {counts}
+                from c join contacts."contact_lists_{campcid}" l on l.contact_id = c.contact_id
+                left join w on w.contact_id = c.contact_id
+                group by l.list_id""",
+                sorted(emails),
+                {prop: ["true"]},
+                prop,
+                prop,
+                prop,
+            ).rowcount:
+                self.list_deltas = True
+
+        for campcid, flags in sorted(unsubs.items()):
+            unsubemails = sorted(flags)
+            # contacts that aren't in the tenant get the rawhash
+            # get_contact_id gives them
+            db.execute(
+                f"""insert into unsublogs (cid, email, rawhash, unsubscribed, complained, bounced)
+                    select %s, u.email, coalesce(c.contact_id, 999999999), false, u.complained, u.bounced
+                    from unnest(%s::text[], %s::boolean[], %s::boolean[]) as u(email, complained, bounced)
+                    left join contacts."contacts_{campcid}" c on c.email = u.email
+                    on conflict (cid, email) do update set
+                    unsubscribed = (unsublogs.unsubscribed or excluded.unsubscribed),
+                    complained = (unsublogs.complained or excluded.complained),
+                    bounced = (unsublogs.bounced or excluded.bounced)""",
+                campcid,
+                unsubemails,
+                [flags[email][0] for email in unsubemails],
+                [flags[email][1] for email in unsubemails],
+            )
+
+    def finish(self) -> None:
+        db = self.db
+
+        for (campid, sendtag), emails in self.sends.items():
+            contacts.add_send(db, campid, emails, txntag=sendtag)
+
+        webhooks: Dict[str, List[JsonObj]] = {}
+        for cid, webhookev in self.webhooks:
+            webhooks.setdefault(cid, []).append(webhookev)
+        for cid, evs in webhooks.items():
+            send_webhooks(db, cid, evs)
+
+        if self.list_deltas:
+            contacts.schedule_list_rollup()
+
+        # open and click events that arrived before their delivery event
+        if self.delivered:
+            pipe = self.rdb.pipeline()
+            for trackingid in self.delivered:
+                trackingkey = "tracking-%s" % trackingid
+                pipe.lrange(trackingkey, 0, -1).delete(trackingkey)
+            pending = pipe.execute()[::2]
+            for (trackingid, (sinkid, settingsid, ip, ts)), pendingevents in zip(
+                self.delivered.items(), pending
+            ):
+                for ev in pendingevents:
+                    log.info("Got pending event %s for tracking ID %s", ev, trackingid)
+                    evo = json.loads(ev)
+                    process_track_event(
+                        db,
+                        evo["t"],
+                        evo["c"],
+                        evo["u"],
+                        sinkid,
+                        settingsid,
+                        evo["txntag"],
+                        evo["txnmsgid"],
+                        ip,
+                        ts,
+                        evo["index"],
+                        evo["track"],
+                        evo["clientip"],
+                        evo["useragent"],
+                    )
+
+
+def _hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def write_test_log(db: DB, usercid: str, email: str, ts: datetime, msg: str) -> None:
+    db.set_cid(usercid)
+    db.testlogs.add(
+        {
+            "to": email,
+            "ts": ts.isoformat() + "Z",
+            "msg": msg,
+        }
+    )
+    db.execute(
+        "delete from testlogs where cid = %s and id not in (select id from testlogs where cid = %s order by data->>'ts' desc limit 12)",
+        usercid,
+        usercid,
+    )
+    db.set_cid(None)
+
+
+def record_delivery(
+    batch: WebhookBatch,
+    cid: str,
+    campcid: str,
+    campid: str,
+    is_camp: bool,
+    txntag: str | None,
+    ts: datetime,
+    sinkid: str,
+    domain: str,
+    ip: str,
+    settingsid: str,
+    send: int,
+    soft: int,
+    hard: int,
+    err: int,
+    defercnt: int,
+) -> None:
+    batch.add_hourstats(
+        cid,
+        campcid,
+        ts,
+        sinkid,
+        domain,
+        ip,
+        settingsid,
+        campid,
+        send,
+        soft,
+        hard,
+        err,
+        defercnt,
+    )
+    if campid.startswith("tx-"):
+        assert txntag is not None
+        batch.add_txnstats(campcid, ts, txntag, domain, send, soft, hard)
 
+    if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
+        batch.add_campcounts(campid, is_camp, send, soft, hard)
 
-def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
+
+def record_msg(
+    batch: WebhookBatch,
+    msgtype: str,
+    cid: str,
+    campcid: str,
+    campid: str,
+    txntag: str | None,
+    ts: datetime,
+    sinkid: str,
+    domain: str,
+    ip: str,
+    settingsid: str,
+    msg: str,
+) -> None:
+    batch.add_statmsg(cid, ts, sinkid, domain, ip, settingsid, campid, msg, msgtype)
+    if campid.startswith("tx-"):
+        assert txntag is not None
+        batch.add_txnmsg(campcid, ts, txntag, domain, msg, msgtype)
+
+
+def process_ses_webhook(db: DB, batch: WebhookBatch, jsonobj: JsonObj) -> None:
     eventtype = jsonobj["eventtype"]
     email = jsonobj["email"]
     domain = jsonobj["domain"]
@@ -1908,36 +2524,20 @@ def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
 
     ts = dateutil.parser.parse(ts).replace(tzinfo=None)
 
-    row = db.row(
-        "select settingsid, cid, campid, is_camp, trackingid, ts from sesmessages where id = %s",
-        messageid,
-    )
+    row = batch.sesmessage(messageid)
     if row is None:
         return
 
     settingsid, usercid, campid, is_camp, trackingid, msgts = row
 
-    co = db.companies.get(usercid)
+    co = batch.company(usercid)
     if co is None:
         log.error("Company %s not found", usercid)
         return
     cid = co["cid"]
 
     if campid == "test":
-        db.set_cid(usercid)
-        db.testlogs.add(
-            {
-                "to": email,
-                "ts": ts.isoformat() + "Z",
-                "msg": msg,
-            }
-        )
-        db.execute(
-            "delete from testlogs where cid = %s and id not in (select id from testlogs where cid = %s order by data->>'ts' desc limit 12)",
-            usercid,
-            usercid,
-        )
-        db.set_cid(None)
+        write_test_log(db, usercid, email, ts, msg)
         return
 
     camp = None
@@ -1945,25 +2545,12 @@ def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
     txntag = None
     txnmsgid = None
     if len(campid) <= 30:
-        if is_camp:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                    campid,
-                )
-            )
-        else:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from messages where id = %s",
-                    campid,
-                )
-            )
+        camp = batch.campaign(campid, is_camp)
         if camp is None or camp.get("archived", False):
             return
         campcid = camp["cid"]
     else:
-        campcid, txntag, txnmsgid = get_txn(db, campid)
+        campcid, txntag, txnmsgid = batch.txn(campid)
         if campcid is None:
             return
         campid = "tx-%s" % campcid
@@ -1985,10 +2572,11 @@ def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
             msgtype = "soft"
 
     if msgtype == "send":
-        contacts.add_send(db, campid, [email], txntag=txntag)
+        batch.add_send(campid, txntag, email)
     elif msgtype in ("hard", "complaint"):
         if campid.startswith("tx-"):
             assert txntag is not None
+            evs: List[JsonObj] = []
             write_txn(
                 db,
                 email,
@@ -2007,97 +2595,82 @@ def process_ses_webhook(db: DB, jsonobj: JsonObj) -> None:
                 True,
                 "",
                 "",
+                webhooks=evs,
             )
+            batch.add_webhooks(campcid, evs)
         else:
             assert camp is not None
-            write_list(
-                db,
-                email,
-                msgtype,
-                camp,
+            batch.add_contact_event(
+                camp["cid"],
+                campid,
                 is_camp,
-                settingsid,
-                ip,
-                domain,
+                email,
+                "bounce" if msgtype == "hard" else msgtype,
+                msg,
                 cid,
-                sinkid,
                 msgts,
-                msg,
-                -1,
-                True,
-                "",
-                "",
+                sinkid,
+                domain,
+                ip,
+                settingsid,
             )
     elif msgtype == "soft":
         if campid.startswith("tx-") or camp is not None:
-            handle_soft_event(db, email, campid, campcid, is_camp, msg)
+            batch.add_contact_event(
+                campcid,
+                campid,
+                is_camp,
+                email,
+                "soft",
+                msg,
+                cid,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+            )
 
     if msgtype in ("send", "soft", "hard") and txnmsgid is not None:
         write_txnsend(db, campcid, txnmsgid, msgtype, msg)
 
     if msgtype != "complaint":
-        hourstats_insert(
-            db,
+        record_delivery(
+            batch,
             cid,
             campcid,
+            campid,
+            is_camp,
+            txntag,
             ts,
             sinkid,
             domain,
             ip,
             settingsid,
-            campid,
-            0,
-            0,
-            0,
-            0,
             send,
             soft,
             hard,
             err,
             defercnt,
         )
-        if campid.startswith("tx-"):
-            assert txntag is not None
-            txnstats_insert(
-                db, campcid, ts, txntag, domain, 0, 0, 0, 0, 0, 0, send, soft, hard
-            )
-
-        if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-
         if msgtype != "send" and msg:
-            statmsgs_insert(
-                db, cid, ts, sinkid, domain, ip, settingsid, campid, msg, msgtype
+            record_msg(
+                batch,
+                msgtype,
+                cid,
+                campcid,
+                campid,
+                txntag,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+                msg,
             )
-            if campid.startswith("tx-"):
-                assert txntag is not None
-                txnmsgs_insert(db, campcid, ts, txntag, domain, msg, msgtype)
 
 
-def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None:  # type: ignore
+def process_sp_webhook(db: DB, batch: WebhookBatch, jsonobj: JsonObj) -> None:
     event_id = jsonobj.get("event_id")
     eventtype = jsonobj["eventtype"]
     bounceclass = jsonobj["bounceclass"]
@@ -2113,17 +2686,13 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
     is_camp = jsonobj["is_camp"]
     trackingid = jsonobj["trackingid"]
 
-    is_new = db.single(
-        "insert into sparkpost_events (id) values (%s) on conflict (id) do nothing returning id",
-        event_id,
-    )
-    if not is_new:
+    if not batch.is_new_sp_event(event_id):
         log.info("Duplicate Sparkpost event ID %s, ignoring", event_id)
         return
 
     ts = datetime.utcfromtimestamp(int(ts))
 
-    co = db.companies.get(usercid)
+    co = batch.company(usercid)
     if co is None:
         log.error("Company %s not found", usercid)
         return
@@ -2133,45 +2702,19 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
         return
 
     if campid == "test":
-        db.set_cid(usercid)
-        db.testlogs.add(
-            {
-                "to": email,
-                "ts": ts.isoformat() + "Z",
-                "msg": msg,
-            }
-        )
-        db.execute(
-            "delete from testlogs where cid = %s and id not in (select id from testlogs where cid = %s order by data->>'ts' desc limit 12)",
-            usercid,
-            usercid,
-        )
-        db.set_cid(None)
+        write_test_log(db, usercid, email, ts, msg)
         return
 
     camp = None
     txntag = None
     txnmsgid = None
     if len(campid) <= 30:
-        if is_camp:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                    campid,
-                )
-            )
-        else:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from messages where id = %s",
-                    campid,
-                )
-            )
+        camp = batch.campaign(campid, is_camp)
         if camp is None or camp.get("archived", False):
             return
         campcid = camp["cid"]
     else:
-        campcid, txntag, txnmsgid = get_txn(db, campid)
+        campcid, txntag, txnmsgid = batch.txn(campid)
         if campcid is None:
             return
         campid = "tx-%s" % campcid
@@ -2196,42 +2739,10 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             msgtype = "soft"
 
     if msgtype == "send":
-        db.execute(
-            """insert into sptracking (id, ip, settingsid, ts) values (%s, %s, %s, %s)
-                      on conflict (id) do update set ip = excluded.ip, settingsid = excluded.settingsid, ts = excluded.ts""",
-            trackingid,
-            ip,
-            settingsid,
-            ts,
-        )
-        contacts.add_send(db, campid, [email], txntag=txntag)
-
-        trackingkey = "tracking-%s" % trackingid
-        pendingevents = (
-            rdb.pipeline().lrange(trackingkey, 0, -1).delete(trackingkey).execute()[0]
-        )
-        if pendingevents:
-            for ev in pendingevents:
-                log.info("Got pending event %s for tracking ID %s", ev, trackingid)
-                evo = json.loads(ev)
-                process_track_event(
-                    db,
-                    evo["t"],
-                    evo["c"],
-                    evo["u"],
-                    sinkid,
-                    settingsid,
-                    evo["txntag"],
-                    evo["txnmsgid"],
-                    ip,
-                    ts,
-                    evo["index"],
-                    evo["track"],
-                    evo["clientip"],
-                    evo["useragent"],
-                )
+        batch.add_tracking("sptracking", trackingid, ip, settingsid, ts, sinkid)
+        batch.add_send(campid, txntag, email)
     elif msgtype in ("hard", "complaint"):
-        trackrow = db.row("select ip, ts from sptracking where id = %s", trackingid)
+        trackrow = batch.last_tracking("sptracking", trackingid)
         msgts = None
         if trackrow is not None:
             if not ip:
@@ -2241,6 +2752,7 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
             ip = "pool"
         if campid.startswith("tx-"):
             assert txntag is not None
+            evs: List[JsonObj] = []
             write_txn(
                 db,
                 email,
@@ -2259,30 +2771,41 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
                 True,
                 "",
                 "",
+                webhooks=evs,
             )
+            batch.add_webhooks(campcid, evs)
         else:
             assert camp is not None
-            write_list(
-                db,
-                email,
-                msgtype,
-                camp,
+            batch.add_contact_event(
+                camp["cid"],
+                campid,
                 is_camp,
-                settingsid,
-                ip,
-                domain,
+                email,
+                "bounce" if msgtype == "hard" else msgtype,
+                msg,
                 cid,
-                sinkid,
                 msgts,
-                msg,
-                -1,
-                True,
-                "",
-                "",
+                sinkid,
+                domain,
+                ip,
+                settingsid,
             )
     elif msgtype == "soft":
         if campid.startswith("tx-") or camp is not None:
-            handle_soft_event(db, email, campid, campcid, is_camp, msg)
+            batch.add_contact_event(
+                campcid,
+                campid,
+                is_camp,
+                email,
+                "soft",
+                msg,
+                cid,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+            )
 
     if msgtype in ("send", "soft", "hard") and txnmsgid is not None:
         write_txnsend(db, campcid, txnmsgid, msgtype, msg)
@@ -2290,68 +2813,42 @@ def process_sp_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
     if msgtype != "complaint":
         if not ip:
             ip = "pool"
-        hourstats_insert(
-            db,
+        record_delivery(
+            batch,
             cid,
             campcid,
+            campid,
+            is_camp,
+            txntag,
             ts,
             sinkid,
             domain,
             ip,
             settingsid,
-            campid,
-            0,
-            0,
-            0,
-            0,
             send,
             soft,
             hard,
             err,
             defercnt,
         )
-        if campid.startswith("tx-"):
-            assert txntag is not None
-            txnstats_insert(
-                db, campcid, ts, txntag, domain, 0, 0, 0, 0, 0, 0, send, soft, hard
-            )
-
-        if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-
         if msgtype != "send":
-            statmsgs_insert(
-                db, cid, ts, sinkid, domain, ip, settingsid, campid, msg, msgtype
+            record_msg(
+                batch,
+                msgtype,
+                cid,
+                campcid,
+                campid,
+                txntag,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+                msg,
             )
-            if campid.startswith("tx-"):
-                assert txntag is not None
-                txnmsgs_insert(db, campcid, ts, txntag, domain, msg, msgtype)
 
 
-def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None:  # type: ignore
+def process_mg_webhook(db: DB, batch: WebhookBatch, jsonobj: JsonObj) -> None:
     eventtype = jsonobj["eventtype"]
     severity = jsonobj["severity"]
     reason = jsonobj["reason"]
@@ -2369,7 +2866,7 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
 
     ts = datetime.utcfromtimestamp(ts)
 
-    co = db.companies.get(usercid)
+    co = batch.company(usercid)
     if co is None:
         log.error("Company %s not found", usercid)
         return
@@ -2379,45 +2876,19 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
         return
 
     if campid == "test":
-        db.set_cid(usercid)
-        db.testlogs.add(
-            {
-                "to": email,
-                "ts": ts.isoformat() + "Z",
-                "msg": msg,
-            }
-        )
-        db.execute(
-            "delete from testlogs where cid = %s and id not in (select id from testlogs where cid = %s order by data->>'ts' desc limit 12)",
-            usercid,
-            usercid,
-        )
-        db.set_cid(None)
+        write_test_log(db, usercid, email, ts, msg)
         return
 
     camp = None
     txntag = None
     txnmsgid = None
     if len(campid) <= 30:
-        if is_camp:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s",
-                    campid,
-                )
-            )
-        else:
-            camp = json_obj(
-                db.row(
-                    "select id, cid, data - 'parts' - 'rawText' from messages where id = %s",
-                    campid,
-                )
-            )
+        camp = batch.campaign(campid, is_camp)
         if camp is None or camp.get("archived", False):
             return
         campcid = camp["cid"]
     else:
-        campcid, txntag, txnmsgid = get_txn(db, campid)
+        campcid, txntag, txnmsgid = batch.txn(campid)
         if campcid is None:
             return
         campid = "tx-%s" % campcid
@@ -2443,42 +2914,10 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
                 msgtype = "soft"
 
     if msgtype == "send":
-        db.execute(
-            """insert into mgtracking (id, ip, settingsid, ts) values (%s, %s, %s, %s)
-                      on conflict (id) do update set ip = excluded.ip, settingsid = excluded.settingsid, ts = excluded.ts""",
-            trackingid,
-            ip,
-            settingsid,
-            ts,
-        )
-        contacts.add_send(db, campid, [email], txntag=txntag)
-
-        trackingkey = "tracking-%s" % trackingid
-        pendingevents = (
-            rdb.pipeline().lrange(trackingkey, 0, -1).delete(trackingkey).execute()[0]
-        )
-        if pendingevents:
-            for ev in pendingevents:
-                log.info("Got pending event %s for tracking ID %s", ev, trackingid)
-                evo = json.loads(ev)
-                process_track_event(
-                    db,
-                    evo["t"],
-                    evo["c"],
-                    evo["u"],
-                    sinkid,
-                    settingsid,
-                    evo["txntag"],
-                    evo["txnmsgid"],
-                    ip,
-                    ts,
-                    evo["index"],
-                    evo["track"],
-                    evo["clientip"],
-                    evo["useragent"],
-                )
+        batch.add_tracking("mgtracking", trackingid, ip, settingsid, ts, sinkid)
+        batch.add_send(campid, txntag, email)
     elif msgtype in ("hard", "complaint"):
-        trackrow = db.row("select ip, ts from mgtracking where id = %s", trackingid)
+        trackrow = batch.last_tracking("mgtracking", trackingid)
         msgts = None
         if trackrow is not None:
             if not ip:
@@ -2489,6 +2928,7 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
         if ip:
             if campid.startswith("tx-"):
                 assert txntag is not None
+                evs: List[JsonObj] = []
                 write_txn(
                     db,
                     email,
@@ -2507,94 +2947,134 @@ def process_mg_webhook(db: DB, rdb: redis.StrictRedis, jsonobj: JsonObj) -> None
                     True,
                     "",
                     "",
+                    webhooks=evs,
                 )
+                batch.add_webhooks(campcid, evs)
             else:
                 assert camp is not None
-                write_list(
-                    db,
-                    email,
-                    msgtype,
-                    camp,
+                batch.add_contact_event(
+                    camp["cid"],
+                    campid,
                     is_camp,
-                    settingsid,
-                    ip,
-                    domain,
+                    email,
+                    "bounce" if msgtype == "hard" else msgtype,
+                    msg,
                     cid,
-                    sinkid,
                     msgts,
-                    msg,
-                    -1,
-                    True,
-                    "",
-                    "",
+                    sinkid,
+                    domain,
+                    ip,
+                    settingsid,
                 )
     elif msgtype == "soft":
         if campid.startswith("tx-") or camp is not None:
-            handle_soft_event(db, email, campid, campcid, is_camp, msg)
+            batch.add_contact_event(
+                campcid,
+                campid,
+                is_camp,
+                email,
+                "soft",
+                msg,
+                cid,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+            )
 
     if msgtype in ("send", "soft", "hard") and txnmsgid is not None:
         write_txnsend(db, campcid, txnmsgid, msgtype, msg)
 
     if msgtype != "complaint":
-        hourstats_insert(
-            db,
+        record_delivery(
+            batch,
             cid,
             campcid,
+            campid,
+            is_camp,
+            txntag,
             ts,
             sinkid,
             domain,
             ip,
             settingsid,
-            campid,
-            0,
-            0,
-            0,
-            0,
             send,
             soft,
             hard,
             err,
             defercnt,
         )
-        if campid.startswith("tx-"):
-            assert txntag is not None
-            txnstats_insert(
-                db, campcid, ts, txntag, domain, 0, 0, 0, 0, 0, 0, send, soft, hard
+        if msgtype != "send":
+            record_msg(
+                batch,
+                msgtype,
+                cid,
+                campcid,
+                campid,
+                txntag,
+                ts,
+                sinkid,
+                domain,
+                ip,
+                settingsid,
+                msg,
             )
 
-        if (send > 0 or soft > 0 or hard > 0) and not campid.startswith("tx-"):
-            if is_camp:
-                db.execute(
-                    """update campaigns set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                     'send', (data->>'send')::int + %s,
-                                                                                     'hard', (data->>'hard')::int + %s,
-                                                                                     'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
-            else:
-                db.execute(
-                    """update messages set data = data || jsonb_build_object('delivered', (data->>'delivered')::int + %s,
-                                                                                    'send', (data->>'send')::int + %s,
-                                                                                    'hard', (data->>'hard')::int + %s,
-                                                                                    'soft', (data->>'soft')::int + %s) where id = %s""",
-                    send + soft + hard,
-                    send,
-                    hard,
-                    soft,
-                    campid,
-                )
 
-        if msgtype != "send":
-            statmsgs_insert(
-                db, cid, ts, sinkid, domain, ip, settingsid, campid, msg, msgtype
-            )
-            if campid.startswith("tx-"):
-                assert txntag is not None
-                txnmsgs_insert(db, campcid, ts, txntag, domain, msg, msgtype)
+def requeue_webhooks(rdb: redis.StrictRedis, lname: str, objs: List[JsonObj]) -> None:  # type: ignore
+    """Puts webhooks back at the end of lname that pop_batch takes from, so
+    they are the next ones processed, dropping those that have failed
+    WEBHOOK_MAX_ATTEMPTS times."""
+    retry = []
+    for obj in objs:
+        obj["attempts"] = obj.get("attempts", 0) + 1
+        if obj["attempts"] >= WEBHOOK_MAX_ATTEMPTS:
+            log.error("Dropping webhook %s after %s attempts", obj, obj["attempts"])
+        else:
+            retry.append(json.dumps(obj))
+    if retry:
+        rdb.rpush(lname, *retry)
+
+
+def process_webhook_batch(db: DB, rdb: redis.StrictRedis, lname: str, objs: List[JsonObj]) -> None:  # type: ignore
+    batch = WebhookBatch(db, rdb)
+    failed: List[JsonObj] = []
+    try:
+        with db.transaction():
+            batch.load(objs)
+
+            for obj in objs:
+                # an event that fails is rolled back on its own and retried,
+                # leaving the rest of the batch to commit
+                batch.begin(obj)
+                db.execute("savepoint webhook")
+                try:
+                    if obj["type"] == "mg":
+                        process_mg_webhook(db, batch, obj)
+                    elif obj["type"] == "sp":
+                        process_sp_webhook(db, batch, obj)
+                    else:
+                        process_ses_webhook(db, batch, obj)
+                except Exception:
+                    log.exception("error processing webhook %s", obj)
+                    db.execute("rollback to savepoint webhook")
+                    batch.discard()
+                    failed.append(obj)
+                    continue
+                db.execute("release savepoint webhook")
+
+            batch.flush()
+    except Exception:
+        # nothing was written, the Sparkpost event id claims included, so the
+        # retry processes the whole batch again
+        requeue_webhooks(rdb, lname, objs)
+        raise
+
+    if failed:
+        requeue_webhooks(rdb, lname, failed)
+
+    batch.finish()
 
 
 def process_webhooks(checkcancel: Callable[[], bool]) -> None:
@@ -2607,21 +3087,15 @@ def process_webhooks(checkcancel: Callable[[], bool]) -> None:
             cnt = 0
 
             while True:
-                jsondata = rdb.rpop(lname)
-                if jsondata is None:
+                items = pop_batch(rdb, lname, PENDING_BATCH_SIZE)
+                if not items:
                     break
 
-                log.info("Got: %s", jsondata)
-                obj = json.loads(jsondata)
+                log.info("Got %s webhooks", len(items))
 
-                if obj["type"] == "mg":
-                    process_mg_webhook(db, rdb, obj)
-                elif obj["type"] == "sp":
-                    process_sp_webhook(db, rdb, obj)
-                else:
-                    process_ses_webhook(db, obj)
+                process_webhook_batch(db, rdb, lname, [json.loads(i) for i in items])
 
-                cnt += 1
+                cnt += len(items)
 
                 if checkcancel():
                     log.info("Process terminated")
@@ -2640,6 +3114,8 @@ class SPWebHook(object):
         if not doc:
             raise falcon.HTTPNotAcceptable(title="A valid JSON document is required.")
 
+        # the whole delivery goes onto the queue in one command
+        pending = []
         for msys in doc:
             event = msys["msys"]["message_event"]
             event_id = event["event_id"]
@@ -2657,7 +3133,7 @@ class SPWebHook(object):
             ts = event["timestamp"]
 
             if "rcpt_meta" not in event or "settingsid" not in event["rcpt_meta"]:
-                return  # probably for an internal transactional email
+                break  # probably for an internal transactional email
 
             emailmatch = emailre.search(email)
             if emailmatch:
@@ -2666,7 +3142,7 @@ class SPWebHook(object):
                 log.error(
                     "Sparkpost webhook error: bad destination email address '%s'", email
                 )
-                return
+                break
 
             uservars = event["rcpt_meta"]
 
@@ -2676,10 +3152,7 @@ class SPWebHook(object):
             is_camp = uservars["is_camp"] == "True"
             trackingid = uservars["trackingid"]
 
-            rdb = redis_connect()
-
-            rdb.lpush(
-                "webhooks-pending",
+            pending.append(
                 json.dumps(
                     {
                         "type": "sp",
@@ -2699,9 +3172,12 @@ class SPWebHook(object):
                         "is_camp": is_camp,
                         "trackingid": trackingid,
                     }
-                ),
+                )
             )
 
+        if pending:
+            redis_connect().lpush("webhooks-pending", *pending)
+
 
 class MGWebHook(object):
 
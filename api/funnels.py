@@ -1,4 +1,6 @@
 import os
+import math
+import time
 import falcon
 from datetime import datetime, timedelta
 import hashlib
@@ -14,7 +16,7 @@ from dateutil.tz import tzutc
 import json
 import urllib.parse
 from html import escape as html_escape
-from typing import List, Dict, Any, Set, cast
+from typing import List, Dict, Any, Set, Tuple, cast
 
 from .shared import config as config_module_side_effects  # noqa: F401
 from .shared.db import open_db, json_obj, json_iter, JsonObj, DB
@@ -40,6 +42,8 @@ from .shared.utils import (
     MTA_TIMEOUT,
     fix_sink_url,
     check_plan_limits,
+    redis_connect,
+    pop_batch,
 )
 from .shared.segments import (
     get_segment_rows,
@@ -47,7 +51,8 @@ from .shared.segments import (
     segment_get_segments,
     segment_get_campaignids,
     get_segment_sentrows,
-    supp_rows,
+    supp_digests,
+    HASHLIMIT_CAP,
     Cache,
 )
 from .shared.send import (
@@ -172,7 +177,7 @@ class Funnel(CRUDSingle):
         segments = db.segments.get_all()
 
         for (msgid,) in db.execute(
-            "select id from messages where data->>'funnel' = %s", id
+            "select id from messages where data_funnel = %s", id
         ):
             msg_del_check(segments, msgid)
 
@@ -202,7 +207,7 @@ class FunnelMessages(object):
         req.context["result"] = [
             json_obj(row)
             for row in db.execute(
-                "select id, cid, data - 'parts' - 'rawText' from messages where data->>'funnel' = %s and cid = %s",
+                "select id, cid, data - 'parts' - 'rawText' from messages where data_funnel = %s and cid = %s",
                 id,
                 db.get_cid(),
             )
@@ -597,10 +602,116 @@ class MessageTest(object):
 
 CHECK_FUNNELS_LOCK = 49080983
 
+# funnelqueue rows moved into funneldue per statement
+FUNNEL_PROMOTE_BATCH_SIZE = 50000
+
+
+def promote_due_funnels(db: DB, ts: datetime) -> int | None:
+    """Adds funnelqueue rows that have come due by ts to the per-bucket counts
+    in funneldue. Each row is promoted once, so a tick only looks at rows that
+    came due since the previous one. Returns None without promoting anything
+    if another tick holds CHECK_FUNNELS_LOCK."""
+    total = 0
+    while True:
+        # the rows are locked as they are picked and rows locked by another
+        # promotion are skipped, so that no row is counted twice
+        with db.transaction():
+            if not db.single(f"select pg_try_advisory_xact_lock({CHECK_FUNNELS_LOCK})"):
+                return None
+            cnt = db.single(
+                """with promoted as (
+                       update funnelqueue set due = true where id in (
+                           select id from funnelqueue
+                           where not sent and not due and domain is not null and ts <= %s
+                           limit %s
+                           for update skip locked
+                       )
+                       returning cid, messageid, domain, mod(rawhash, %s) bucket
+                   ), counted as (
+                       insert into funneldue (cid, messageid, domain, bucket, count)
+                       select cid, messageid, domain, bucket, count(*) from promoted
+                       group by cid, messageid, domain, bucket
+                       on conflict (cid, messageid, domain, bucket) do update set count = funneldue.count + excluded.count
+                   )
+                   select count(*) from promoted""",
+                ts,
+                FUNNEL_PROMOTE_BATCH_SIZE,
+                HASHLIMIT_CAP,
+            )
+        total += cnt
+        if cnt < FUNNEL_PROMOTE_BATCH_SIZE:
+            break
+
+    # counts for messages that have since been deleted would never be sent
+    # and would keep their company in every tick
+    db.execute(
+        """delete from funneldue d
+           where count <= 0 or not exists (select from messages m where m.id = d.messageid)"""
+    )
+
+    return total
+
+
+def recount_funnel_due(
+    db: DB, cid: str, messageid: str, domain: str, hashlimit: int, hashval: int
+) -> None:
+    # lock the counts first so promotions that commit after the recount's
+    # snapshot are added on top of it rather than lost
+    db.execute(
+        """select from funneldue where cid = %s and messageid = %s and domain = %s and (%s = 1 or mod(bucket, %s) = %s)
+           for update""",
+        cid,
+        messageid,
+        domain,
+        hashlimit,
+        hashlimit,
+        hashval,
+    )
+    db.execute(
+        """update funneldue d set count = (
+               select count(*) from funnelqueue q
+               where q.cid = d.cid and q.messageid = d.messageid and q.domain = d.domain and q.due and (not q.sent)
+               and mod(q.rawhash, %s) = d.bucket
+           )
+           where cid = %s and messageid = %s and domain = %s and (%s = 1 or mod(bucket, %s) = %s)""",
+        HASHLIMIT_CAP,
+        cid,
+        messageid,
+        domain,
+        hashlimit,
+        hashlimit,
+        hashval,
+    )
+
+
+def get_funnel_routes(db: DB, cid: str, messageids: List[str]) -> Dict[str, Any]:
+    """Returns the postal route each message is sent with, leaving out
+    messages that no longer belong to a funnel."""
+    routes: Dict[str, Any] = {}
+    for messageid, route in db.execute(
+        """select m.id,
+           case coalesce(a->>'msgroute', '')
+           when '' then f.data->>'route'
+           else a->>'msgroute' end r
+           from messages m
+           inner join funnels f on f.id = m.data_funnel and m.cid = f.cid
+           left join jsonb_array_elements(f.data->'messages') a on a->>'id' = m.id
+           where m.id = any(%s) and m.cid = %s""",
+        messageids,
+        cid,
+    ):
+        routes.setdefault(messageid, route)
+    return routes
+
 
 def check_funnels() -> None:
     with open_db() as db:
         try:
+            ts = datetime.utcnow()
+
+            if promote_due_funnels(db, ts) is None:
+                return
+
             with db.transaction():
                 if not db.single(
                     f"select pg_try_advisory_xact_lock({CHECK_FUNNELS_LOCK})"
@@ -611,7 +722,7 @@ def check_funnels() -> None:
                         db.execute(
                             """
                     select id, cid, data from companies where data @> %s and id in (
-                        select distinct cid from funnelqueue where not sent
+                        select cid from funneldue where count > 0
                     )
                 """,
                             {"admin": False},
@@ -635,28 +746,33 @@ def check_funnels() -> None:
                             for l in db.lists.get_all()
                             if not l.get("unapproved", False)
                         ]
-                        ts = datetime.utcnow()
-
-                        hashlimit = segments.get_hashlimit(db, cid)
+                        # funneldue buckets are contact ids modulo
+                        # HASHLIMIT_CAP, so they can only be split by a
+                        # hashlimit that divides it; a tenant whose stored
+                        # hashlimit predates the cap (or a lowered
+                        # hashlimit_max) is split by their common divisor
+                        hashlimit = math.gcd(
+                            segments.get_hashlimit(db, cid), HASHLIMIT_CAP
+                        )
 
-                        for hashval, messageid, route, domain, cnt in list(
+                        due = list(
                             db.execute(
-                                """select mod(rawhash, %s) h, messageid,
-                                case coalesce(a->>'msgroute', '')
-                                when '' then f.data->>'route'
-                                else a->>'msgroute' end r,
-                                domain, count(email)
-                                from funnelqueue q
-                                inner join messages m on q.messageid = m.id and q.cid = m.cid
-                                inner join funnels f on f.id = m.data->>'funnel' and m.cid = f.cid
-                                left join jsonb_array_elements(f.data->'messages') a on a->>'id' = m.id
-                                where ts <= %s and q.cid = %s and (not sent)
-                                group by h, messageid, r, domain""",
+                                """select mod(bucket, %s) h, messageid, domain, sum(count)::bigint
+                                from funneldue where cid = %s and count > 0
+                                group by h, messageid, domain""",
                                 hashlimit,
-                                ts,
                                 cid,
                             )
-                        ):
+                        )
+
+                        routes = get_funnel_routes(
+                            db, cid, list(set(messageid for _, messageid, _, _ in due))
+                        )
+
+                        for hashval, messageid, domain, cnt in due:
+                            route = routes.get(messageid)
+                            if route is None:
+                                continue
                             if cnt > 0:
                                 requesting = cnt
                                 cnt = check_send_limit(
@@ -759,7 +875,7 @@ def send_message(
                 if reverse_order:
                     for rowid, email in db.execute(
                         """select id, email from funnelqueue
-                                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and messageid = %s and domain = %s and (not sent)
+                                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and messageid = %s and domain = %s and (not sent) and due
                                                 order by id desc limit %s""",
                         ts,
                         cid,
@@ -776,7 +892,7 @@ def send_message(
                 else:
                     for rowid, email in db.execute(
                         """select id, email from funnelqueue
-                                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and messageid = %s and domain = %s and (not sent)
+                                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and messageid = %s and domain = %s and (not sent) and due
                                                 order by id asc limit %s""",
                         ts,
                         cid,
@@ -792,6 +908,9 @@ def send_message(
                             lastid = rowid
 
                 if lastid is None:
+                    # nothing is due in these buckets after all, so their
+                    # counts have drifted from the queue
+                    recount_funnel_due(db, cid, messageid, domain, hashlimit, hashval)
                     return
 
                 if (
@@ -816,8 +935,11 @@ def send_message(
                     suppfactors = [
                         supplist["id"] for supplist in supplists if supplist is not None
                     ]
-                    supprows = supp_rows(
-                        db, msg["cid"], hashval, hashlimit, suppfactors
+                    supprows = supp_digests(
+                        db,
+                        msg["cid"],
+                        suppfactors,
+                        (hashlib.md5(e.encode("utf-8")).hexdigest() for e in emails),
                     )
 
                     listfactors = [l["id"] for l in alllists]
@@ -1276,9 +1398,15 @@ def send_message(
 
                 if reverse_order:
                     db.execute(
-                        """update funnelqueue set sent = true
-                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and (not sent) and
-                                messageid = %s and domain = %s and id >= %s""",
+                        """with sent as (
+                                update funnelqueue set sent = true
+                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and (not sent) and due and
+                                messageid = %s and domain = %s and id >= %s
+                                returning mod(rawhash, %s) bucket
+                            )
+                            update funneldue d set count = d.count - s.cnt
+                            from (select bucket, count(*) cnt from sent group by bucket) s
+                            where d.cid = %s and d.messageid = %s and d.domain = %s and d.bucket = s.bucket""",
                         ts,
                         cid,
                         hashlimit,
@@ -1287,12 +1415,22 @@ def send_message(
                         messageid,
                         domain,
                         lastid,
+                        HASHLIMIT_CAP,
+                        cid,
+                        messageid,
+                        domain,
                     )
                 else:
                     db.execute(
-                        """update funnelqueue set sent = true
-                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and (not sent) and
-                                messageid = %s and domain = %s and id <= %s""",
+                        """with sent as (
+                                update funnelqueue set sent = true
+                                where ts <= %s and cid = %s and (%s = 1 or mod(rawhash, %s) = %s) and (not sent) and due and
+                                messageid = %s and domain = %s and id <= %s
+                                returning mod(rawhash, %s) bucket
+                            )
+                            update funneldue d set count = d.count - s.cnt
+                            from (select bucket, count(*) cnt from sent group by bucket) s
+                            where d.cid = %s and d.messageid = %s and d.domain = %s and d.bucket = s.bucket""",
                         ts,
                         cid,
                         hashlimit,
@@ -1301,6 +1439,10 @@ def send_message(
                         messageid,
                         domain,
                         lastid,
+                        HASHLIMIT_CAP,
+                        cid,
+                        messageid,
+                        domain,
                     )
         except:
             log.exception("error")
@@ -1310,19 +1452,11 @@ class Forms(CRUDCollection):
 
     def __init__(self) -> None:
         self.domain = "forms"
+        self.large = ["parts", "rawText"]
         self.useronly = True
 
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
-        db = req.context["db"]
-
-        req.context["result"] = list(
-            json_iter(
-                db.execute(
-                    "select id, cid, data - 'parts' - 'rawText' from forms where cid = %s",
-                    db.get_cid(),
-                )
-            )
-        )
+        self.get_result(req)
 
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
         doc = req.context.get("doc")
@@ -1418,23 +1552,196 @@ def esc_html(s: str) -> str:
     return html_escape(s, quote=True)
 
 
+# forms are cached per process for this long
+FORM_CACHE_SECS = 10
+# rendered form pages and embed scripts are reused for this long while the
+# form is unchanged
+FORM_RENDER_SECS = 300
+# counters left out of a form's version so counting doesn't invalidate renders
+FORM_COUNTERS = ("views", "views_uniq", "submits", "submits_uniq")
+
+# views are counted here and written by flush_form_views
+FORMS_VIEWS_KEY = "forms-views"
+FORMS_VIEWCOOKIES_KEY = "forms-viewcookies"
+FORM_VIEWS_BATCH_SIZE = 10000
+
+_form_cache: Dict[str, Tuple[float, JsonObj | None, str]] = {}
+_render_cache: Dict[Tuple[str, str, bool], Tuple[float, str, str, str]] = {}
+
+
+def get_live_form(db: DB, id: str) -> Tuple[JsonObj | None, str]:
+    """Returns the form, or None if it is missing or disabled, along with its
+    version. "list_exists" is set on the form to whether its contact list is
+    present. The form is shared between requests and must not be modified."""
+    cached = _form_cache.get(id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+
+    form = db.forms.get(id)
+    version = ""
+    if form is not None and not form.get("disabled"):
+        form["list_exists"] = db.single(
+            "select exists (select from lists where id = %s)", form["list"]
+        )
+        version = hashlib.sha1(
+            json.dumps(
+                {k: v for k, v in form.items() if k not in FORM_COUNTERS},
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        ).hexdigest()
+    else:
+        form = None
+
+    _form_cache[id] = (time.monotonic() + FORM_CACHE_SECS, form, version)
+    return form, version
+
+
+def get_form_render(
+    kind: str, id: str, version: str, mobile: bool
+) -> Tuple[str, str] | None:
+    cached = _render_cache.get((kind, id, mobile))
+    if cached is None or cached[0] <= time.monotonic() or cached[1] != version:
+        return None
+    return cached[2], cached[3]
+
+
+def set_form_render(
+    kind: str, id: str, version: str, mobile: bool, body: str
+) -> Tuple[str, str]:
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+    _render_cache[(kind, id, mobile)] = (
+        time.monotonic() + FORM_RENDER_SECS,
+        version,
+        body,
+        etag,
+    )
+    return body, etag
+
+
+def send_form_render(
+    req: falcon.Request,
+    resp: falcon.Response,
+    content_type: str,
+    body: str,
+    etag: str,
+) -> None:
+    resp.etag = etag
+    resp.cache_control = ["no-cache"]
+    if req.if_none_match and any(
+        tag == "*" or tag == etag for tag in req.if_none_match
+    ):
+        resp.status = falcon.HTTP_304
+        return
+    resp.content_type = content_type
+    resp.text = body
+
+
+def count_form_view(req: falcon.Request, resp: falcon.Response, id: str) -> None:
+    """Buffers a view of the form in redis, setting the browser's form cookie
+    if it doesn't have one yet."""
+    formuid = req.cookies.get("edfu")
+    if not formuid:
+        formuid = shortuuid.uuid()
+        resp.set_cookie("edfu", formuid, path="/", same_site="None")
+
+    pipe = redis_connect().pipeline(transaction=False)
+    pipe.hincrby(FORMS_VIEWS_KEY, id, 1)
+    pipe.hset(FORMS_VIEWCOOKIES_KEY, "%s:%s" % (id, formuid), time.time())
+    pipe.execute()
+
+
+def write_form_views(
+    db: DB, views: Dict[str, int], cookies: List[Tuple[str, str, float]]
+) -> None:
+    """Adds buffered views to the forms' counts. Everything is written in one
+    transaction, so views put back after a failure aren't counted twice or
+    lose their uniqueness to cookie rows that were already written."""
+    with db.transaction():
+        # a view is unique when it creates the browser's cookie row for the form
+        uniq: Dict[str, int] = {}
+        for i in range(0, len(cookies), FORM_VIEWS_BATCH_SIZE):
+            chunk = cookies[i : i + FORM_VIEWS_BATCH_SIZE]
+            for formid, inserted in db.execute(
+                """insert into formcookies (formid, uid, viewed_at)
+                   select formid, uid, to_timestamp(ts) from unnest(%s::text[], %s::text[], %s::float8[]) as t(formid, uid, ts)
+                   on conflict (formid, uid) do update set viewed_at = excluded.viewed_at
+                   returning formid, xmax = 0""",
+                [formid for formid, _, _ in chunk],
+                [uid for _, uid, _ in chunk],
+                [ts for _, _, ts in chunk],
+            ):
+                if inserted:
+                    uniq[formid] = uniq.get(formid, 0) + 1
+
+        formids = sorted(views)
+        if formids:
+            db.execute(
+                """update forms f set data = f.data || jsonb_build_object('views', coalesce((f.data->>'views')::integer, 0) + v.views, 'views_uniq', coalesce((f.data->>'views_uniq')::integer, 0) + v.uniq)
+                   from unnest(%s::text[], %s::integer[], %s::integer[]) as v(id, views, uniq)
+                   where f.id = v.id""",
+                formids,
+                [views[formid] for formid in formids],
+                [uniq.get(formid, 0) for formid in formids],
+            )
+
+
+def flush_form_views() -> None:
+    rdb = redis_connect()
+
+    pipe = rdb.pipeline()
+    pipe.hgetall(FORMS_VIEWS_KEY)
+    pipe.delete(FORMS_VIEWS_KEY)
+    pipe.hgetall(FORMS_VIEWCOOKIES_KEY)
+    pipe.delete(FORMS_VIEWCOOKIES_KEY)
+    rawviews, _, rawcookies, _ = pipe.execute()
+
+    if not rawviews and not rawcookies:
+        return
+
+    views = {k.decode("utf-8"): int(v) for k, v in rawviews.items()}
+    cookies: List[Tuple[str, str, float]] = []
+    for k, v in rawcookies.items():
+        formid, uid = k.decode("utf-8").split(":", 1)
+        cookies.append((formid, uid, float(v)))
+    cookies.sort()
+
+    try:
+        with open_db() as db:
+            write_form_views(db, views, cookies)
+    except:
+        log.exception("error")
+
+        # put the views back for the next run
+        pipe = rdb.pipeline(transaction=False)
+        for k, v in rawviews.items():
+            pipe.hincrby(FORMS_VIEWS_KEY, k, int(v))
+        for k, v in rawcookies.items():
+            pipe.hsetnx(FORMS_VIEWCOOKIES_KEY, k, v)
+        pipe.execute()
+        return
+
+    log.info("Wrote %s form views", sum(views.values()))
+
+
 class ShowFormEmbed(object):
 
     def on_get(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
+        resp.vary = ("User-Agent", "Cookie")
+
         with open_db() as db:
-            form = db.forms.get(id)
+            form, version = get_live_form(db, id)
 
-            if form is None or form.get("disabled"):
+            if form is None:
                 raise falcon.HTTPForbidden()
 
-            set_onboarding(db, form["cid"], "form", "complete")
-
             now = datetime.utcnow().replace(tzinfo=tzutc())
 
+            # only forms that hide themselves need the browser's history
             lastview = None
             lastsubmit = None
             formuid = req.cookies.get("edfu")
-            if formuid:
+            if formuid and (form["hideaftersubmit"] or form["hideaftershow"]):
                 r = db.row(
                     "select viewed_at, submitted_at from formcookies where formid = %s and uid = %s",
                     id,
@@ -1443,15 +1750,6 @@ class ShowFormEmbed(object):
                 if r is not None:
                     lastview, lastsubmit = r
 
-            if "mobile" in req.get_header("User-Agent", default="").lower():
-                m = form["mobile"]
-                form["parts"] = m["parts"]
-                form["bodyStyle"] = m["bodyStyle"]
-                form["display"] = m["display"]
-                form["slidelocation"] = m["slidelocation"]
-                form["hellolocation"] = m["hellolocation"]
-                form["modaldismiss"] = m.get("modaldismiss")
-
             hide = False
             if (
                 form["hideaftersubmit"]
@@ -1481,6 +1779,25 @@ class ShowFormEmbed(object):
                 resp.text = ""
                 return
 
+            mobile = "mobile" in req.get_header("User-Agent", default="").lower()
+
+            cached = get_form_render("embed", id, version, mobile)
+            if cached is not None:
+                send_form_render(req, resp, falcon.MEDIA_JS, *cached)
+                return
+
+            set_onboarding(db, form["cid"], "form", "complete")
+
+            form = copy.deepcopy(form)
+            if mobile:
+                m = form["mobile"]
+                form["parts"] = m["parts"]
+                form["bodyStyle"] = m["bodyStyle"]
+                form["display"] = m["display"]
+                form["slidelocation"] = m["slidelocation"]
+                form["hellolocation"] = m["hellolocation"]
+                form["modaldismiss"] = m.get("modaldismiss")
+
             bs = form.get("bodyStyle", {})
             bt = bs.get("bodyType", "fixed")
             if bt == "fixed":
@@ -1747,8 +2064,12 @@ class ShowFormEmbed(object):
                 "webroot": get_webroot(),
                 "setheight": setheight,
             }
-            resp.content_type = falcon.MEDIA_JS
-            resp.text = js
+            send_form_render(
+                req,
+                resp,
+                falcon.MEDIA_JS,
+                *set_form_render("embed", id, version, mobile, js),
+            )
 
 
 class TrackForm(object):
@@ -1758,76 +2079,39 @@ class TrackForm(object):
         resp.data = GIF
 
         with open_db() as db:
-            form = db.forms.get(id)
+            form, _ = get_live_form(db, id)
 
-            if form is None or form.get("disabled"):
+            if form is None:
                 return
 
-            uniq = 1
-            formuid = req.cookies.get("edfu")
-            if formuid:
-                if db.single(
-                    "select formid from formcookies where formid = %s and uid = %s",
-                    id,
-                    formuid,
-                ):
-                    uniq = 0
-            else:
-                formuid = shortuuid.uuid()
-                resp.set_cookie("edfu", formuid, path="/", same_site="None")
-
-            db.execute(
-                """insert into formcookies (formid, uid, viewed_at) values (%s, %s, now())
-                        on conflict (formid, uid) do update set viewed_at = now()""",
-                id,
-                formuid,
-            )
-
-            db.execute(
-                "update forms set data = data || jsonb_build_object('views', coalesce((data->>'views')::integer, 0) + 1, 'views_uniq', coalesce((data->>'views_uniq')::integer, 0) + %s) where id = %s",
-                uniq,
-                id,
-            )
+            count_form_view(req, resp, id)
 
 
 class ShowForm(object):
 
     def on_get(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
+        resp.vary = ("User-Agent",)
+
         with open_db() as db:
-            form = db.forms.get(id)
+            form, version = get_live_form(db, id)
 
-            if form is None or form.get("disabled"):
+            if form is None:
                 resp.content_type = falcon.MEDIA_HTML
                 resp.text = NOFORM
                 return
 
-            mycid = form["cid"]
+            count_form_view(req, resp, id)
 
-            uniq = 1
-            formuid = req.cookies.get("edfu")
-            if formuid:
-                if db.single(
-                    "select formid from formcookies where formid = %s and uid = %s",
-                    id,
-                    formuid,
-                ):
-                    uniq = 0
-            else:
-                formuid = shortuuid.uuid()
-                resp.set_cookie("edfu", formuid, path="/", same_site="None")
+            mobile = "mobile" in req.get_header("User-Agent").lower()
 
-            db.execute(
-                """insert into formcookies (formid, uid, viewed_at) values (%s, %s, now())
-                        on conflict (formid, uid) do update set viewed_at = now()""",
-                id,
-                formuid,
-            )
+            cached = get_form_render("page", id, version, mobile)
+            if cached is not None:
+                send_form_render(req, resp, falcon.MEDIA_HTML, *cached)
+                return
 
-            db.execute(
-                "update forms set data = data || jsonb_build_object('views', coalesce((data->>'views')::integer, 0) + 1, 'views_uniq', coalesce((data->>'views_uniq')::integer, 0) + %s) where id = %s",
-                uniq,
-                id,
-            )
+            form = copy.deepcopy(form)
+
+            mycid = form["cid"]
 
             company = db.companies.get(form["cid"])
             if company is None:
@@ -1838,7 +2122,7 @@ class ShowForm(object):
             if parentcompany is not None:
                 imagebucket = parentcompany.get("s3_imagebucket", imagebucket)
 
-            if "mobile" in req.get_header("User-Agent").lower():
+            if mobile:
                 form = cast(JsonObj, form["mobile"])
 
             formclose = True
@@ -1850,13 +2134,206 @@ class ShowForm(object):
             html, _ = generate_html(
                 db, form, id, imagebucket, True, True, True, formclose
             )
-            resp.content_type = falcon.MEDIA_HTML
-            resp.text = html
+            send_form_render(
+                req,
+                resp,
+                falcon.MEDIA_HTML,
+                *set_form_render("page", id, version, mobile, html),
+            )
 
 
 FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
 FORM_MULTIPART_TYPE = "multipart/form-data"
 
+# submissions are acknowledged once queued here and written in batches
+FORMS_PENDING_KEY = "forms-pending"
+FORMS_LOCK_KEY = "forms-pending-lock"
+FORM_SUBMIT_BATCH_SIZE = 500
+FORM_LOCK_SECS = 300
+# times a submission that fails to write is put back on the queue before it
+# is dropped
+FORM_SUBMIT_MAX_ATTEMPTS = 5
+
+
+def schedule_form_submits() -> None:
+    """Starts a task to write queued submissions unless one is already queued
+    or running."""
+    rdb = redis_connect()
+    if rdb.set(FORMS_LOCK_KEY, "1", nx=True, ex=FORM_LOCK_SECS):
+        run_task(process_form_submits)
+
+
+def requeue_form_submits(subs: List[JsonObj]) -> None:
+    """Puts submissions back at the end of the queue that pop_batch takes
+    from, dropping those that have failed FORM_SUBMIT_MAX_ATTEMPTS times."""
+    retry = []
+    for sub in subs:
+        sub["attempts"] = sub.get("attempts", 0) + 1
+        if sub["attempts"] >= FORM_SUBMIT_MAX_ATTEMPTS:
+            log.error("Dropping form submission %s after %s attempts", sub, sub["attempts"])
+        else:
+            retry.append(json.dumps(sub))
+    if retry:
+        redis_connect().rpush(FORMS_PENDING_KEY, *retry)
+
+
+def write_form_submits(db: DB, subs: List[JsonObj]) -> List[JsonObj]:
+    """Writes a batch of queued submissions in one transaction, returning
+    those that couldn't be added to their list so they can be retried. If
+    this raises nothing was written. Webhooks are only sent once the batch
+    has committed."""
+    counts: Dict[str, List[int]] = {}
+    events: Dict[str, List[JsonObj]] = {}
+    failed: List[JsonObj] = []
+
+    with db.transaction():
+        tags = sorted(set((sub["cid"], tag) for sub in subs for tag in sub["tags"]))
+        if tags:
+            db.execute(
+                """insert into alltags (cid, tag, added, count)
+                   select cid, tag, now(), 0 from unnest(%s::text[], %s::text[]) as t(cid, tag)
+                   on conflict (cid, tag) do nothing""",
+                [cid for cid, _ in tags],
+                [tag for _, tag in tags],
+            )
+
+        cookies = sorted(set((sub["form"], sub["uid"]) for sub in subs if sub["uid"]))
+        submitted: Set[Tuple[str, str]] = set()
+        if cookies:
+            submitted = set(
+                (formid, uid)
+                for formid, uid in db.execute(
+                    """select f.formid, f.uid from formcookies f
+                       join unnest(%s::text[], %s::text[]) as c(formid, uid)
+                       on f.formid = c.formid and f.uid = c.uid
+                       where f.submitted_at is not null""",
+                    [formid for formid, _ in cookies],
+                    [uid for _, uid in cookies],
+                )
+            )
+
+        written: Set[Tuple[str, str]] = set()
+        for sub in subs:
+            # a submission that fails is undone on its own and retried,
+            # leaving the rest of the batch to commit
+            webhooks: List[JsonObj] = []
+            db.execute("savepoint form_submit")
+            try:
+                contacts.feed(
+                    db,
+                    sub["list"],
+                    sub["data"],
+                    sub["tags"],
+                    sub["funnel"],
+                    webhooks=webhooks,
+                )
+            except Exception:
+                db.execute("rollback to savepoint form_submit")
+                log.exception("error writing form submission %s", sub)
+                failed.append(sub)
+                continue
+            db.execute("release savepoint form_submit")
+
+            # a submission is unique the first time a browser submits the
+            # form, including earlier in this batch
+            uniq = 1
+            if sub["uid"]:
+                key = (sub["form"], sub["uid"])
+                if key in submitted:
+                    uniq = 0
+                submitted.add(key)
+                written.add(key)
+
+            c = counts.setdefault(sub["form"], [0, 0])
+            c[0] += 1
+            c[1] += uniq
+
+            data = dict(sub["data"])
+            email = data.pop("Email")
+            evs = events.setdefault(sub["cid"], [])
+            evs.extend(webhooks)
+            evs.append(
+                {
+                    "type": "form_submit",
+                    "form": sub["form"],
+                    "email": email,
+                    "data": data,
+                    "timestamp": sub["ts"],
+                }
+            )
+
+        if written:
+            db.execute(
+                """update formcookies f set submitted_at = now(), viewed_at = null
+                   from unnest(%s::text[], %s::text[]) as c(formid, uid)
+                   where f.formid = c.formid and f.uid = c.uid""",
+                [formid for formid, _ in written],
+                [uid for _, uid in written],
+            )
+
+        for formid in sorted(counts):
+            submits, uniqs = counts[formid]
+            db.execute(
+                "update forms set data = data || jsonb_build_object('submits', coalesce((data->>'submits')::integer, 0) + %s, 'submits_uniq', coalesce((data->>'submits_uniq')::integer, 0) + %s) where id = %s",
+                submits,
+                uniqs,
+                formid,
+            )
+
+    # the batch is written, so a webhook that can't be queued is not a reason
+    # to write it again
+    for cid, evs in events.items():
+        try:
+            send_webhooks(db, cid, evs)
+        except Exception:
+            log.exception("error sending form submission webhooks for %s", cid)
+
+    return failed
+
+
+@tasks.task(priority=HIGH_PRIORITY)
+def process_form_submits() -> None:
+    rdb = redis_connect()
+
+    retry = False
+    try:
+        with open_db() as db:
+            while True:
+                items = pop_batch(rdb, FORMS_PENDING_KEY, FORM_SUBMIT_BATCH_SIZE)
+                if not items:
+                    break
+
+                subs = [json.loads(i) for i in items]
+                try:
+                    failed = write_form_submits(db, subs)
+                except:
+                    # nothing in the batch was written
+                    retry = True
+                    requeue_form_submits(subs)
+                    raise
+
+                rdb.expire(FORMS_LOCK_KEY, FORM_LOCK_SECS)
+
+                if failed:
+                    # retried by the next check rather than straight away
+                    retry = True
+                    requeue_form_submits(failed)
+                    break
+    except:
+        log.exception("error")
+    finally:
+        rdb.delete(FORMS_LOCK_KEY)
+
+    # pick up anything queued while the lock was held
+    if not retry and rdb.llen(FORMS_PENDING_KEY):
+        schedule_form_submits()
+
+
+def check_form_submits() -> None:
+    """Restarts writing for submissions left behind by a lost task."""
+    if redis_connect().llen(FORMS_PENDING_KEY):
+        schedule_form_submits()
+
 
 class PostForm(object):
 
@@ -1882,9 +2359,9 @@ class PostForm(object):
         resp.set_header("Access-Control-Max-Age", 86400)
 
         with open_db() as db:
-            form = db.forms.get(id)
+            form, _ = get_live_form(db, id)
 
-            if form is None or form.get("disabled"):
+            if form is None:
                 raise falcon.HTTPBadRequest(
                     title="Form not found", description="This form does not exist"
                 )
@@ -1963,60 +2440,27 @@ class PostForm(object):
                     title="Data too large", description="Maximum data size is 64KB"
                 )
 
-            l = db.lists.get(form["list"])
-            if l is None:
+            if not form["list_exists"]:
                 raise falcon.HTTPBadRequest(
                     title="Missing contact list", description="Contact list not found"
                 )
 
-            for tag in taglist:
-                db.execute(
-                    """insert into alltags (cid, tag, added, count) values (%s, %s, now(), 0)
-                            on conflict (cid, tag) do nothing""",
-                    form["cid"],
-                    tag,
-                )
-
-            contacts.feed(db, l["id"], doc["data"], doc["tags"], doc["funnel"])
-
-            formuid = req.cookies.get("edfu")
-            uniq = 0
-            if formuid:
-                lastsubmit = db.single(
-                    "select submitted_at from formcookies where formid = %s and uid = %s",
-                    id,
-                    formuid,
-                )
-                if lastsubmit is None:
-                    uniq = 1
-                db.execute(
-                    "update formcookies set submitted_at = now(), viewed_at = null where formid = %s and uid = %s",
-                    id,
-                    formuid,
-                )
-            else:
-                uniq = 1
-
-            db.execute(
-                "update forms set data = data || jsonb_build_object('submits', coalesce((data->>'submits')::integer, 0) + 1, 'submits_uniq', coalesce((data->>'submits_uniq')::integer, 0) + %s) where id = %s",
-                uniq,
-                id,
-            )
-
-            doc["data"].pop("Email")
-            send_webhooks(
-                db,
-                form["cid"],
-                [
+            redis_connect().lpush(
+                FORMS_PENDING_KEY,
+                json.dumps(
                     {
-                        "type": "form_submit",
                         "form": id,
-                        "email": email,
+                        "cid": form["cid"],
+                        "list": form["list"],
+                        "funnel": doc["funnel"],
                         "data": doc["data"],
-                        "timestamp": datetime.utcnow().isoformat() + "Z",
+                        "tags": doc["tags"],
+                        "uid": req.cookies.get("edfu"),
+                        "ts": datetime.utcnow().isoformat() + "Z",
                     }
-                ],
+                ),
             )
+            schedule_form_submits()
 
             if req.path.endswith(".json"):
                 if form["submitaction"] == "msg":
@@ -216,12 +216,49 @@ def refresh_bucket_active(
                         for a, c in active.items():
                             counts[listid][a] = counts[listid].get(a, 0) + c
 
-                for listid, patch in counts.items():
-                    db.lists.patch(listid, patch)
+                # wait for a running rollup and hold the lock until the
+                # recount is written, so that the pending deltas are folded in
+                # and then replaced by the recount rather than applied again
+                # on top of it, and the check sees the counters with them
+                with db.transaction():
+                    db.execute(
+                        f"select pg_advisory_xact_lock({contacts.LIST_ROLLUP_LOCK})"
+                    )
+                    while (
+                        contacts.apply_list_deltas(db)
+                        == contacts.LIST_ROLLUP_BATCH_SIZE
+                    ):
+                        pass
+                    check_list_counts(db, counts)
+
+                    for listid, patch in counts.items():
+                        db.lists.patch(listid, patch)
         except:
             log.exception("error")
 
 
+# counters kept by contact events; the active counts also move with time so
+# they aren't compared
+RECONCILED_COUNTS = ("bounced", "unsubscribed", "complained", "soft_bounced")
+
+
+def check_list_counts(db: DB, counts: Dict[str, Dict[str, int]]) -> None:
+    """Logs lists whose counters differ from a full recount. Pending
+    list_deltas must have been folded into the counters first, or they show
+    up as drift."""
+    for listid, recount in counts.items():
+        l = db.lists.get(listid)
+        if l is None:
+            continue
+        drift = {
+            k: recount.get(k, 0) - (l.get(k) or 0)
+            for k in RECONCILED_COUNTS
+            if recount.get(k, 0) != (l.get(k) or 0)
+        }
+        if drift:
+            log.info("List %s counters differ from recount by %s", listid, drift)
+
+
 def get_contact_data(db: DB, cid: str, email: str) -> JsonObj:
     alldata = db.single(
         f"""
@@ -1332,6 +1369,34 @@ def find_segment(id: str, doc: JsonObj) -> JsonObj:
     }
 
 
+def find_search_text(segment: JsonObj) -> str | None:
+    """Returns the text of a contact search that every match of a find_segment
+    must contain, so that the rows can be narrowed with the trigram indexes
+    before the segment is evaluated. Only plain ASCII text of three or more
+    characters qualifies, since it lowercases the same way in Python and SQL,
+    is stored unescaped in props::text and is long enough to use the index."""
+    group = segment["parts"][1]
+    if group["operator"] != "and":
+        return None
+    for part in group["parts"]:
+        if (
+            part.get("type") == "Info"
+            and not part.get("test")
+            and part.get("prop") == "!!*"
+            and part.get("operator") == "contains"
+        ):
+            text: str = part.get("value", "").strip().lower()
+            if (
+                len(text) >= 3
+                and text.isascii()
+                and text.isprintable()
+                and '"' not in text
+                and "\\" not in text
+            ):
+                return text
+    return None
+
+
 class ListFind(object):
 
     def on_post(self, req: falcon.Request, resp: falcon.Response, id: str) -> None:
@@ -1450,7 +1515,9 @@ def do_list_find(
 
     sentrows = get_segment_sentrows(db, cid, campaignids, hashval, hashlimit)
 
-    rows = get_segment_rows(db, cid, hashval, listfactors, hashlimit)
+    rows = get_segment_rows(
+        db, cid, hashval, listfactors, hashlimit, search=find_search_text(segment)
+    )
 
     def fix_row(r: JsonObj) -> JsonObj:
         fixedrow = {}
@@ -2313,22 +2380,14 @@ class Segments(CRUDCollection):
 
     def __init__(self) -> None:
         self.domain = "segments"
+        self.large = "parts"
         self.useronly = True
         # self.schema = SEGMENT_SCHEMA
 
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
         check_noadmin(req, True)
 
-        db = req.context["db"]
-
-        req.context["result"] = list(
-            json_iter(
-                db.execute(
-                    "select id, cid, data - 'parts' from segments where cid = %s",
-                    db.get_cid(),
-                )
-            )
-        )
+        self.get_result(req)
 
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
         ts = datetime.utcnow().isoformat() + "Z"
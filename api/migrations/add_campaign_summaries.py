@@ -0,0 +1,147 @@
+from datetime import datetime
+
+from api.shared import partitions
+
+
+def run(db):
+    db.execute(
+        """
+        create table campstats_hourly (
+            cid text not null,
+            campcid text not null,
+            campid text not null,
+            ts timestamp without time zone not null,
+            open integer not null default 0,
+            send integer not null default 0,
+            delivered_rows integer not null default 0,
+            delivered_open integer not null default 0,
+            delivered_complaint integer not null default 0,
+            delivered_send integer not null default 0,
+            delivered_hard integer not null default 0,
+            delivered_soft integer not null default 0,
+            primary key (cid, ts, campid, campcid)
+        ) partition by range (ts);
+        create index campstats_hourly_campcid_idx on campstats_hourly (campcid, ts);
+
+        create table campstats_daily (like campstats_hourly including defaults) partition by range (ts);
+        alter table campstats_daily add primary key (cid, ts, campid, campcid);
+        create index campstats_daily_campcid_idx on campstats_daily (campcid, ts);
+
+        create function campstats_rollup() returns trigger language plpgsql as $$
+        declare
+            s campstats_hourly%%rowtype;
+        begin
+            s.open := 0;
+            s.send := 0;
+            s.delivered_rows := 0;
+            s.delivered_open := 0;
+            s.delivered_complaint := 0;
+            s.delivered_send := 0;
+            s.delivered_hard := 0;
+            s.delivered_soft := 0;
+
+            -- hourstats updates only change the counters, so old and new
+            -- rows always belong to the same summary row
+            if tg_op <> 'DELETE' then
+                s.cid := new.cid;
+                s.campcid := new.campcid;
+                s.campid := new.campid;
+                s.ts := new.ts;
+                s.open := new.open;
+                s.send := new.send;
+                if new.send + new.soft + new.hard + new.defercnt > 0 then
+                    s.delivered_rows := 1;
+                    s.delivered_open := new.open;
+                    s.delivered_complaint := new.complaint;
+                    s.delivered_send := new.send;
+                    s.delivered_hard := new.hard;
+                    s.delivered_soft := new.soft;
+                end if;
+            end if;
+            if tg_op <> 'INSERT' then
+                s.cid := old.cid;
+                s.campcid := old.campcid;
+                s.campid := old.campid;
+                s.ts := old.ts;
+                s.open := s.open - old.open;
+                s.send := s.send - old.send;
+                if old.send + old.soft + old.hard + old.defercnt > 0 then
+                    s.delivered_rows := s.delivered_rows - 1;
+                    s.delivered_open := s.delivered_open - old.open;
+                    s.delivered_complaint := s.delivered_complaint - old.complaint;
+                    s.delivered_send := s.delivered_send - old.send;
+                    s.delivered_hard := s.delivered_hard - old.hard;
+                    s.delivered_soft := s.delivered_soft - old.soft;
+                end if;
+            end if;
+
+            if s.open = 0 and s.send = 0 and s.delivered_rows = 0 and s.delivered_open = 0
+               and s.delivered_complaint = 0 and s.delivered_send = 0 and s.delivered_hard = 0
+               and s.delivered_soft = 0 then
+                return null;
+            end if;
+
+            insert into campstats_hourly values (s.*)
+            on conflict (cid, ts, campid, campcid) do update set
+            open =                campstats_hourly.open                + excluded.open,
+            send =                campstats_hourly.send                + excluded.send,
+            delivered_rows =      campstats_hourly.delivered_rows      + excluded.delivered_rows,
+            delivered_open =      campstats_hourly.delivered_open      + excluded.delivered_open,
+            delivered_complaint = campstats_hourly.delivered_complaint + excluded.delivered_complaint,
+            delivered_send =      campstats_hourly.delivered_send      + excluded.delivered_send,
+            delivered_hard =      campstats_hourly.delivered_hard      + excluded.delivered_hard,
+            delivered_soft =      campstats_hourly.delivered_soft      + excluded.delivered_soft;
+
+            s.ts := date_trunc('day', s.ts);
+            insert into campstats_daily values (s.*)
+            on conflict (cid, ts, campid, campcid) do update set
+            open =                campstats_daily.open                + excluded.open,
+            send =                campstats_daily.send                + excluded.send,
+            delivered_rows =      campstats_daily.delivered_rows      + excluded.delivered_rows,
+            delivered_open =      campstats_daily.delivered_open      + excluded.delivered_open,
+            delivered_complaint = campstats_daily.delivered_complaint + excluded.delivered_complaint,
+            delivered_send =      campstats_daily.delivered_send      + excluded.delivered_send,
+            delivered_hard =      campstats_daily.delivered_hard      + excluded.delivered_hard,
+            delivered_soft =      campstats_daily.delivered_soft      + excluded.delivered_soft;
+
+            return null;
+        end;
+        $$;
+    """
+    )
+
+    # take the trigger's lock before backfilling so no stats written in
+    # between are missed or counted twice
+    db.execute(
+        """
+        create trigger hourstats_campstats after insert or update or delete on hourstats
+            for each row execute function campstats_rollup();
+    """
+    )
+
+    since = db.single("select min(ts) from hourstats") or datetime.utcnow()
+    for table in ("campstats_hourly", "campstats_daily"):
+        partitions.create_partitions_since(db, table, since)
+
+    db.execute(
+        """
+        insert into campstats_hourly (cid, campcid, campid, ts, open, send, delivered_rows, delivered_open,
+                                      delivered_complaint, delivered_send, delivered_hard, delivered_soft)
+        select cid, campcid, campid, ts, sum(open), sum(send),
+               count(*) filter (where send + soft + hard + defercnt > 0),
+               coalesce(sum(open) filter (where send + soft + hard + defercnt > 0), 0),
+               coalesce(sum(complaint) filter (where send + soft + hard + defercnt > 0), 0),
+               coalesce(sum(send) filter (where send + soft + hard + defercnt > 0), 0),
+               coalesce(sum(hard) filter (where send + soft + hard + defercnt > 0), 0),
+               coalesce(sum(soft) filter (where send + soft + hard + defercnt > 0), 0)
+        from hourstats
+        group by cid, campcid, campid, ts;
+
+        insert into campstats_daily (cid, campcid, campid, ts, open, send, delivered_rows, delivered_open,
+                                     delivered_complaint, delivered_send, delivered_hard, delivered_soft)
+        select cid, campcid, campid, date_trunc('day', ts) as dayts, sum(open), sum(send), sum(delivered_rows),
+               sum(delivered_open), sum(delivered_complaint), sum(delivered_send), sum(delivered_hard), sum(delivered_soft)
+        from campstats_hourly
+        group by cid, campcid, campid, dayts;
+    """
+    )
@@ -0,0 +1,31 @@
+from api.shared.log import get_logger
+
+log = get_logger()
+
+# customer collections that can be read a page at a time in id order
+COLLECTION_TABLES = (
+    "messages",
+    "forms",
+    "txntemplates",
+    "segments",
+    "lists",
+    "supplists",
+    "exports",
+    "savedrows",
+    "funnels",
+    "domainthrottles",
+)
+
+
+def run_online(db):
+    for table in COLLECTION_TABLES:
+        name = "%s_cid_id_idx" % table
+        if db.single(
+            "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+            name,
+        ):
+            db.execute(f"drop index concurrently {name}")
+        db.execute(
+            f"create index concurrently if not exists {name} on {table} (cid, id)"
+        )
+        log.info("    indexed %s", table)
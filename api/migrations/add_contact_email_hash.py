@@ -0,0 +1,22 @@
+from api.shared import contacts
+from api.shared.log import get_logger
+
+log = get_logger()
+
+
+def tenants(db):
+    return [cid for cid, in db.execute("select cid from contacts.contacts_hashlimit")]
+
+
+def run(db):
+    contacts.create_djb2_function(db)
+
+    for cid in tenants(db):
+        contacts.create_email_hash_column(db, cid)
+
+
+def run_online(db):
+    for cid in tenants(db):
+        count = contacts.backfill_email_hash(db, cid)
+        contacts.index_email_hash(db, cid)
+        log.info("    hashed %s contacts of %s", count, cid)
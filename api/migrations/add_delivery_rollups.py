@@ -0,0 +1,150 @@
+from datetime import datetime
+
+from api.shared import partitions
+
+
+def run(db):
+    db.execute(
+        """
+        create table deliverystats_hourly (
+            cid text not null,
+            ts timestamp without time zone not null,
+            sinkid text not null,
+            domaingroupid text not null,
+            ip text not null,
+            settingsid text not null,
+            complaint integer not null default 0,
+            open integer not null default 0,
+            send integer not null default 0,
+            soft integer not null default 0,
+            hard integer not null default 0,
+            err integer not null default 0,
+            defercnt integer not null default 0,
+            click integer not null default 0,
+            unsub integer not null default 0,
+            primary key (cid, ts, sinkid, domaingroupid, ip, settingsid)
+        ) partition by range (ts);
+
+        create table deliverystats_daily (like deliverystats_hourly including defaults) partition by range (ts);
+        alter table deliverystats_daily add primary key (cid, ts, sinkid, domaingroupid, ip, settingsid);
+
+        create table deliverymsgs_hourly (
+            cid text not null,
+            ts timestamp without time zone not null,
+            sinkid text not null,
+            domaingroupid text not null,
+            ip text not null,
+            settingsid text not null,
+            message text not null,
+            msgtype text not null,
+            count integer not null default 0,
+            primary key (sinkid, domaingroupid, ip, settingsid, msgtype, ts, message)
+        ) partition by range (ts);
+
+        create function deliverystats_rollup() returns trigger language plpgsql as $$
+        declare
+            d hourstats%%rowtype;
+        begin
+            d := new;
+            if tg_op = 'UPDATE' then
+                d.complaint := new.complaint - old.complaint;
+                d.open := new.open - old.open;
+                d.send := new.send - old.send;
+                d.soft := new.soft - old.soft;
+                d.hard := new.hard - old.hard;
+                d.err := new.err - old.err;
+                d.defercnt := new.defercnt - old.defercnt;
+                d.click := new.click - old.click;
+                d.unsub := new.unsub - old.unsub;
+            end if;
+
+            insert into deliverystats_hourly (cid, ts, sinkid, domaingroupid, ip, settingsid,
+                                              complaint, open, send, soft, hard, err, defercnt, click, unsub)
+            values (d.cid, d.ts, d.sinkid, d.domaingroupid, d.ip, d.settingsid,
+                    d.complaint, d.open, d.send, d.soft, d.hard, d.err, d.defercnt, d.click, d.unsub)
+            on conflict (cid, ts, sinkid, domaingroupid, ip, settingsid) do update set
+            complaint = deliverystats_hourly.complaint + excluded.complaint,
+            open =      deliverystats_hourly.open      + excluded.open,
+            send =      deliverystats_hourly.send      + excluded.send,
+            soft =      deliverystats_hourly.soft      + excluded.soft,
+            hard =      deliverystats_hourly.hard      + excluded.hard,
+            err =       deliverystats_hourly.err       + excluded.err,
+            defercnt =  deliverystats_hourly.defercnt  + excluded.defercnt,
+            click =     deliverystats_hourly.click     + excluded.click,
+            unsub =     deliverystats_hourly.unsub     + excluded.unsub;
+
+            insert into deliverystats_daily (cid, ts, sinkid, domaingroupid, ip, settingsid,
+                                             complaint, open, send, soft, hard, err, defercnt, click, unsub)
+            values (d.cid, date_trunc('day', d.ts), d.sinkid, d.domaingroupid, d.ip, d.settingsid,
+                    d.complaint, d.open, d.send, d.soft, d.hard, d.err, d.defercnt, d.click, d.unsub)
+            on conflict (cid, ts, sinkid, domaingroupid, ip, settingsid) do update set
+            complaint = deliverystats_daily.complaint + excluded.complaint,
+            open =      deliverystats_daily.open      + excluded.open,
+            send =      deliverystats_daily.send      + excluded.send,
+            soft =      deliverystats_daily.soft      + excluded.soft,
+            hard =      deliverystats_daily.hard      + excluded.hard,
+            err =       deliverystats_daily.err       + excluded.err,
+            defercnt =  deliverystats_daily.defercnt  + excluded.defercnt,
+            click =     deliverystats_daily.click     + excluded.click,
+            unsub =     deliverystats_daily.unsub     + excluded.unsub;
+
+            return null;
+        end;
+        $$;
+
+        create function deliverymsgs_rollup() returns trigger language plpgsql as $$
+        begin
+            insert into deliverymsgs_hourly (cid, ts, sinkid, domaingroupid, ip, settingsid, message, msgtype, count)
+            values (new.cid, new.ts, new.sinkid, new.domaingroupid, new.ip, new.settingsid, new.message, new.msgtype,
+                    case when tg_op = 'UPDATE' then new.count - old.count else new.count end)
+            on conflict (sinkid, domaingroupid, ip, settingsid, msgtype, ts, message) do update set
+            count = deliverymsgs_hourly.count + excluded.count;
+
+            return null;
+        end;
+        $$;
+    """
+    )
+
+    # take the triggers' locks before backfilling so no stats written in
+    # between are missed or counted twice
+    db.execute(
+        """
+        create trigger hourstats_rollup after insert or update on hourstats
+            for each row execute function deliverystats_rollup();
+        create trigger statmsgs_rollup after insert or update on statmsgs
+            for each row execute function deliverymsgs_rollup();
+    """
+    )
+
+    since = (
+        db.single(
+            "select least((select min(ts) from hourstats), (select min(ts) from statmsgs))"
+        )
+        or datetime.utcnow()
+    )
+    for table in ("deliverystats_hourly", "deliverystats_daily", "deliverymsgs_hourly"):
+        partitions.create_partitions_since(db, table, since)
+
+    db.execute(
+        """
+        insert into deliverystats_hourly (cid, ts, sinkid, domaingroupid, ip, settingsid,
+                                          complaint, open, send, soft, hard, err, defercnt, click, unsub)
+        select cid, ts, sinkid, domaingroupid, ip, settingsid,
+               sum(complaint), sum(open), sum(send), sum(soft), sum(hard), sum(err), sum(defercnt), sum(click), sum(unsub)
+        from hourstats
+        group by cid, ts, sinkid, domaingroupid, ip, settingsid;
+
+        insert into deliverystats_daily (cid, ts, sinkid, domaingroupid, ip, settingsid,
+                                         complaint, open, send, soft, hard, err, defercnt, click, unsub)
+        select cid, date_trunc('day', ts) as dayts, sinkid, domaingroupid, ip, settingsid,
+               sum(complaint), sum(open), sum(send), sum(soft), sum(hard), sum(err), sum(defercnt), sum(click), sum(unsub)
+        from deliverystats_hourly
+        group by cid, dayts, sinkid, domaingroupid, ip, settingsid;
+
+        insert into deliverymsgs_hourly (cid, ts, sinkid, domaingroupid, ip, settingsid, message, msgtype, count)
+        select min(cid), ts, sinkid, domaingroupid, ip, settingsid, message, msgtype, sum(count)
+        from statmsgs
+        group by ts, sinkid, domaingroupid, ip, settingsid, message, msgtype;
+    """
+    )
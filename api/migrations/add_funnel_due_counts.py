@@ -0,0 +1,27 @@
+def run(db):
+    db.execute(
+        """
+        alter table funnelqueue add column due boolean not null default false;
+
+        create table funneldue (
+            cid text not null,
+            messageid text not null,
+            domain text not null,
+            bucket integer not null,
+            count bigint not null,
+            primary key (cid, messageid, domain, bucket)
+        );
+        """
+    )
+
+
+def run_online(db):
+    if db.single(
+        "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+        "funnelqueue_undue_idx",
+    ):
+        db.execute("drop index concurrently funnelqueue_undue_idx")
+    db.execute(
+        """create index concurrently if not exists funnelqueue_undue_idx on funnelqueue (ts)
+        where not sent and not due and domain is not null"""
+    )
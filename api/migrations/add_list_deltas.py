@@ -0,0 +1,18 @@
+def run(db):
+    db.execute(
+        """
+        create table list_deltas (
+            id bigserial primary key,
+            list_id text not null,
+            property text not null,
+            active30 integer not null default 0,
+            active60 integer not null default 0,
+            active90 integer not null default 0,
+            bounced integer not null default 0,
+            complained integer not null default 0,
+            unsubscribed integer not null default 0,
+            soft_bounced integer not null default 0,
+            ts timestamp with time zone not null default now()
+        );
+        """
+    )
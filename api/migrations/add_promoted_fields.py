@@ -0,0 +1,21 @@
+from api.shared.db import (
+    PROMOTED_FIELDS,
+    create_promoted_columns,
+    backfill_promoted_columns,
+    index_promoted_columns,
+)
+from api.shared.log import get_logger
+
+log = get_logger()
+
+
+def run(db):
+    for table in PROMOTED_FIELDS:
+        create_promoted_columns(db, table)
+
+
+def run_online(db):
+    for table in PROMOTED_FIELDS:
+        count = backfill_promoted_columns(db, table)
+        log.info("    backfilled %s rows of %s", count, table)
+        index_promoted_columns(db, table)
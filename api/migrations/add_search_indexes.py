@@ -0,0 +1,29 @@
+from api.shared import contacts
+from api.shared.log import get_logger
+
+log = get_logger()
+
+# campaign fields matched by a campaign search
+CAMPAIGN_SEARCH_FIELDS = ("name", "subject", "fromname")
+
+
+def run(db):
+    db.execute("create extension if not exists pg_trgm")
+
+
+def run_online(db):
+    for field in CAMPAIGN_SEARCH_FIELDS:
+        name = "campaigns_%s_search_idx" % field
+        if db.single(
+            "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+            name,
+        ):
+            db.execute(f"drop index concurrently {name}")
+        db.execute(
+            f"create index concurrently if not exists {name} on campaigns using gin (lower(data->>'{field}') gin_trgm_ops)"
+        )
+
+    cids = [cid for cid, in db.execute("select cid from contacts.contacts_hashlimit")]
+    for cid in cids:
+        contacts.create_search_indexes(db, cid, concurrently=True)
+        log.info("    indexed %s", cid)
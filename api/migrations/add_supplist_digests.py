@@ -0,0 +1,9 @@
+from api.shared import contacts
+
+
+def run(db):
+    contacts.create_suppdigest_functions(db)
+
+    cids = [cid for cid, in db.execute("select cid from contacts.contacts_hashlimit")]
+    for cid in cids:
+        contacts.create_suppdigests(db, cid)
@@ -0,0 +1,28 @@
+from api.shared import partitions
+
+
+TABLES = (
+    "statlogs2",
+    "hourstats",
+    "statmsgs",
+    "txnstats",
+    "txnstatmsgs",
+    "txnsends",
+    "sesmessages",
+    "eltracking",
+    "smtptracking",
+)
+
+
+def run(db):
+    for table in TABLES:
+        partitions.convert_to_partitioned(db, table)
+
+    db.execute(
+        """
+        create index if not exists camplogs_ts_brin_idx on camplogs using brin (ts);
+        create index if not exists txnlogs_ts_brin_idx on txnlogs using brin (ts);
+        create index if not exists sptracking_ts_brin_idx on sptracking using brin (ts);
+        create index if not exists mgtracking_ts_brin_idx on mgtracking using brin (ts);
+    """
+    )
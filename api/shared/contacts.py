@@ -1,6 +1,8 @@
 import os
 import re
 import csv
+import zlib
+import codecs
 import shortuuid
 import requests
 import msgpack
@@ -15,9 +17,11 @@ from .utils import (
     fix_tag,
     get_funnels,
     insert_funnel,
-    insert_funnel_tag,
+    insert_funnel_bulk,
     incr_funnel_counts,
     run_task,
+    run_task_delay,
+    redis_connect,
     gather_init,
     gather_complete,
     emailre,
@@ -28,7 +32,7 @@ from .utils import (
     SECS_IN_DAY,
     get_txn,
 )
-from .s3 import s3_delete, s3_read_stream, s3_open_write
+from .s3 import s3_delete, s3_list, s3_read_range, s3_read_stream, s3_open_write
 from .db import open_db, json_obj, JsonObj, DB
 from .tasks import tasks, HIGH_PRIORITY, LOW_PRIORITY
 from .segments import (
@@ -49,6 +53,18 @@ WRITE_BLOCK_SIZE = 32 * 1024
 HASH_BLOCK_SIZE = 1024 * 1024
 # Max hash buckets to prevent runaway rehashing/task fan-out. Can be overridden via env.
 HASHLIMIT_CAP = int(os.environ.get("hashlimit_max", "128"))
+# contacts whose send logs are applied in one transaction
+SEND_LOG_BATCH_SIZE = 10000
+
+# delay before pending list_deltas are rolled up into the lists, which bounds
+# how stale list counters are
+LIST_ROLLUP_DELAY = 2
+LIST_ROLLUP_LOCK_SECS = 60
+LIST_ROLLUP_BATCH_SIZE = 10000
+LIST_ROLLUP_KEY = "list-deltas-rollup"
+LIST_ROLLUP_LOCK = 73820946
+# contacts whose email_hash is filled in per statement by backfill_email_hash
+EMAIL_HASH_BACKFILL_BATCH = 5000
 
 
 def load_campaign_or_message(db: DB, campid: str) -> Tuple[JsonObj | None, bool]:
@@ -112,7 +128,7 @@ def add_send(db: DB, campid: str, emails: List[str], txntag: str | None = None)
             if funnel is not None:
                 msgvals = {}
                 for mid, who, days, dayoffset in db.execute(
-                    "select id, data->>'who', data->'days', data->'dayoffset' from messages where data->>'funnel' = %s",
+                    "select id, data->>'who', data->'days', data->'dayoffset' from messages where data_funnel = %s",
                     funnel["id"],
                 ):
                     msgvals[mid] = (who or "all", days, dayoffset or 0)
@@ -130,71 +146,127 @@ def add_send(db: DB, campid: str, emails: List[str], txntag: str | None = None)
                     if i == 0:
                         m["who"] = "all"
 
-        contactids = list(
+        # the next message a contact moves on to once this one is sent
+        nextindex = None
+        if funnel is not None and funnel.get("active") and len(funnel["messages"]) > 0:
+            currindex = -1
+            for m in funnel["messages"]:
+                currindex += 1
+                if m["id"] == campid:
+                    break
+            while currindex >= 0 and currindex < len(funnel["messages"]) - 1:
+                if funnel["messages"][currindex + 1].get("unpublished"):
+                    currindex += 1
+                    continue
+                if funnel["messages"][currindex + 1]["who"] in (
+                    "all",
+                    "openany",
+                    "clickany",
+                ):
+                    nextindex = currindex + 1
+                break
+
+        # tags in a fixed order, so that concurrent senders lock the tag rows
+        # of a contact in the same order
+        taglist = sorted(
+            set([fix_tag(tag) for tag in camp.get("sendaddtags", ()) if fix_tag(tag)])
+        )
+        taglist.extend(
+            sorted(
+                set(
+                    [
+                        "-" + fix_tag(tag)
+                        for tag in camp.get("sendremtags", ())
+                        if fix_tag(tag)
+                    ]
+                )
+            )
+        )
+
+        # walk the contacts in hash bucket order, which is how the contact
+        # tables are clustered
+        hashlimit = get_hashlimit(db, cid)
+        contactids = sorted(
             db.execute(
                 f"""select email, contact_id from contacts."contacts_{cid}" where email = any(%s)""",
                 emails,
-            )
+            ),
+            key=lambda r: (r[1] % hashlimit, r[1]),
         )
 
-        for email, contact_id in contactids:
-            inserted = db.execute(
-                f"""
-                insert into contacts."contact_send_logs_{cid}" (contact_id, campid) values (%s, %s) on conflict (contact_id, campid) do nothing returning contact_id
-            """,
-                contact_id,
-                camp["id"],
-            )
+        def write_batch(
+            batch: List[Tuple[str, int]],
+        ) -> Tuple[List[JsonObj], Dict[str, int], Dict[str, int]]:
+            msgs: List[JsonObj] = []
+            tagcounts: Dict[str, int] = {}
+            funnelcounts: Dict[str, int] = {}
+
+            # only contacts whose send log is new in this transaction move
+            # on, so a retried send log file changes nothing that an earlier
+            # attempt already committed
+            with db.transaction():
+                inserted = set(
+                    r[0]
+                    for r in db.execute(
+                        f"""
+                    insert into contacts."contact_send_logs_{cid}" (contact_id, campid)
+                    select unnest(%s::integer[]), %s
+                    on conflict (contact_id, campid) do nothing returning contact_id
+                """,
+                        [contact_id for _, contact_id in batch],
+                        camp["id"],
+                    )
+                )
+                sent = [
+                    (email, contact_id)
+                    for email, contact_id in batch
+                    if contact_id in inserted
+                ]
 
-            if inserted:
-                msg: JsonObj = {
-                    "type": "send",
-                    "source": {},
-                    "email": email,
-                    "timestamp": ts,
-                }
-                if is_msg:
-                    msg["source"]["funnelmsg"] = campid
-                else:
-                    msg["source"]["broadcast"] = campid
-                webhook_msgs.append(msg)
-
-            if (
-                inserted
-                and funnel is not None
-                and funnel.get("active")
-                and len(funnel["messages"]) > 0
-            ):
-                currindex = -1
-                for m in funnel["messages"]:
-                    currindex += 1
-                    if m["id"] == campid:
-                        break
-                while currindex >= 0 and currindex < len(funnel["messages"]) - 1:
-                    if funnel["messages"][currindex + 1].get("unpublished"):
-                        currindex += 1
-                        continue
-                    msg = funnel["messages"][currindex + 1]
-                    if msg["who"] in ("all", "openany", "clickany"):
-                        insert_funnel(
-                            db, funnel["cid"], email, funnel, currindex + 1, None
-                        )
-                    break
+                for email, _ in sent:
+                    msg: JsonObj = {
+                        "type": "send",
+                        "source": {},
+                        "email": email,
+                        "timestamp": ts,
+                    }
+                    if is_msg:
+                        msg["source"]["funnelmsg"] = campid
+                    else:
+                        msg["source"]["broadcast"] = campid
+                    msgs.append(msg)
 
-        taglist = list(
-            set([fix_tag(tag) for tag in camp.get("sendaddtags", ()) if fix_tag(tag)])
-        )
-        taglist.extend(
-            set(
-                [
-                    "-" + fix_tag(tag)
-                    for tag in camp.get("sendremtags", ())
-                    if fix_tag(tag)
-                ]
+                if nextindex is not None:
+                    assert funnel is not None
+                    insert_funnel_bulk(db, funnel["cid"], sent, funnel, nextindex, None)
+
+                if len(taglist) and len(sent):
+                    update_tags(
+                        db,
+                        cid,
+                        [],
+                        taglist,
+                        msgs,
+                        sent,
+                        tagcounts=tagcounts,
+                        funnelcounts=funnelcounts,
+                    )
+            return msgs, tagcounts, funnelcounts
+
+        for i in range(0, len(contactids), SEND_LOG_BATCH_SIZE):
+            # a batch that loses a deadlock is rolled back whole and retried,
+            # rather than dropping its send logs, since this runs after the
+            # messages have gone out and nothing else would write them
+            msgs, tagcounts, funnelcounts = retry_deadlock(
+                "add_send", write_batch, contactids[i : i + SEND_LOG_BATCH_SIZE]
             )
-        )
 
-        update_tags(db, cid, emails, taglist, webhook_msgs, contactids)
+            # the shared counter rows are updated after the batch commits, so
+            # they are only locked for a moment instead of for the whole batch
+            apply_tag_counts(db, cid, tagcounts, funnelcounts)
+
+            if len(msgs):
+                send_webhooks(db, cid, msgs)
 
     if len(webhook_msgs):
         send_webhooks(db, cid, webhook_msgs)
@@ -208,7 +280,20 @@ def update_tags(
     webhook_msgs: List[JsonObj],
     email_contact_ids: List[Tuple[str, int]] | None = None,
     funnel: str | None = None,
+    tagcounts: Dict[str, int] | None = None,
+    funnelcounts: Dict[str, int] | None = None,
 ) -> None:
+    """Adds and removes tags (those starting with "-") for the contacts and
+    enrols them in the tag and response funnels. The changes to the tag and
+    funnel counts are applied before returning, unless tagcounts and
+    funnelcounts are passed in, in which case they are added to those for the
+    caller to apply with apply_tag_counts."""
+    apply_counts = tagcounts is None or funnelcounts is None
+    if tagcounts is None:
+        tagcounts = {}
+    if funnelcounts is None:
+        funnelcounts = {}
+
     if email_contact_ids is None:
         email_contact_ids = list(
             db.execute(
@@ -227,107 +312,98 @@ def update_tags(
 
     tagfunnels = None
     respfunnels = None
-    funnelcounts: Dict[str, int] = {}
-    tagcounts: Dict[str, int] = {}
     if len(add_tags) or funnel is not None:
         tagfunnels, respfunnels = get_funnels(db, cid)
 
-    for email, contact_id in email_contact_ids:
-        for tag in add_tags:
-            assert tagfunnels is not None
-            add_tag(
-                db,
-                cid,
-                email,
-                contact_id,
-                tag,
-                tagfunnels,
-                funnelcounts,
-                tagcounts,
-                webhook_msgs,
-            )
+    if not len(email_contact_ids):
+        return
 
-        for tag in remove_tags:
-            remove_tag(db, cid, email, contact_id, tag, tagcounts, webhook_msgs)
+    contact_ids = [contact_id for _, contact_id in email_contact_ids]
+    contact_emails = dict(
+        (contact_id, email) for email, contact_id in email_contact_ids
+    )
 
-        if funnel is not None:
-            assert respfunnels is not None
-            fun = respfunnels.get(funnel, None)
-            if fun is not None:
-                insert_funnel(db, cid, email, fun, 0, funnelcounts)
+    for tag in add_tags:
+        assert tagfunnels is not None
+        added = [
+            (contact_emails[r[0]], r[0])
+            for r in db.execute(
+                f"""insert into contacts."contact_values_{cid}" (contact_id, type, value)
+                    select unnest(%s::integer[]), 'tag', %s
+                    on conflict (contact_id, type, value) do nothing returning contact_id""",
+                contact_ids,
+                tag,
+            )
+        ]
+        if not len(added):
+            continue
 
-    incr_funnel_counts(db, funnelcounts)
+        tagcounts[tag] = tagcounts.get(tag, 0) + len(added)
 
-    for tagname, cnt in tagcounts.items():
-        db.execute(
-            "update alltags set count = count + %s where cid = %s and tag = %s",
-            cnt,
-            cid,
-            tagname,
-        )
+        ts = datetime.utcnow().isoformat() + "Z"
+        for email, _ in added:
+            webhook_msgs.append(
+                {
+                    "type": "tag_add",
+                    "tag": tag,
+                    "email": email,
+                    "timestamp": ts,
+                }
+            )
 
+        for tagfunnel in tagfunnels.get(tag, ()):
+            insert_funnel_bulk(db, cid, added, tagfunnel, 0, funnelcounts)
+
+    for tag in remove_tags:
+        removed = [
+            contact_emails[r[0]]
+            for r in db.execute(
+                f"""delete from contacts."contact_values_{cid}"
+                    where contact_id = any(%s::integer[]) and type = 'tag' and value = %s
+                    returning contact_id""",
+                contact_ids,
+                tag,
+            )
+        ]
+        if not len(removed):
+            continue
 
-def add_tag(
-    db: DB,
-    cid: str,
-    email: str,
-    contact_id: int,
-    tag: str,
-    tagfunnels: Dict[str, List[JsonObj]],
-    funnelcounts: Dict[str, int],
-    tagcounts: Dict[str, int],
-    webhook_msgs: List[JsonObj],
-) -> None:
-    is_new = db.single(
-        f"""insert into contacts."contact_values_{cid}" (contact_id, type, value) values (%s, 'tag', %s)
-                           on conflict (contact_id, type, value) do nothing returning contact_id""",
-        contact_id,
-        tag,
-    )
+        tagcounts[tag] = tagcounts.get(tag, 0) - len(removed)
 
-    if is_new:
-        tagcounts[tag] = tagcounts.get(tag, 0) + 1
+        ts = datetime.utcnow().isoformat() + "Z"
+        for email in removed:
+            webhook_msgs.append(
+                {
+                    "type": "tag_remove",
+                    "tag": tag,
+                    "email": email,
+                    "timestamp": ts,
+                }
+            )
 
-        webhook_msgs.append(
-            {
-                "type": "tag_add",
-                "tag": tag,
-                "email": email,
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-            }
-        )
+    if funnel is not None:
+        assert respfunnels is not None
+        fun = respfunnels.get(funnel)
+        if fun is not None:
+            insert_funnel_bulk(db, cid, email_contact_ids, fun, 0, funnelcounts)
 
-        if tagfunnels is not None:
-            insert_funnel_tag(db, cid, email, tag, tagfunnels, funnelcounts)
+    if apply_counts:
+        apply_tag_counts(db, cid, tagcounts, funnelcounts)
 
 
-def remove_tag(
-    db: DB,
-    cid: str,
-    email: str,
-    contact_id: int,
-    tag: str,
-    tagcounts: Dict[str, int],
-    webhook_msgs: List[JsonObj],
+def apply_tag_counts(
+    db: DB, cid: str, tagcounts: Dict[str, int], funnelcounts: Dict[str, int]
 ) -> None:
-    is_del = db.execute(
-        f"""delete from contacts."contact_values_{cid}"
-                            where contact_id = %s and type = 'tag' and value = %s""",
-        contact_id,
-        tag,
-    ).rowcount
-
-    if is_del:
-        tagcounts[tag] = tagcounts.get(tag, 0) - 1
+    incr_funnel_counts(db, funnelcounts)
 
-        webhook_msgs.append(
-            {
-                "type": "tag_remove",
-                "tag": tag,
-                "email": email,
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-            }
-        )
+    for tagname, cnt in sorted(tagcounts.items()):
+        if cnt:
+            db.execute(
+                "update alltags set count = count + %s where cid = %s and tag = %s",
+                cnt,
+                cid,
+                tagname,
+            )
 
 
 def erase(db: DB, cid: str, emails: List[str], unsublog: bool = False) -> None:
@@ -476,6 +552,7 @@ def feed(
     funnel: str | None = None,
     override: bool = False,
     unsubscribe: bool = False,
+    webhooks: List[JsonObj] | None = None,
 ) -> None:
     lst = db.lists.get(listid)
     if lst is None or lst.get("unapproved", False):
@@ -656,7 +733,10 @@ def feed(
             contact_id,
         )
 
-    if len(webhook_msgs):
+    # a caller writing in a transaction sends the events once it commits
+    if webhooks is not None:
+        webhooks.extend(webhook_msgs)
+    elif len(webhook_msgs):
         send_webhooks(db, cid, webhook_msgs)
 
 
@@ -840,49 +920,112 @@ def update(db: DB, cid: str, upd: JsonObj) -> None:
 
         incr_funnel_counts(db, funnelcounts)
 
-    patch = {
-        "last_update": datetime.utcnow().isoformat() + "Z",
-        "count_dirty": True,
-    }
+    # list counters are shared by every event for the list's contacts, so
+    # changes are appended to list_deltas and rolled up in the background
+    # rather than written to the list rows here
+    if db.execute(
+        f"""
+        insert into list_deltas (list_id, property, active30, active60, active90, bounced, complained, unsubscribed, soft_bounced)
+        select l.list_id, %s, %s, %s, %s, %s, %s, %s, %s
+        from contacts."contact_lists_{cid}" l
+        where l.contact_id = %s""",
+        fn.prop,
+        active30,
+        active60,
+        active90,
+        counts["bounced"],
+        counts["complained"],
+        counts["unsubscribed"],
+        counts["soft_bounced"],
+        contact_id,
+    ).rowcount:
+        schedule_list_rollup()
 
-    listids = [
-        id
-        for id, in db.execute(
-            f"""
-            select l.list_id
-            from contacts."contact_lists_{cid}" l
-            join contacts."contacts_{cid}" c on c.contact_id = l.contact_id
-            where c.email = %s""",
-            fn.email,
-        )
-    ]
 
-    for listid in listids:
-        db.execute(
-            """
-            update lists set data = data || %s || jsonb_build_object(
+def schedule_list_rollup() -> None:
+    """Starts a rollup of list_deltas shortly unless one is already
+    pending."""
+    if redis_connect().set(
+        LIST_ROLLUP_KEY, "1", nx=True, ex=LIST_ROLLUP_DELAY + LIST_ROLLUP_LOCK_SECS
+    ):
+        run_task_delay(rollup_list_deltas_task, LIST_ROLLUP_DELAY)
+
+
+def apply_list_deltas(db: DB) -> int:
+    """Folds up to LIST_ROLLUP_BATCH_SIZE of the oldest pending list_deltas
+    into the list counters, returning how many were applied. The caller must
+    hold LIST_ROLLUP_LOCK in the current transaction."""
+    cnt: int = db.single(
+        """
+        with d as (
+            delete from list_deltas where id = any(array(
+                select id from list_deltas order by id limit %s
+            ))
+            returning *
+        ), a as (
+            select list_id, array_agg(distinct property) properties, max(ts) ts,
+                   sum(active30) active30, sum(active60) active60, sum(active90) active90,
+                   sum(bounced) bounced, sum(complained) complained,
+                   sum(unsubscribed) unsubscribed, sum(soft_bounced) soft_bounced
+            from d group by list_id
+        ), u as (
+            update lists set data = data || jsonb_build_object(
+                'last_update', to_char(a.ts at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'),
+                'count_dirty', true,
                 'used_properties', (select '["Email"]' || (jsonb_agg(distinct p) - 'Email')
-                                    from jsonb_array_elements(coalesce(data->'used_properties', '[]'::jsonb) || array_to_json(%s)::jsonb) as p),
-                'active30', coalesce((data->'active30')::int, 0) + %s,
-                'active60', coalesce((data->'active60')::int, 0) + %s,
-                'active90', coalesce((data->'active90')::int, 0) + %s,
-                'bounced', coalesce((data->'bounced')::int, 0) + %s,
-                'complained', coalesce((data->'complained')::int, 0) + %s,
-                'unsubscribed', coalesce((data->'unsubscribed')::int, 0) + %s,
-                'soft_bounced', coalesce((data->'soft_bounced')::int, 0) + %s
+                                    from jsonb_array_elements(coalesce(data->'used_properties', '[]'::jsonb) || array_to_json(a.properties)::jsonb) as p),
+                'active30', coalesce((data->'active30')::int, 0) + a.active30,
+                'active60', coalesce((data->'active60')::int, 0) + a.active60,
+                'active90', coalesce((data->'active90')::int, 0) + a.active90,
+                'bounced', coalesce((data->'bounced')::int, 0) + a.bounced,
+                'complained', coalesce((data->'complained')::int, 0) + a.complained,
+                'unsubscribed', coalesce((data->'unsubscribed')::int, 0) + a.unsubscribed,
+                'soft_bounced', coalesce((data->'soft_bounced')::int, 0) + a.soft_bounced
             )
-            where id = %s""",
-            patch,
-            [fn.prop],
-            active30,
-            active60,
-            active90,
-            counts["bounced"],
-            counts["complained"],
-            counts["unsubscribed"],
-            counts["soft_bounced"],
-            listid,
+            from a where lists.id = a.list_id
         )
+        select count(*) from d""",
+        LIST_ROLLUP_BATCH_SIZE,
+    )
+    return cnt
+
+
+def rollup_list_deltas(db: DB) -> int:
+    """Folds pending list_deltas into the list counters in batches, returning
+    the number of deltas applied. Only one rollup runs at a time."""
+    total = 0
+    while True:
+        with db.transaction():
+            if not db.single(f"select pg_try_advisory_xact_lock({LIST_ROLLUP_LOCK})"):
+                break
+            cnt = apply_list_deltas(db)
+        total += cnt
+        if cnt < LIST_ROLLUP_BATCH_SIZE:
+            break
+    return total
+
+
+@tasks.task(priority=HIGH_PRIORITY)
+def rollup_list_deltas_task() -> None:
+    # deltas added from here on schedule the next rollup
+    redis_connect().delete(LIST_ROLLUP_KEY)
+
+    with open_db() as db:
+        try:
+            rollup_list_deltas(db)
+        except:
+            log.exception("error")
+
+
+def rollup_list_counts() -> None:
+    """Catches deltas whose rollup was lost or raced with the insert."""
+    with open_db() as db:
+        try:
+            cnt = rollup_list_deltas(db)
+            if cnt:
+                log.info("Rolled up %s list deltas", cnt)
+        except:
+            log.exception("error")
 
 
 @tasks.task(priority=HIGH_PRIORITY)
@@ -1804,6 +1947,76 @@ def write_block(
 
 CONTACTS_PER_BLOCK = 500
 
+# uploads are parsed in chunks of about IMPORT_CHUNK_SIZE bytes in parallel;
+# the parsed rows are partitioned by email into one bucket per
+# IMPORT_BUCKET_SIZE bytes of upload so each bucket can be deduplicated on its
+# own in bounded memory
+IMPORT_CHUNK_SIZE = 32 * 1024 * 1024
+IMPORT_BUCKET_SIZE = 64 * 1024 * 1024
+IMPORT_MAX_BUCKETS = 256
+IMPORT_EXCLUSION_BATCH = 5000
+
+
+def import_failed(db: DB, keytype: str, listid: str, e: Exception) -> None:
+    patch = {
+        "processing": "",
+        "processing_error": "Importing data failed: %s" % str(e),
+    }
+    if keytype == "supp":
+        db.supplists.patch(listid, patch)
+    elif keytype == "list":
+        db.lists.patch(listid, patch)
+
+
+def split_import(fp: IOBase, chunksize: int) -> Tuple[str, List[Tuple[int, int]]]:
+    """Reads the upload in fp once, without parsing it, and returns the
+    encoding to parse it with and the byte ranges to split it into. Ranges
+    end at line breaks outside of quoted fields so that each one parses as
+    CSV on its own."""
+    decoder: codecs.IncrementalDecoder | None = codecs.getincrementaldecoder("utf-8")()
+    offsets = [0]
+    pos = 0
+    quoted = False
+    while True:
+        block = fp.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        if decoder is not None:
+            try:
+                decoder.decode(block)
+            except UnicodeDecodeError:
+                decoder = None
+
+        # line breaks inside quoted fields follow an odd number of quotes
+        i = max(offsets[-1] + chunksize - pos, 0)
+        counted = 0
+        quotes = 0
+        while i < len(block):
+            i = block.find(b"\n", i)
+            if i < 0:
+                break
+            quotes += block.count(b'"', counted, i)
+            counted = i
+            if quoted == (quotes % 2 == 0):
+                i += 1
+                continue
+            offsets.append(pos + i + 1)
+            i = offsets[-1] + chunksize - pos
+
+        quoted = quoted != (block.count(b'"') % 2 == 1)
+        pos += len(block)
+
+    if decoder is not None:
+        try:
+            decoder.decode(b"", True)
+        except UnicodeDecodeError:
+            decoder = None
+
+    offsets = [o for o in offsets if o < pos] + [pos]
+    return "utf-8" if decoder is not None else "iso-8859-1", list(
+        zip(offsets[:-1], offsets[1:])
+    )
+
 
 @tasks.task(priority=LOW_PRIORITY)
 def dedupe_blocks(
@@ -1817,156 +2030,279 @@ def dedupe_blocks(
 ) -> None:
     with open_db() as db:
         try:
-            l = len(colmap)
-            strippedcols = [c for c in colmap if valid_prop(c)]
-            s = len(strippedcols)
-            emailindex = strippedcols.index("Email")
-
-            used = set()
             skipvalidation = False
-            excludemails = None
-            excludedomains = None
             if keytype == "list":
-                excludemails = set()
-                excludedomains = set()
-                for item, rh in db.execute(
-                    "select item, rawhash from exclusions where cid = %s", cid
-                ):
-                    if rh is None:
-                        excludedomains.add(item)
-                    else:
-                        excludemails.add(item)
                 skipvalidation = db.single(
                     "select (data->>'skip_list_validation')::boolean from companies where id = %s",
                     cid,
                 )
 
-            for encoding in ["utf-8", "iso-8859-1", "ascii"]:
-                try:
-                    files: List[str] = []
-                    writefp: IOBase | None = None
-                    writecount = 0
-                    emails = set()
-
-                    with s3_read_stream(os.environ["s3_transferbucket"], key) as fp:
-                        with TextIOWrapper(
-                            fp,
-                            encoding,
-                            newline="",
-                            errors="ignore" if encoding == "ascii" else None,
-                        ) as text:
-                            for row in csv.reader(text):
-                                r = [
-                                    row[i].strip()
-                                    for i in range(min(len(row), l))
-                                    if valid_prop(colmap[i])
-                                ]
-
-                                if len(r) <= emailindex:
-                                    continue
+            with s3_read_stream(os.environ["s3_transferbucket"], key) as fp:
+                encoding, ranges = split_import(fp, IMPORT_CHUNK_SIZE)
 
-                                emailmatch = emailre.search(r[emailindex])
-                                if not emailmatch and not (
-                                    keytype == "supp" and md5re.search(r[emailindex])
-                                ):
-                                    continue
+            if not len(ranges):
+                if keytype == "supp":
+                    db.supplists.patch(
+                        listid, {"processing": "", "processing_error": ""}
+                    )
+                elif keytype == "list":
+                    db.lists.patch(listid, {"processing": "", "processing_error": ""})
+                s3_delete(os.environ["s3_transferbucket"], key)
+                return
 
-                                if emailmatch:
-                                    email = emailmatch.group(0).lower()
-                                    if len(email) > 254:
-                                        continue
-                                else:
-                                    email = r[emailindex].lower()
+            buckets = min(
+                IMPORT_MAX_BUCKETS,
+                -(-ranges[-1][1] // IMPORT_BUCKET_SIZE),
+            )
+            tmpid = gather_init(db, "dedupe_chunk", len(ranges))
 
-                                if email in emails:
-                                    continue
-                                emails.add(email)
-
-                                while len(r) < s:
-                                    r.append("")
-
-                                props = {}
-                                for i in range(len(r)):
-                                    if i != emailindex:
-                                        colname = strippedcols[i]
-                                        if not unsub and colname in (
-                                            "Bounced",
-                                            "Unsubscribed",
-                                            "Complained",
-                                            "Soft Bounced",
-                                        ):
-                                            continue
-                                        props[colname] = [r[i]]
-                                        used.add(colname)
-
-                                if keytype == "list":
-                                    domain = email.split("@")[1]
-
-                                    if (email in excludemails) or (
-                                        domain in excludedomains
-                                    ):
-                                        continue
-
-                                if writefp is None or writecount >= CONTACTS_PER_BLOCK:
-                                    if writefp is not None:
-                                        writefp.close()
-                                    filename = f"{key}.dedupe.{len(files):05d}"
-                                    writefp = s3_open_write(
-                                        os.environ["s3_transferbucket"], filename
-                                    )
-                                    files.append(filename)
-                                    writecount = 0
-                                msgpack.pack([email, props], writefp)
-                                writecount += 1
-                    if writefp is not None:
-                        writefp.close()
-                    break
-                except UnicodeDecodeError:
-                    if encoding == "ascii":
-                        raise
+            for index, (start, end) in enumerate(ranges):
+                run_task(
+                    dedupe_chunk,
+                    cid,
+                    listid,
+                    keytype,
+                    key,
+                    colmap,
+                    override,
+                    unsub,
+                    skipvalidation,
+                    encoding,
+                    index,
+                    start,
+                    end,
+                    buckets,
+                    tmpid,
+                )
+        except Exception as e:
+            log.exception("error")
+            import_failed(db, keytype, listid, e)
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def dedupe_chunk(
+    cid: str,
+    listid: str,
+    keytype: str,
+    key: str,
+    colmap: List[str],
+    override: bool,
+    unsub: bool,
+    skipvalidation: bool,
+    encoding: str,
+    index: int,
+    start: int,
+    end: int,
+    buckets: int,
+    tmpid: str,
+) -> None:
+    with open_db() as db:
+        try:
+            l = len(colmap)
+            strippedcols = [c for c in colmap if valid_prop(c)]
+            s = len(strippedcols)
+            emailindex = strippedcols.index("Email")
 
-            if len(files):
-                tmpid = gather_init(db, "write_block", len(files))
+            used = set()
+            writefps: Dict[int, IOBase] = {}
 
-                for filename in files:
+            data = s3_read_range(
+                os.environ["s3_transferbucket"], key, start, end - start
+            )
+            try:
+                with TextIOWrapper(BytesIO(data), encoding, newline="") as text:
+                    for row in csv.reader(text):
+                        r = [
+                            row[i].strip()
+                            for i in range(min(len(row), l))
+                            if valid_prop(colmap[i])
+                        ]
+
+                        if len(r) <= emailindex:
+                            continue
+
+                        emailmatch = emailre.search(r[emailindex])
+                        if not emailmatch and not (
+                            keytype == "supp" and md5re.search(r[emailindex])
+                        ):
+                            continue
+
+                        if emailmatch:
+                            email = emailmatch.group(0).lower()
+                            if len(email) > 254:
+                                continue
+                        else:
+                            email = r[emailindex].lower()
+
+                        while len(r) < s:
+                            r.append("")
+
+                        props = {}
+                        for i in range(len(r)):
+                            if i != emailindex:
+                                colname = strippedcols[i]
+                                if not unsub and colname in (
+                                    "Bounced",
+                                    "Unsubscribed",
+                                    "Complained",
+                                    "Soft Bounced",
+                                ):
+                                    continue
+                                props[colname] = [r[i]]
+                                used.add(colname)
+
+                        bucket = zlib.crc32(email.encode("utf-8")) % buckets
+                        writefp = writefps.get(bucket)
+                        if writefp is None:
+                            writefp = s3_open_write(
+                                os.environ["s3_transferbucket"],
+                                f"{key}.bucket.{bucket:05d}.{index:05d}",
+                            )
+                            writefps[bucket] = writefp
+                        msgpack.pack([email, props], writefp)
+            finally:
+                for writefp in writefps.values():
+                    writefp.close()
+
+            chunkinfo = gather_complete(db, tmpid, {"used": list(used)})
+            if chunkinfo is not None:
+                s3_delete(os.environ["s3_transferbucket"], key)
+
+                allused = set()
+                for info in chunkinfo:
+                    allused.update(info["used"])
+
+                buckettmpid = gather_init(db, "dedupe_bucket", buckets)
+                for bucket in range(buckets):
                     run_task(
-                        write_block,
+                        dedupe_bucket,
                         cid,
-                        filename,
-                        tmpid,
                         listid,
                         keytype,
-                        list(used),
-                        skipvalidation,
+                        key,
                         override,
                         unsub,
+                        skipvalidation,
+                        bucket,
+                        list(allused),
+                        buckettmpid,
                     )
-            else:
-                if keytype == "supp":
-                    db.supplists.patch(
-                        listid, {"processing": "", "processing_error": ""}
-                    )
-                elif keytype == "list":
-                    db.lists.patch(listid, {"processing": "", "processing_error": ""})
-            s3_delete(os.environ["s3_transferbucket"], key)
         except Exception as e:
             log.exception("error")
-            if keytype == "supp":
-                db.supplists.patch(
-                    listid,
-                    {
-                        "processing": "",
-                        "processing_error": "Importing data failed: %s" % str(e),
-                    },
-                )
-            elif keytype == "list":
-                db.lists.patch(
-                    listid,
-                    {
-                        "processing": "",
-                        "processing_error": "Importing data failed: %s" % str(e),
-                    },
-                )
+            import_failed(db, keytype, listid, e)
+
+
+def excluded_emails(db: DB, cid: str, emails: List[str]) -> set[str]:
+    domains = list(set(email.split("@")[1] for email in emails))
+    excludemails = set()
+    excludedomains = set()
+    for item, rh in db.execute(
+        "select item, rawhash from exclusions where cid = %s and item = any(%s)",
+        cid,
+        emails + domains,
+    ):
+        if rh is None:
+            excludedomains.add(item)
+        else:
+            excludemails.add(item)
+    return set(
+        email
+        for email in emails
+        if email in excludemails or email.split("@")[1] in excludedomains
+    )
+
+
+@tasks.task(priority=LOW_PRIORITY)
+def dedupe_bucket(
+    cid: str,
+    listid: str,
+    keytype: str,
+    key: str,
+    override: bool,
+    unsub: bool,
+    skipvalidation: bool,
+    bucket: int,
+    used: List[str],
+    tmpid: str,
+) -> None:
+    with open_db() as db:
+        try:
+            files: List[str] = []
+            writefp: IOBase | None = None
+            writecount = 0
+            emails = set()
+            pending: List[Tuple[str, JsonObj]] = []
+
+            def write_pending() -> None:
+                nonlocal writefp, writecount
+                excluded: set[str] = set()
+                if keytype == "list":
+                    excluded = excluded_emails(db, cid, [email for email, _ in pending])
+                for email, props in pending:
+                    if email in excluded:
+                        continue
+                    if writefp is None or writecount >= CONTACTS_PER_BLOCK:
+                        if writefp is not None:
+                            writefp.close()
+                        filename = f"{key}.dedupe.{bucket:05d}.{len(files):05d}"
+                        writefp = s3_open_write(
+                            os.environ["s3_transferbucket"], filename
+                        )
+                        files.append(filename)
+                        writecount = 0
+                    msgpack.pack([email, props], writefp)
+                    writecount += 1
+                pending.clear()
+
+            # chunk files are read in upload order, so the first row with an
+            # email is the one kept, as when the upload was read in one pass
+            for part in s3_list(
+                os.environ["s3_transferbucket"], f"{key}.bucket.{bucket:05d}."
+            ):
+                with s3_read_stream(os.environ["s3_transferbucket"], part.key) as fp:
+                    for email, props in msgpack.Unpacker(fp, strict_map_key=False):
+                        if email in emails:
+                            continue
+                        emails.add(email)
+                        pending.append((email, props))
+                        if len(pending) >= IMPORT_EXCLUSION_BATCH:
+                            write_pending()
+                s3_delete(os.environ["s3_transferbucket"], part.key)
+            write_pending()
+            if writefp is not None:
+                writefp.close()
+
+            bucketinfo = gather_complete(db, tmpid, {"files": files})
+            if bucketinfo is not None:
+                allfiles = [f for info in bucketinfo for f in info["files"]]
+                if len(allfiles):
+                    blocktmpid = gather_init(db, "write_block", len(allfiles))
+
+                    for filename in allfiles:
+                        run_task(
+                            write_block,
+                            cid,
+                            filename,
+                            blocktmpid,
+                            listid,
+                            keytype,
+                            used,
+                            skipvalidation,
+                            override,
+                            unsub,
+                        )
+                else:
+                    if keytype == "supp":
+                        db.supplists.patch(
+                            listid, {"processing": "", "processing_error": ""}
+                        )
+                    elif keytype == "list":
+                        db.lists.patch(
+                            listid, {"processing": "", "processing_error": ""}
+                        )
+        except Exception as e:
+            log.exception("error")
+            import_failed(db, keytype, listid, e)
 
 
 def add_blocks(
@@ -2275,8 +2611,12 @@ def initialize_cid(db: DB, cid: str) -> None:
             unsubscribed boolean,
             complained boolean,
             props jsonb not null,
+            email_hash bigint,
             unique (email)
         ) inherits (contacts.contacts);
+        create trigger "contacts_{cid}_email_hash" before insert or update of email on contacts."contacts_{cid}"
+            for each row execute function contacts.set_email_hash();
+        create index "contacts_{cid}_email_hash_idx" on contacts."contacts_{cid}" (email_hash);
         create table contacts."contact_lists_{cid}" (
             list_id text not null,
             contact_id int not null references contacts."contacts_{cid}" on delete cascade,
@@ -2329,6 +2669,188 @@ def initialize_cid(db: DB, cid: str) -> None:
         cid,
         HASHLIMIT_CAP,
     )
+    create_suppdigests(db, cid)
+    create_search_indexes(db, cid)
+
+
+def create_search_indexes(db: DB, cid: str, concurrently: bool = False) -> None:
+    """Creates the trigram indexes that let a contact search find the
+    contacts whose email, properties or tags contain some text without
+    reading the whole tenant. Requires the pg_trgm extension.
+
+    With concurrently the indexes are built without blocking writes,
+    replacing any left invalid by an interrupted build, and this must not be
+    called inside a transaction."""
+    for name, table, index in (
+        (
+            f"contacts_{cid}_search_idx",
+            f"contacts_{cid}",
+            "using gin (lower(email || ' ' || props::text) gin_trgm_ops)",
+        ),
+        (
+            f"contact_values_{cid}_tag_search_idx",
+            f"contact_values_{cid}",
+            "using gin (lower(value) gin_trgm_ops) where type = 'tag'",
+        ),
+    ):
+        if concurrently:
+            if db.single(
+                "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+                'contacts."%s"' % name,
+            ):
+                db.execute('drop index concurrently contacts."%s"' % name)
+            db.execute(
+                f'create index concurrently if not exists "{name}" on contacts."{table}" {index}'
+            )
+        else:
+            db.execute(
+                f'create index if not exists "{name}" on contacts."{table}" {index}'
+            )
+
+
+def create_djb2_function(db: DB) -> None:
+    """Creates contacts.djb2, which matches utils.djb2 on the UTF-8 bytes of
+    its argument, and the trigger function that keeps the email_hash column
+    that orders contacts and places them in percentage splits set from it."""
+    db.execute(
+        """
+        create or replace function contacts.djb2(s text) returns bigint
+        language plpgsql immutable strict parallel safe as $$
+        declare
+            b bytea := convert_to(s, 'UTF8');
+            h bigint := 5381;
+        begin
+            for i in 0 .. length(b) - 1 loop
+                h := ((h << 5) + h + get_byte(b, i)) & 4294967295;
+            end loop;
+            return h;
+        end $$;
+
+        create or replace function contacts.set_email_hash() returns trigger language plpgsql as $$
+        begin
+            new.email_hash := contacts.djb2(new.email);
+            return new;
+        end $$;
+    """
+    )
+
+
+def create_email_hash_column(db: DB, cid: str) -> None:
+    """Adds the email_hash column of an existing tenant and the trigger that
+    sets it. Existing rows are left null until backfill_email_hash has run;
+    adding the column does not rewrite the table."""
+    db.execute(
+        f"""
+        alter table contacts."contacts_{cid}" add column if not exists email_hash bigint;
+        create or replace trigger "contacts_{cid}_email_hash" before insert or update of email on contacts."contacts_{cid}"
+            for each row execute function contacts.set_email_hash();
+    """
+    )
+
+
+def backfill_email_hash(
+    db: DB, cid: str, batch: int = EMAIL_HASH_BACKFILL_BATCH
+) -> int:
+    """Fills in email_hash for the tenant's contacts written before its
+    trigger existed, one committed batch at a time in contact_id order, so
+    that no lock is held for long. Must not be called inside a transaction.
+    Returns the number of contacts updated."""
+    total = 0
+    last = 0
+    while True:
+        row = db.row(
+            f"""
+            with batch as (
+                select contact_id from contacts."contacts_{cid}" where contact_id > %s order by contact_id limit %s
+            ),
+            updated as (
+                update contacts."contacts_{cid}" c set email_hash = contacts.djb2(c.email)
+                from batch where c.contact_id = batch.contact_id and c.email_hash is null
+                returning 1
+            )
+            select (select max(contact_id) from batch), (select count(*) from updated)
+        """,
+            last,
+            batch,
+        )
+        if row is None or row[0] is None:
+            return total
+        last, updated = row
+        total += updated
+
+
+def index_email_hash(db: DB, cid: str) -> None:
+    """Builds the tenant's email_hash index without blocking writes,
+    replacing one left invalid by an interrupted build. Must not be called
+    inside a transaction."""
+    name = "contacts_%s_email_hash_idx" % cid
+    if db.single(
+        "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+        'contacts."%s"' % name,
+    ):
+        db.execute('drop index concurrently contacts."%s"' % name)
+    db.execute(
+        f'create index concurrently if not exists "{name}" on contacts."contacts_{cid}" (email_hash)'
+    )
+
+
+def create_suppdigest_functions(db: DB) -> None:
+    """Creates the trigger functions that keep each tenant's
+    contact_suppdigests table in step with contact_supplists. The tenant id is
+    passed as the trigger argument."""
+    db.execute(
+        """
+        create or replace function contacts.suppdigests_insert() returns trigger language plpgsql as $$
+        begin
+            execute format(
+                'insert into contacts.%%I (supplist_id, contact_id, digest)
+                 select n.supplist_id, n.contact_id,
+                        case when c.email ~ ''^[A-Fa-f0-9]{32}$'' then c.email::uuid else md5(c.email)::uuid end
+                 from new_rows n join contacts.%%I c on c.contact_id = n.contact_id
+                 on conflict do nothing',
+                'contact_suppdigests_' || TG_ARGV[0], 'contacts_' || TG_ARGV[0]);
+            return null;
+        end $$;
+
+        create or replace function contacts.suppdigests_delete() returns trigger language plpgsql as $$
+        begin
+            execute format(
+                'delete from contacts.%%I d using old_rows o
+                 where d.supplist_id = o.supplist_id and d.contact_id = o.contact_id',
+                'contact_suppdigests_' || TG_ARGV[0]);
+            return null;
+        end $$;
+    """
+    )
+
+
+def create_suppdigests(db: DB, cid: str) -> None:
+    """Creates the tenant's suppression digest table, which holds the md5 of
+    every suppression list member (or the stored value for lists imported as
+    md5 hashes), fills it from the current lists and attaches the triggers that
+    maintain it from then on."""
+    db.execute(
+        f"""
+        create table if not exists contacts."contact_suppdigests_{cid}" (
+            supplist_id text not null,
+            contact_id int not null,
+            digest uuid not null,
+            primary key (supplist_id, contact_id)
+        );
+        create index if not exists "contact_suppdigests_{cid}_digest_idx" on contacts."contact_suppdigests_{cid}" (digest);
+
+        insert into contacts."contact_suppdigests_{cid}" (supplist_id, contact_id, digest)
+        select s.supplist_id, s.contact_id,
+               case when c.email ~ '^[A-Fa-f0-9]{{32}}$' then c.email::uuid else md5(c.email)::uuid end
+        from contacts."contact_supplists_{cid}" s join contacts."contacts_{cid}" c on c.contact_id = s.contact_id
+        on conflict do nothing;
+
+        create or replace trigger "contact_supplists_{cid}_digests_ins" after insert on contacts."contact_supplists_{cid}"
+            referencing new table as new_rows for each statement execute function contacts.suppdigests_insert('{cid}');
+        create or replace trigger "contact_supplists_{cid}_digests_del" after delete on contacts."contact_supplists_{cid}"
+            referencing old table as old_rows for each statement execute function contacts.suppdigests_delete('{cid}');
+    """
+    )
 
 
 def initialize(db: DB) -> None:
@@ -2384,6 +2906,9 @@ def initialize(db: DB) -> None:
         );
     """
     )
+    create_suppdigest_functions(db)
+    create_djb2_function(db)
+    db.execute("create extension if not exists pg_trgm")
 
     cids = []
     for (cid,) in db.execute(
@@ -4,7 +4,7 @@ import falcon
 from typing import Tuple
 from jsonschema import validate
 
-from .db import json_iter, JsonObj, DB
+from .db import JsonObj, DB
 from .utils import user_log
 from .log import get_logger
 
@@ -12,6 +12,9 @@ log = get_logger()
 
 origre = re.compile(r" \((\d+)\)$")
 
+COLLECTION_PAGE_SIZE = 100
+COLLECTION_PAGE_MAX = 1000
+
 
 def get_orig(name: str) -> Tuple[str, int]:
     m = origre.search(name)
@@ -83,29 +86,56 @@ class CRUDCollection(object):
                 req, getattr(self, "api", False), getattr(self, "checkexports", False)
             )
 
+        self.get_result(req)
+
+    def get_result(self, req: falcon.Request) -> None:
+        # without paging parameters the whole collection is returned as a list,
+        # as it always has been; with limit or after it is returned a page at a
+        # time in id order, and next is the after value for the following page
         db = req.context["db"]
 
         large = getattr(self, "large", None)
-
-        if large is not None:
-            req.context["result"] = list(
-                json_iter(
-                    db.execute(
-                        "select id, cid, data - %%s from %s where cid = %%s"
-                        % self.domain,
-                        large,
-                        db.get_cid(),
-                    )
-                )
+        exclude = [large] if isinstance(large, str) else large
+
+        fields = req.get_param_as_list("fields")
+        if fields is not None:
+            fields = [f for field in fields for f in field.split(",") if f]
+        search = req.get_param("search")
+        filt = req.get_param_as_json("filter")
+        if filt is not None and not isinstance(filt, dict):
+            raise falcon.HTTPBadRequest(
+                title="Invalid filter", description="filter must be a JSON object."
             )
-        else:
-            req.context["result"] = db[self.domain].get_all()
+        after = req.get_param("after")
+        limit = req.get_param_as_int(
+            "limit", min_value=1, max_value=COLLECTION_PAGE_MAX
+        )
+        paged = limit is not None or after is not None
+        if paged and limit is None:
+            limit = COLLECTION_PAGE_SIZE
+
+        rows = db[self.domain].get_page(
+            filt,
+            exclude,
+            fields,
+            search,
+            after,
+            limit + 1 if limit is not None else None,
+        )
 
         hide = getattr(self, "hide", None)
         if hide:
-            for r in req.context["result"]:
+            for r in rows:
                 r.pop(hide, None)
 
+        if not paged:
+            req.context["result"] = rows
+        elif limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            req.context["result"] = {"records": rows, "next": rows[-1]["id"]}
+        else:
+            req.context["result"] = {"records": rows, "next": None}
+
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
         if getattr(self, "adminonly", False) and not req.context["admin"]:
             raise falcon.HTTPUnauthorized()
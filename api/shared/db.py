@@ -2,8 +2,15 @@ import psycopg2
 import psycopg2.pool
 import psycopg2.extras
 import psycopg2.extensions
+import psycopg2.errors
 import shortuuid
 import os
+import time
+import threading
+import re
+import math
+from decimal import Decimal
+from datetime import datetime, date
 from typing import (
     Dict,
     Iterator,
@@ -12,10 +19,12 @@ from typing import (
     Tuple,
     TypeAlias,
     List,
+    Set,
     overload,
     Literal,
     cast,
 )
+from collections import OrderedDict
 from contextlib import contextmanager
 from .log import get_logger
 
@@ -164,6 +173,122 @@ def statlogs_iter(
         yield statlogs_obj(row)
 
 
+# Document fields that hot queries filter and sort on, kept in typed columns
+# named data_<field> beside the data column so that they get ordinary
+# statistics and btree indexes. A trigger derives them from data on every
+# write. text columns hold data->>field; boolean columns hold JSON booleans
+# and are null for anything else.
+PROMOTED_FIELDS: Dict[str, Dict[str, str]] = {
+    "campaigns": {"sent_at": "text", "hidden": "text", "modified": "text"},
+    "messages": {"funnel": "text", "modified": "text"},
+    "funnels": {"active": "boolean"},
+}
+
+# (columns, partial index predicate) for each index on the promoted columns
+PROMOTED_INDEXES: Dict[str, List[Tuple[Tuple[str, ...], str]]] = {
+    "campaigns": [
+        (("cid", "data_sent_at"), "data_hidden is null"),
+        (("cid", "data_modified"), "data_sent_at is null"),
+    ],
+    "messages": [
+        (("data_funnel",), ""),
+        (("cid", "data_modified"), ""),
+    ],
+    "funnels": [
+        (("data_active",), ""),
+    ],
+}
+
+PROMOTED_BACKFILL_BATCH = 2000
+
+
+def promoted_expr(field: str, pgtype: str, doc: str = "data") -> str:
+    if pgtype == "boolean":
+        return f"case when jsonb_typeof({doc}->'{field}') = 'boolean' then ({doc}->'{field}')::boolean end"
+    return f"{doc}->>'{field}'"
+
+
+def create_promoted_columns(db: "DB", table: str) -> None:
+    """Adds the promoted columns of table and the trigger that maintains
+    them. Existing rows are left null until backfill_promoted_columns has run;
+    adding the columns does not rewrite the table."""
+    fields = PROMOTED_FIELDS[table]
+    columns = ", ".join(
+        f"add column if not exists data_{field} {pgtype}"
+        for field, pgtype in fields.items()
+    )
+    assigns = "\n".join(
+        f"new.data_{field} := {promoted_expr(field, pgtype, 'new.data')};"
+        for field, pgtype in fields.items()
+    )
+    db.execute(
+        f"""
+        alter table {table} {columns};
+        create or replace function promote_{table}_fields() returns trigger language plpgsql as $$
+        begin
+            {assigns}
+            return new;
+        end $$;
+        create or replace trigger {table}_promote_fields before insert or update of data on {table}
+            for each row execute function promote_{table}_fields();
+    """
+    )
+
+
+def backfill_promoted_columns(
+    db: "DB", table: str, batch: int = PROMOTED_BACKFILL_BATCH
+) -> int:
+    """Fills the promoted columns of the rows written before the trigger
+    existed, one committed batch at a time in id order, so that no lock is
+    held for long. Must not be called inside a transaction. Returns the
+    number of rows updated."""
+    fields = PROMOTED_FIELDS[table]
+    columns = ", ".join(f"data_{field}" for field in fields)
+    exprs = ", ".join(promoted_expr(field, pgtype) for field, pgtype in fields.items())
+
+    total = 0
+    last = ""
+    while True:
+        row = db.row(
+            f"""
+            with batch as (
+                select id from {table} where id > %s order by id limit %s
+            ),
+            updated as (
+                update {table} t set ({columns}) = row({exprs})
+                from batch where t.id = batch.id
+                and ({columns}) is distinct from ({exprs})
+                returning 1
+            )
+            select (select max(id) from batch), (select count(*) from updated)
+        """,
+            last,
+            batch,
+        )
+        if row is None or row[0] is None:
+            return total
+        last, updated = row
+        total += updated
+
+
+def index_promoted_columns(db: "DB", table: str) -> None:
+    """Builds the indexes on the promoted columns of table without blocking
+    writes, replacing any left invalid by an interrupted build, and analyzes
+    the table so the planner has statistics for the new columns. Must not be
+    called inside a transaction."""
+    for columns, where in PROMOTED_INDEXES.get(table, ()):
+        name = "%s_%s_idx" % (table, "_".join(columns))
+        if db.single(
+            "select not indisvalid from pg_index where indexrelid = to_regclass(%s)",
+            name,
+        ):
+            db.execute(f"drop index concurrently {name}")
+        db.execute(
+            f"create index concurrently if not exists {name} on {table} ({', '.join(columns)}) {'where ' + where if where else ''}"
+        )
+    db.execute(f"analyze {table}")
+
+
 class JSONWrapper(object):
 
     def __init__(self, c: "DB", cid: str | None, name: str) -> None:
@@ -171,16 +296,41 @@ class JSONWrapper(object):
         self.cid = cid
         self.name = name
 
+    def _promoted(self, obj: JsonObj) -> Tuple[str, List[Any]]:
+        """Returns conditions on the promoted columns that are implied by the
+        containment query obj, so that the planner can use their indexes and
+        statistics. The containment test itself is kept."""
+        fields = PROMOTED_FIELDS.get(self.name, {})
+        q = ""
+        args = []
+        for key, val in obj.items():
+            pgtype = fields.get(key)
+            if (pgtype == "text" and isinstance(val, str)) or (
+                pgtype == "boolean" and isinstance(val, bool)
+            ):
+                q += " and data_%s = %%s" % key
+                args.append(val)
+        return q, args
+
+    def _sort_key(self, field: str) -> str:
+        if PROMOTED_FIELDS.get(self.name, {}).get(field) == "text":
+            return "data_%s" % field
+        return "data->>'%s'" % field
+
     def find_one(self, obj: JsonObj) -> JsonObj | None:
+        promoted, promotedargs = self._promoted(obj)
         if self.cid is not None:
-            q = (
-                "select id, cid, data from %s where cid = %%s and data @> %%s"
-                % self.name
+            q = "select id, cid, data from %s where cid = %%s and data @> %%s%s" % (
+                self.name,
+                promoted,
             )
-            return json_obj(self.conn.row(q, self.cid, obj))
+            return json_obj(self.conn.row(q, self.cid, obj, *promotedargs))
         else:
-            q = "select id, cid, data from %s where data @> %%s" % self.name
-            return json_obj(self.conn.row(q, obj))
+            q = "select id, cid, data from %s where data @> %%s%s" % (
+                self.name,
+                promoted,
+            )
+            return json_obj(self.conn.row(q, obj, *promotedargs))
 
     def count(
         self,
@@ -230,9 +380,14 @@ class JSONWrapper(object):
         if obj is None:
             obj = {}
 
+        promoted, promotedargs = self._promoted(obj)
+
         sort_str = ""
         if sort:
-            sort_str = " order by %s" % ", ".join("data->>'%s' %s" % s for s in sort)
+            sort_str = " order by %s" % ", ".join(
+                "%s %s" % (self._sort_key(field), direction)
+                for field, direction in sort
+            )
         limit_str = ""
         if limit is not None:
             limit_str = " limit %s" % limit
@@ -242,33 +397,36 @@ class JSONWrapper(object):
         if find:
             if self.cid is not None:
                 q = (
-                    "select id, cid, data from %s where cid = %%s and data @> %%s%s%s%s"
-                    % (self.name, sort_str, limit_str, offset_str)
+                    "select id, cid, data from %s where cid = %%s and data @> %%s%s%s%s%s"
+                    % (self.name, promoted, sort_str, limit_str, offset_str)
                 )
-                return json_iter(self.conn.execute(q, self.cid, obj))
+                return json_iter(self.conn.execute(q, self.cid, obj, *promotedargs))
             else:
-                q = "select id, cid, data from %s where data @> %%s%s%s%s" % (
+                q = "select id, cid, data from %s where data @> %%s%s%s%s%s" % (
                     self.name,
+                    promoted,
                     sort_str,
                     limit_str,
                     offset_str,
                 )
-                return json_iter(self.conn.execute(q, obj))
+                return json_iter(self.conn.execute(q, obj, *promotedargs))
         else:
             if self.cid is not None:
-                q = "select count(id) from %s where cid = %%s and data @> %%s%s%s" % (
+                q = "select count(id) from %s where cid = %%s and data @> %%s%s%s%s" % (
                     self.name,
+                    promoted,
                     limit_str,
                     offset_str,
                 )
-                return cast(int, self.conn.single(q, self.cid, obj))
+                return cast(int, self.conn.single(q, self.cid, obj, *promotedargs))
             else:
-                q = "select count(id) from %s where data @> %%s%s%s" % (
+                q = "select count(id) from %s where data @> %%s%s%s%s" % (
                     self.name,
+                    promoted,
                     limit_str,
                     offset_str,
                 )
-                return cast(int, self.conn.single(q, obj))
+                return cast(int, self.conn.single(q, obj, *promotedargs))
 
     def delete(self, obj: JsonObj) -> int:
         if self.cid is not None:
@@ -329,6 +487,57 @@ class JSONWrapper(object):
                 json_iter(self.conn.execute("select id, cid, data from %s" % self.name))
             )
 
+    def get_page(
+        self,
+        obj: JsonObj | None = None,
+        exclude: List[str] | None = None,
+        fields: List[str] | None = None,
+        search: str | None = None,
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> List[JsonObj]:
+        """Returns the documents matching the containment query obj and whose
+        name contains search, without the keys in exclude and, if fields is
+        given, with only those keys. With a limit, documents are returned in
+        id order starting after the id after, so that a collection can be
+        read a page at a time with an index range scan on (cid, id)."""
+        data = "data"
+        dataargs: List[Any] = []
+        if exclude:
+            data = "data - %s::text[]"
+            dataargs.append(list(exclude))
+        if fields is not None:
+            data = (
+                "(select coalesce(jsonb_object_agg(key, value), '{}') from jsonb_each(%s) where key = any(%%s::text[]))"
+                % data
+            )
+            dataargs.append(list(fields))
+
+        where = []
+        args: List[Any] = []
+        if self.cid is not None:
+            where.append("cid = %s")
+            args.append(self.cid)
+        if obj:
+            promoted, promotedargs = self._promoted(obj)
+            where.append("data @> %s" + promoted)
+            args.append(obj)
+            args.extend(promotedargs)
+        if search:
+            where.append("lower(data->>'name') like %s")
+            args.append("%%%s%%" % re.sub(r"([\\%_])", r"\\\1", search.lower()))
+        if after is not None:
+            where.append("id > %s")
+            args.append(after)
+
+        q = "select id, cid, %s from %s" % (data, self.name)
+        if where:
+            q += " where " + " and ".join(where)
+        if limit is not None:
+            q += " order by id limit %s"
+            args.append(limit)
+        return list(json_iter(self.conn.execute(q, *dataargs, *args)))
+
     def patch(self, id: str, obj: JsonObj) -> int:
         obj.pop("id", None)
         obj.pop("cid", None)
@@ -363,7 +572,401 @@ class JSONWrapper(object):
             return self.conn.execute(q, id).rowcount
 
 
-_pools = {}
+# per process limits; gunicorn and celery workers are separate processes, so
+# the server sees up to this many connections from each of them
+POOL_SIZE = int(os.environ.get("postgres_pool_size", 32))
+# seconds to wait for a connection when the pool is exhausted
+POOL_TIMEOUT = float(os.environ.get("postgres_pool_timeout", 30))
+# idle connections are closed after this many seconds
+POOL_IDLE_SECS = float(os.environ.get("postgres_pool_idle", 300))
+# connections idle for longer than this are checked before being handed out
+POOL_CHECK_SECS = 5
+POOL_LOG_SECS = 60
+# "transaction" when postgres_conn points at pgbouncer in transaction pooling
+# mode. The check query would only reach pgbouncer, so it is skipped, and
+# nothing may rely on state that outlives a transaction.
+POOL_MODE = os.environ.get("postgres_pool_mode", "session")
+
+
+# statements run this many times on a connection are prepared on it; not
+# possible through pgbouncer in transaction mode, where consecutive
+# transactions may land on different server connections
+PREPARE_STATEMENTS = POOL_MODE != "transaction"
+PREPARE_AFTER = 3
+# prepared statements kept per connection; the least recently used one is
+# deallocated to make room for another
+PREPARE_MAX = 250
+# prepared statements are still planned for their parameters on every run.
+# A generic plan is picked once it looks no worse than the custom ones, which
+# for segment and contact queries depends heavily on the tenant and tag the
+# statement happens to run for.
+PREPARE_PLAN_MODE = "force_custom_plan"
+
+PREPARABLE = ("select", "insert", "update", "delete", "with")
+
+placeholderre = re.compile(r"%%|%s|%")
+
+
+def param_types(vals: Tuple[Any, ...]) -> Tuple[str, ...] | None:
+    """Returns the types to declare for vals so that a prepared statement
+    sees the same types the literals psycopg2 would interpolate have, or None
+    if a value has no such type."""
+    types = []
+    for v in vals:
+        if v is None or isinstance(v, (str, dict, psycopg2.extras.Json)):
+            t = "unknown"
+        elif isinstance(v, bool):
+            t = "boolean"
+        elif isinstance(v, int):
+            if -(2**31) < v < 2**31:
+                t = "int4"
+            elif -(2**63) < v < 2**63:
+                t = "int8"
+            else:
+                t = "numeric"
+        elif isinstance(v, float):
+            t = "numeric" if math.isfinite(v) else "float8"
+        elif isinstance(v, Decimal):
+            t = "numeric"
+        elif isinstance(v, datetime):
+            t = "timestamp" if v.tzinfo is None else "timestamptz"
+        elif isinstance(v, date):
+            t = "date"
+        elif isinstance(v, list) and v:
+            if all(isinstance(e, str) for e in v):
+                t = "text[]"
+            elif all(
+                isinstance(e, int) and not isinstance(e, bool) and -(2**31) < e < 2**31
+                for e in v
+            ):
+                t = "int4[]"
+            else:
+                return None
+        else:
+            return None
+        types.append(t)
+    return tuple(types)
+
+
+class StatementCache(object):
+    """Tracks how often each statement runs on a connection and runs the
+    frequent ones through PREPARE/EXECUTE so the server parses them once.
+    Statements are keyed on their text and parameter types, and the least
+    recently used is deallocated once PREPARE_MAX are prepared."""
+
+    def __init__(self) -> None:
+        # least recently used first
+        self._names: OrderedDict[Tuple[str, Tuple[str, ...]], str] = OrderedDict()
+        self._uses: Dict[Tuple[str, Tuple[str, ...]], int] = {}
+        self._skip: Set[Tuple[str, Tuple[str, ...]]] = set()
+        self._seq = 0
+
+    def execute(
+        self,
+        cur: psycopg2.extensions.cursor,
+        sql: str,
+        vals: Tuple[Any, ...],
+    ) -> bool:
+        """Runs sql through its prepared statement if it has one or has now
+        earned one. Returns False if the caller should run it normally."""
+        types = param_types(vals)
+        if types is None:
+            return False
+        key = (sql, types)
+        name = self._names.get(key)
+        if name is None:
+            if key in self._skip:
+                return False
+            uses = self._uses.get(key, 0) + 1
+            if uses < PREPARE_AFTER:
+                if len(self._uses) >= PREPARE_MAX * 20:
+                    self._uses.clear()
+                self._uses[key] = uses
+                return False
+            self._uses.pop(key, None)
+            name = self._prepare(cur, sql, types)
+            if name is None:
+                self._skip.add(key)
+                return False
+            self._names[key] = name
+        else:
+            self._names.move_to_end(key)
+
+        try:
+            cur.execute("execute %s (%s)" % (name, ", ".join(["%s"] * len(vals))), vals)
+        except (
+            psycopg2.errors.InvalidSqlStatementName,
+            psycopg2.errors.FeatureNotSupported,
+        ) as e:
+            # gone from the server, or a table it selects * from has changed
+            # shape; it is prepared again once it has earned it
+            del self._names[key]
+            if not cur.connection.autocommit:
+                raise
+            if isinstance(e, psycopg2.errors.FeatureNotSupported):
+                cur.execute("deallocate %s" % name)
+            return False
+        return True
+
+    def _prepare(
+        self, cur: psycopg2.extensions.cursor, sql: str, types: Tuple[str, ...]
+    ) -> str | None:
+        if not sql.lstrip().lower().startswith(PREPARABLE):
+            return None
+
+        n = 0
+        valid = True
+
+        def placeholder(m: re.Match[str]) -> str:
+            nonlocal n, valid
+            if m.group(0) == "%%":
+                return "%"
+            if m.group(0) == "%":
+                valid = False
+                return "%"
+            n += 1
+            return "$%s" % n
+
+        body = placeholderre.sub(placeholder, sql)
+        if not valid or n != len(types):
+            return None
+
+        self._seq += 1
+        name = "stmt_%s" % self._seq
+        q = "prepare %s (%s) as %s" % (name, ", ".join(types), body)
+
+        evict = None
+        if len(self._names) >= PREPARE_MAX:
+            _, evict = self._names.popitem(last=False)
+
+        # a failed prepare would abort an open transaction, but prepared
+        # statements are not themselves undone by a rollback
+        intxn = not cur.connection.autocommit
+        try:
+            if intxn:
+                cur.execute("savepoint prepare_statement")
+            if evict is not None:
+                cur.execute("deallocate %s" % evict)
+            cur.execute(q)
+        except psycopg2.Error:
+            if intxn:
+                cur.execute("rollback to savepoint prepare_statement")
+            return None
+        finally:
+            if intxn:
+                cur.execute("release savepoint prepare_statement")
+        return name
+
+
+class Connection(psycopg2.extensions.connection):
+    """A connection along with the statements prepared on it."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.statements = StatementCache()
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of autocommit connections for a single
+    process. Callers wait up to the timeout for a free connection, idle
+    connections are checked before reuse and closed once they have been idle
+    too long, and broken connections are dropped when they are returned."""
+
+    def __init__(
+        self,
+        dsn: str,
+        maxconn: int,
+        timeout: float,
+        idle_secs: float,
+        check: bool,
+    ) -> None:
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_secs = idle_secs
+        self.check = check
+        self._cond = threading.Condition()
+        # most recently returned last, so the oldest are evicted first and
+        # the warmest are reused first
+        self._idle: List[Tuple[Connection, float]] = []
+        self._size = 0
+        self._waiting = 0
+        self._stats = {
+            "opened": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "failed_checks": 0,
+            "wait_secs": 0.0,
+        }
+        self._logged = time.monotonic()
+
+    def stats(self) -> JsonObj:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "max": self.maxconn,
+                **self._stats,
+            }
+
+    def _connect(self) -> Connection:
+        conn = psycopg2.connect(self.dsn, connection_factory=Connection)
+        conn.autocommit = True
+        if PREPARE_STATEMENTS:
+            with conn.cursor() as cur:
+                cur.execute("set plan_cache_mode = %s", (PREPARE_PLAN_MODE,))
+        with self._cond:
+            self._stats["opened"] += 1
+        return conn
+
+    def _close(self, conn: Connection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def _alive(self, conn: Connection) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _take_expired(self, now: float) -> List[Connection]:
+        expired = []
+        while self._idle and self._idle[0][1] < now - self.idle_secs:
+            expired.append(self._idle.pop(0)[0])
+            self._size -= 1
+        return expired
+
+    def getconn(self) -> Connection:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn: Connection | None = None
+        returned = 0.0
+        with self._cond:
+            self._stats["checkouts"] += 1
+            expired = self._take_expired(start)
+            waited = False
+            while True:
+                if self._idle:
+                    conn, returned = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # reserve the slot, the connection is opened outside the
+                    # lock
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise psycopg2.pool.PoolError(
+                        "timed out after %ss waiting for a database connection"
+                        % self.timeout
+                    )
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            if waited:
+                self._stats["wait_secs"] += time.monotonic() - start
+
+        for c in expired:
+            self._close(c)
+
+        if conn is not None and (
+            conn.closed
+            or (
+                self.check
+                and time.monotonic() - returned > POOL_CHECK_SECS
+                and not self._alive(conn)
+            )
+        ):
+            with self._cond:
+                self._stats["failed_checks"] += 1
+            self._close(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        self._log_stats()
+        return conn
+
+    def putconn(self, conn: Connection) -> None:
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status in (
+                psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+                psycopg2.extensions.TRANSACTION_STATUS_INERROR,
+            ):
+                try:
+                    conn.rollback()
+                    conn.autocommit = True
+                except psycopg2.Error:
+                    pass
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self._close(conn)
+
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _log_stats(self) -> None:
+        now = time.monotonic()
+        if now - self._logged < POOL_LOG_SECS:
+            return
+        self._logged = now
+        log.info("[POOL] %s", self.stats())
+
+
+_pools: Dict[int, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    # pools are per pid since a forked worker must not share the parent's
+    # sockets
+    pid = os.getpid()
+    pool = _pools.get(pid)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(pid)
+            if pool is None:
+                pool = ConnectionPool(
+                    os.environ["postgres_conn"],
+                    POOL_SIZE,
+                    POOL_TIMEOUT,
+                    POOL_IDLE_SECS,
+                    POOL_MODE != "transaction",
+                )
+                _pools[pid] = pool
+    return pool
+
+
+def pool_stats() -> JsonObj:
+    """Returns the connection counters for this process's pool."""
+    return get_pool().stats()
 
 
 class DB(object):
@@ -373,12 +976,8 @@ class DB(object):
         self.cur: psycopg2.extensions.cursor | None = None
         self.conn = None
         self._trace = bool(os.environ.get("sql_trace", False))
-        pid = os.getpid()
-        if pid not in _pools:
-            _pools[pid] = psycopg2.pool.SimpleConnectionPool(
-                1, 50000, os.environ["postgres_conn"]
-            )
-        self.conn = _pools[pid].getconn()
+        self._pool = get_pool()
+        self.conn = self._pool.getconn()
         self.conn.autocommit = True
         self.cur = self.conn.cursor()
 
@@ -387,8 +986,7 @@ class DB(object):
             self.cur.close()
             self.cur = None
         if self.conn is not None:
-            pid = os.getpid()
-            _pools[pid].putconn(self.conn)
+            self._pool.putconn(self.conn)
             self.conn = None
 
     def __del__(self) -> None:
@@ -446,13 +1044,37 @@ class DB(object):
         if len(vals):
             if self._trace:
                 log.info(self.cur.mogrify(sql, vals).decode("utf-8"))
-            self.cur.execute(sql, vals)
+            if not (
+                PREPARE_STATEMENTS
+                and self.conn is not None
+                and self.conn.statements.execute(self.cur, sql, vals)
+            ):
+                self.cur.execute(sql, vals)
         else:
             if self._trace:
                 log.info(self.cur.mogrify(sql, dvals).decode("utf-8"))
             self.cur.execute(sql, dvals)
         return self.cur
 
+    def stream(
+        self, sql: str, *vals: Any, size: int = 2000
+    ) -> Generator[Tuple[Any, ...], None, None]:
+        """Yields the rows of a query from a server-side cursor, fetching size
+        rows at a time. The cursor only lives as long as the transaction, so
+        this has to be consumed inside transaction()."""
+        if self.conn is None:
+            raise Exception("Database connection not open")
+
+        cur = self.conn.cursor(name="stream_%s" % shortuuid.uuid().lower())
+        cur.itersize = size
+        try:
+            if self._trace:
+                log.info(cur.mogrify(sql, vals).decode("utf-8"))
+            cur.execute(sql, vals)
+            yield from cur
+        finally:
+            cur.close()
+
     def single(self, sql: str, *vals: Any, **dvals: Any) -> Any:
         if self.cur is None:
             raise Exception("Database connection not open")
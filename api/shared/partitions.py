@@ -0,0 +1,275 @@
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from .db import DB
+from .log import get_logger
+
+log = get_logger()
+
+STATS_RETENTION_DAYS = 90
+TRACKING_RETENTION_DAYS = 367
+
+# number of monthly partitions created in advance of the current month
+PARTITIONS_AHEAD = 3
+
+DELETE_BATCH_SIZE = 10000
+
+# table name -> retention in days. Every table here is range partitioned by
+# month on its ts column, so retention drops whole partitions.
+PARTITIONED_TABLES: Dict[str, int] = {
+    "statlogs2": STATS_RETENTION_DAYS,
+    "hourstats": STATS_RETENTION_DAYS,
+    "statmsgs": STATS_RETENTION_DAYS,
+    "txnstats": STATS_RETENTION_DAYS,
+    "txnstatmsgs": STATS_RETENTION_DAYS,
+    "txnsends": STATS_RETENTION_DAYS,
+    "sesmessages": TRACKING_RETENTION_DAYS,
+    "eltracking": TRACKING_RETENTION_DAYS,
+    "smtptracking": TRACKING_RETENTION_DAYS,
+    "deliverystats_hourly": STATS_RETENTION_DAYS,
+    "deliverystats_daily": STATS_RETENTION_DAYS,
+    "deliverymsgs_hourly": STATS_RETENTION_DAYS,
+    "campstats_hourly": STATS_RETENTION_DAYS,
+    "campstats_daily": STATS_RETENTION_DAYS,
+}
+
+# statlogs2 stores ts as ISO 8601 text, which is partitioned using the "C"
+# collation so that string order matches time order.
+TEXT_TS_TABLES = ("statlogs2",)
+
+# Tables whose uniqueness does not include ts (first open/click per contact,
+# first event per transactional message, one provider tracking row per
+# message) can't be partitioned by time without losing that guarantee; they
+# are expired in small batches instead.
+BATCH_EXPIRED_TABLES: Dict[str, int] = {
+    "camplogs": TRACKING_RETENTION_DAYS,
+    "txnlogs": TRACKING_RETENTION_DAYS,
+    "sptracking": TRACKING_RETENTION_DAYS,
+    "mgtracking": TRACKING_RETENTION_DAYS,
+}
+
+# rows kept past their retention period; a campaign's camplogs are removed by
+# its archival once the archive has been verified
+BATCH_EXPIRED_KEEP: Dict[str, str] = {
+    "camplogs": "campid = any(array(select id from campaigns where data ? 'archive_stage'))",
+}
+
+_bound_re = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(d: datetime) -> datetime:
+    return datetime(d.year, d.month, 1)
+
+
+def add_months(d: datetime, months: int) -> datetime:
+    m = d.month - 1 + months
+    return datetime(d.year + m // 12, m % 12 + 1, 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return "%s_p%s" % (table, start.strftime("%Y%m"))
+
+
+def legacy_name(table: str) -> str:
+    return "%s_legacy" % table
+
+
+def is_partitioned(db: DB, table: str) -> bool:
+    return bool(
+        db.single(
+            """select exists (select from pg_partitioned_table p join pg_class c on c.oid = p.partrelid
+                              where c.relname = %s and c.relnamespace = 'public'::regnamespace)""",
+            table,
+        )
+    )
+
+
+def list_partitions(db: DB, table: str) -> List[Tuple[str, datetime | None]]:
+    """Returns (name, upper bound) for each partition of table; the upper
+    bound is None for a partition that is unbounded above."""
+    ret: List[Tuple[str, datetime | None]] = []
+    for name, bound in db.execute(
+        """select c.relname, pg_get_expr(c.relpartbound, c.oid)
+           from pg_inherits i join pg_class c on c.oid = i.inhrelid
+           where i.inhparent = ('public.' || quote_ident(%s))::regclass
+           order by c.relname""",
+        table,
+    ).fetchall():
+        m = _bound_re.search(bound)
+        if m is None:
+            ret.append((name, None))
+        else:
+            ret.append((name, datetime.fromisoformat(m.group(1).rstrip("Z")[:19])))
+    return ret
+
+
+def create_partition(db: DB, table: str, start: datetime) -> None:
+    end = add_months(start, 1)
+    db.execute(
+        'create table if not exists public."%s" partition of public."%s" for values from (%%s) to (%%s)'
+        % (partition_name(table, start), table),
+        start.strftime("%Y-%m-%d"),
+        end.strftime("%Y-%m-%d"),
+    )
+
+
+def create_partitions_since(
+    db: DB, table: str, since: datetime, ahead: int = PARTITIONS_AHEAD
+) -> None:
+    start = month_start(since)
+    end = add_months(month_start(datetime.utcnow()), ahead)
+    while start <= end:
+        create_partition(db, table, start)
+        start = add_months(start, 1)
+
+
+def ensure_partitions(db: DB, ahead: int = PARTITIONS_AHEAD) -> None:
+    now = month_start(datetime.utcnow())
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(db, table):
+            continue
+        covered = max(
+            (b for _, b in list_partitions(db, table) if b is not None),
+            default=now,
+        )
+        # start from the first uncovered month so a missed run leaves no gaps
+        start = min(month_start(covered), now)
+        while start <= add_months(now, ahead):
+            if start >= covered:
+                log.info("Creating partition %s", partition_name(table, start))
+                create_partition(db, table, start)
+            start = add_months(start, 1)
+
+
+def delete_batches(db: DB, table: str, where: str, *args: Any) -> None:
+    """Deletes the rows of table matching where a batch at a time, so no
+    single statement holds its locks or bloats the WAL for long."""
+    while True:
+        deleted = db.execute(
+            """delete from public."%s" where ctid = any(array(
+                   select ctid from public."%s" where %s limit %%s))"""
+            % (table, table, where),
+            *args,
+            DELETE_BATCH_SIZE,
+        ).rowcount
+        if deleted < DELETE_BATCH_SIZE:
+            break
+
+
+def drop_expired_partitions(db: DB) -> None:
+    for table, days in PARTITIONED_TABLES.items():
+        if not is_partitioned(db, table):
+            continue
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        for name, upper in list_partitions(db, table):
+            if upper is not None and upper <= cutoff:
+                log.info("Dropping expired partition %s", name)
+                db.execute('drop table public."%s"' % name)
+            elif name == legacy_name(table):
+                # the legacy partition holds everything from before the
+                # conversion, so it would only be dropped a full retention
+                # period after its newest row; its older rows go in batches
+                if table in TEXT_TS_TABLES:
+                    delete_batches(db, name, "ts < %s", cutoff.isoformat() + "Z")
+                else:
+                    delete_batches(db, name, "ts < %s", cutoff)
+
+
+def delete_expired_rows(db: DB) -> None:
+    for table, days in BATCH_EXPIRED_TABLES.items():
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        where = "ts < %s"
+        if table in BATCH_EXPIRED_KEEP:
+            where += " and not (%s)" % BATCH_EXPIRED_KEEP[table]
+        delete_batches(db, table, where, cutoff)
+
+
+def convert_to_partitioned(db: DB, table: str) -> None:
+    """Converts an existing table into a monthly range partitioned table. The
+    existing rows stay in place as a single "<table>_legacy" partition covering
+    everything before the first monthly partition, so no data is copied; its
+    rows are expired in batches until it ages past the retention period and is
+    dropped like any other partition."""
+    if is_partitioned(db, table):
+        return
+
+    legacy = legacy_name(table)
+
+    db.execute('alter table public."%s" rename to "%s"' % (table, legacy))
+
+    constraints = db.execute(
+        """select conname, contype, array(select a.attname from unnest(conkey) with ordinality k(attnum, ord)
+                                           join pg_attribute a on a.attrelid = conrelid and a.attnum = k.attnum
+                                           order by k.ord)
+           from pg_constraint where conrelid = ('public.' || quote_ident(%s))::regclass and contype in ('p', 'u')""",
+        legacy,
+    ).fetchall()
+    indexes = db.execute(
+        """select i.indexname, i.indexdef from pg_indexes i
+           where i.schemaname = 'public' and i.tablename = %s
+           and not exists (select from pg_constraint c where c.conname = i.indexname and c.conrelid = ('public.' || quote_ident(%s))::regclass)""",
+        legacy,
+        legacy,
+    ).fetchall()
+
+    for name, _, _ in constraints:
+        db.execute(
+            'alter table public."%s" rename constraint "%s" to "%s_legacy"'
+            % (legacy, name, name)
+        )
+    for name, _ in indexes:
+        db.execute('alter index public."%s" rename to "%s_legacy"' % (name, name))
+
+    if table in TEXT_TS_TABLES:
+        db.execute('delete from public."%s" where ts is null' % legacy)
+        db.execute(
+            'alter table public."%s" alter column ts type text collate "C"' % legacy
+        )
+    db.execute('alter table public."%s" alter column ts set not null' % legacy)
+
+    db.execute(
+        'create table public."%s" (like public."%s" including defaults including storage) partition by range (ts)'
+        % (table, legacy)
+    )
+
+    for name, contype, cols in constraints:
+        if "ts" not in cols:
+            cols = list(cols) + ["ts"]
+        db.execute(
+            'alter table public."%s" add constraint "%s" %s (%s)'
+            % (
+                table,
+                name,
+                "primary key" if contype == "p" else "unique",
+                ", ".join(cols),
+            )
+        )
+    for _, indexdef in indexes:
+        db.execute(
+            indexdef.replace(" ON public.%s " % legacy, " ON public.%s " % table, 1)
+        )
+
+    start = add_months(month_start(datetime.utcnow()), 1)
+    maxts = db.single('select max(ts) from public."%s"' % legacy)
+    if maxts is not None:
+        if isinstance(maxts, str):
+            maxts = datetime.fromisoformat(maxts.rstrip("Z")[:19])
+        start = max(start, add_months(month_start(maxts), 1))
+
+    # keys without ts are superseded by the (..., ts) keys built while
+    # attaching, and a partition can't carry a second primary key
+    for name, _, cols in constraints:
+        if "ts" not in cols:
+            db.execute(
+                'alter table public."%s" drop constraint "%s_legacy"' % (legacy, name)
+            )
+
+    db.execute(
+        'alter table public."%s" attach partition public."%s" for values from (minvalue) to (%%s)'
+        % (table, legacy),
+        start.strftime("%Y-%m-%d"),
+    )
+
+    for i in range(PARTITIONS_AHEAD + 1):
+        create_partition(db, table, add_months(start, i))
@@ -1,12 +1,23 @@
-import hashlib
 import dateutil.parser
 import shortuuid
 import os
-from typing import TypeAlias, Tuple, Dict, Any, List, Set, cast, Sequence
+import re
+from typing import (
+    TypeAlias,
+    Tuple,
+    Dict,
+    Any,
+    List,
+    Set,
+    cast,
+    Sequence,
+    Iterable,
+    Iterator,
+)
 from fnmatch import fnmatch
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
-from .utils import djb2, md5re, unix_time_secs
+from .utils import unix_time_secs
 from .log import get_logger
 from .db import DB, JsonObj
 
@@ -166,29 +177,30 @@ def get_segment_sentrows(
     return ret
 
 
-def supp_rows(
-    db: DB, cid: str, hashval: int, hashlimit: int, suppfactors: List[str]
+def supp_digests(
+    db: DB, cid: str, suppfactors: List[str], digests: Iterable[str]
 ) -> Set[str]:
-    supprows = set()
-
-    for (email,) in db.execute(
-        f"""
-        select c.email
-        from contacts."contacts_{cid}" c
-        join contacts."contact_supplists_{cid}" s on s.contact_id = c.contact_id
-        where s.supplist_id = any(%s)
-        and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
-        and ({hashlimit} = 1 or mod(s.contact_id, {hashlimit}) = %s)
-    """,
-        suppfactors,
-        hashval,
-        hashval,
-    ):
-        if md5re.search(email):
-            supprows.add(email)
-        else:
-            supprows.add(hashlib.md5(email.encode("utf-8")).hexdigest())
-    return supprows
+    """Returns the md5 digests from digests that belong to any of the
+    suppression lists in suppfactors, probing the tenant's
+    contact_suppdigests index rather than loading the lists."""
+    if not suppfactors:
+        return set()
+    digests = list(digests)
+    if not digests:
+        return set()
+    return set(
+        digest
+        for (digest,) in db.execute(
+            f"""
+            select distinct replace(digest::text, '-', '')
+            from contacts."contact_suppdigests_{cid}"
+            where supplist_id = any(%s)
+            and digest = any(%s::uuid[])
+        """,
+            suppfactors,
+            digests,
+        )
+    )
 
 
 def tag_set(row: JsonObj) -> JsonObj:
@@ -197,29 +209,47 @@ def tag_set(row: JsonObj) -> JsonObj:
     return row
 
 
-def get_segment_rows(
-    db: DB,
+def _segment_rows_query(
     cid: str,
     hashval: int,
     listfactors: List[str],
     hashlimit: int,
-    rowset: Set[str] | None = None,
-) -> List[JsonObj]:
-    ret = []
-
+    rowset: Set[str] | None,
+    counted: bool,
+    search: str | None = None,
+) -> Tuple[str, List[Any]]:
     rowsetexpr = ""
     rowsetargs = []
     if rowset is not None:
         rowsetexpr = "and c.email = any(%s)"
         rowsetargs = [list(rowset)]
 
+    # a search narrows every part of the query to the contacts whose email,
+    # properties or tags contain the text, using the trigram indexes on both
+    matchedcte = ""
+    matchedexpr = ""
+    searchargs = []
+    if search is not None:
+        matchedcte = f"""
+        matched as (
+            select contact_id from contacts."contacts_{cid}"
+            where lower(email || ' ' || props::text) like %s
+            union
+            select contact_id from contacts."contact_values_{cid}"
+            where type = 'tag' and lower(value) like %s
+        ),"""
+        matchedexpr = "and c.contact_id in (select contact_id from matched)"
+        pattern = "%%%s%%" % re.sub(r"([\\%_])", r"\\\1", search)
+        searchargs = [pattern, pattern]
+
     alternate_plan = os.environ.get("alternate_contact_plan")
 
-    ret = [
-        tag_set(row)
-        for row, in db.execute(
-            f"""
-        with values as (
+    # rows come back in djb2 order of their email, which is random but
+    # reproducible, so that the counts of subsets remain consistent. Contacts
+    # the email_hash backfill hasn't reached yet are hashed here.
+    sql = f"""
+        with {matchedcte}
+        values as (
             select
                 c.contact_id,
                 array_agg(distinct value) filter (where type = 'tag') as tags,
@@ -234,6 +264,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {matchedexpr}
             group by c.contact_id
         ),
         open_logs as (
@@ -245,6 +276,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {matchedexpr}
             group by c.contact_id
         ),
         click_logs as (
@@ -256,6 +288,7 @@ def get_segment_rows(
             where l.list_id = any(%s)
             and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
             {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
+            {matchedexpr}
             group by c.contact_id
         )
         select c.props ||
@@ -263,6 +296,7 @@ def get_segment_rows(
                 'Email', jsonb_build_array(c.email),
                 '!!added', jsonb_build_array(c.added),
                 '!!added_index', jsonb_build_array(row_number() over (order by c.added, c.email) - 1),
+                '!!hash', jsonb_build_array(coalesce(c.email_hash, contacts.djb2(c.email))),
                 '!!list', array_agg(distinct l.list_id),
                 '!!open-logs', coalesce(op.open_logs, '{{}}'),
                 '!!click-logs', coalesce(cl.click_logs, '{{}}'),
@@ -275,6 +309,7 @@ def get_segment_rows(
                 '!!region', coalesce(v.region, '{{}}'),
                 '!!zip', coalesce(v.zip,  '{{}}')
             )
+            {', count(*) over ()' if counted else ''}
         from contacts."contacts_{cid}" c
         join contacts."contact_lists_{cid}" l on l.contact_id = c.contact_id
         left join values v on v.contact_id = c.contact_id
@@ -284,29 +319,57 @@ def get_segment_rows(
         and ({hashlimit} = 1 or mod(c.contact_id, {hashlimit}) = %s)
         {f'and %s >= 0' if alternate_plan else f'and ({hashlimit} = 1 or mod(l.contact_id, {hashlimit}) = %s)'}
         {rowsetexpr}
-        group by c.email, c.added, c.props, op.open_logs, cl.click_logs, op.max_open_ts, cl.max_click_ts, v.tags, v.device, v.os, v.browser, v.country, v.region, v.zip
-    """,
-            listfactors,
-            hashval,
-            hashval,
-            listfactors,
-            hashval,
-            hashval,
-            listfactors,
-            hashval,
-            hashval,
-            listfactors,
-            hashval,
-            hashval,
-            *rowsetargs,
-        )
+        {matchedexpr}
+        group by c.email, c.added, c.props, c.email_hash, op.open_logs, cl.click_logs, op.max_open_ts, cl.max_click_ts, v.tags, v.device, v.os, v.browser, v.country, v.region, v.zip
+        order by coalesce(c.email_hash, contacts.djb2(c.email)), c.email
+    """
+    args = [
+        *searchargs,
+        listfactors,
+        hashval,
+        hashval,
+        listfactors,
+        hashval,
+        hashval,
+        listfactors,
+        hashval,
+        hashval,
+        listfactors,
+        hashval,
+        hashval,
+        *rowsetargs,
     ]
+    return sql, args
 
-    # sort in random but reproducible order so that the counts of subsets
-    # remain consistent
-    ret.sort(key=lambda r: djb2(r["Email"][0]))
 
-    return ret
+def get_segment_rows(
+    db: DB,
+    cid: str,
+    hashval: int,
+    listfactors: List[str],
+    hashlimit: int,
+    rowset: Set[str] | None = None,
+    search: str | None = None,
+) -> List[JsonObj]:
+    sql, args = _segment_rows_query(
+        cid, hashval, listfactors, hashlimit, rowset, False, search
+    )
+    return [tag_set(row) for row, in db.execute(sql, *args)]
+
+
+def stream_segment_rows(
+    db: DB,
+    cid: str,
+    hashval: int,
+    listfactors: List[str],
+    hashlimit: int,
+) -> Iterator[Tuple[JsonObj, int]]:
+    """Yields the same rows as get_segment_rows, each with the number of rows
+    in the bucket, without holding them all in memory. Must be consumed
+    inside a transaction on db."""
+    sql, args = _segment_rows_query(cid, hashval, listfactors, hashlimit, None, True)
+    for row, numrows in db.stream(sql, *args):
+        yield tag_set(row), numrows
 
 
 def segment_eval_part_all(
@@ -777,7 +840,7 @@ def segment_eval_parts(
             trace(cache, "numrows = %s, returning %s", numrows, retval)
             return retval
         else:
-            hashval = djb2(row["Email"][0])
+            hashval = row["!!hash"][0]
             retval = hashval <= 0xFFFFFFFF * pct
             if retval:
                 segcounts[sub["id"]] = segcounts.get(sub["id"], 0) + 1
@@ -102,6 +102,99 @@ def send_rate(company: JsonObj) -> Tuple[int, bytes | None]:
     return int(rdb.get(daykey) or 0), rdb.get(limithitkey)
 
 
+# how long workers share a campaign's cancellation status before it is read
+# from the campaign again; canceling a campaign replaces it at once
+CAMP_STATUS_SECS = 15
+CAMP_CANCELED_SECS = 7 * 24 * 60 * 60
+
+# MTA queue reports are written to the database at most this often per sink,
+# and whenever a sink's queue drains
+SINK_QUEUE_FLUSH_SECS = 30
+
+
+def campaign_canceled(db: DB, campid: str) -> bool:
+    """Returns whether the campaign has been canceled, reading the campaign
+    row only when no worker has done so in the last CAMP_STATUS_SECS."""
+    rdb = redis_connect()
+    key = "campcanceled-%s" % campid
+    status = rdb.get(key)
+    if status is not None:
+        return bool(status == b"1")
+    canceled = bool(
+        db.single(
+            "select (data->>'canceled')::boolean from campaigns where id = %s",
+            campid,
+        )
+    )
+    # nx so that a cancellation recorded meanwhile is not overwritten
+    rdb.set(
+        key,
+        "1" if canceled else "0",
+        nx=True,
+        ex=CAMP_CANCELED_SECS if canceled else CAMP_STATUS_SECS,
+    )
+    return canceled
+
+
+def set_campaign_canceled(campid: str) -> None:
+    """Tells every worker sending the campaign that it has been canceled.
+    Call after the cancellation is committed to the campaign."""
+    redis_connect().set("campcanceled-%s" % campid, "1", ex=CAMP_CANCELED_SECS)
+
+
+def sink_complete(db: DB, campid: str, sinkid: str) -> None:
+    """Records that the sink has finished sending the campaign, and the
+    campaign as finished once every sink has. Repeated reports for the same
+    sink leave the campaign row alone."""
+    db.execute(
+        """update campaigns set data = data || jsonb_build_object('sinkstatus', (data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)) ||
+                  case when 'false'::jsonb in (select value from jsonb_each((data->>'sinkstatus')::jsonb || jsonb_build_object(%s, true)))
+                  then '{}'::jsonb else jsonb_build_object('finished_at', %s) end
+           where id = %s and (data->'sinkstatus'->%s) is distinct from 'true'::jsonb""",
+        sinkid,
+        sinkid,
+        datetime.utcnow().isoformat() + "Z",
+        campid,
+        sinkid,
+    )
+
+
+def record_sink_queues(
+    db: DB, sinkid: str, queue: int, domainqueues: Dict[str, int] | None
+) -> None:
+    """Stores the queue sizes an MTA reported. Reports arrive every few
+    seconds per sink, so they are only written every SINK_QUEUE_FLUSH_SECS,
+    or when the queue has drained, and then only the rows that changed."""
+    if queue and not redis_connect().set(
+        "sinkqueueflush-%s" % sinkid, "1", nx=True, ex=SINK_QUEUE_FLUSH_SECS
+    ):
+        return
+
+    domains = list((domainqueues or {}).keys())
+    with db.transaction():
+        db.execute(
+            "update sinks set data = data || jsonb_build_object('queue', %s) where id = %s and data->'queue' is distinct from to_jsonb(%s)",
+            queue,
+            sinkid,
+            queue,
+        )
+        db.execute(
+            "delete from sinkdomainqueues where sinkid = %s and domain <> all(%s::text[])",
+            sinkid,
+            domains,
+        )
+        if len(domains):
+            db.execute(
+                """insert into sinkdomainqueues (sinkid, domain, queue)
+                   select %s, domain, queue from unnest(%s::text[], %s::bigint[]) as q (domain, queue)
+                   on conflict (sinkid, domain) do update set queue = excluded.queue
+                   where sinkdomainqueues.queue is distinct from excluded.queue""",
+                sinkid,
+                domains,
+                [domainqueues[d] for d in domains] if domainqueues else [],
+            )
+
+
 def check_test_limit(db: DB, company: JsonObj, email: str) -> None:
     cid = company["id"]
     paid = company.get("paid", False)
@@ -291,46 +384,38 @@ def check_send_limit(
     with rdb.pipeline() as pipe:
         while True:
             try:
-                pipe.watch(minkey)
-                pipe.watch(hourkey)
-                pipe.watch(daykey)
-                pipe.watch(monthkey)
-                pipe.watch(domainminkey)
-                pipe.watch(domainhourkey)
-                pipe.watch(domaindaykey)
+                # one round trip to watch every counter and one to read them
+                watchkeys = [
+                    minkey,
+                    hourkey,
+                    daykey,
+                    monthkey,
+                    domainminkey,
+                    domainhourkey,
+                    domaindaykey,
+                ]
                 if paid:
-                    pipe.watch(creditskey)
-                    pipe.watch(creditsexpirekey)
-
-                pipemin: bytes | None = cast(bytes | None, pipe.get(minkey))
-                pipehour: bytes | None = cast(bytes | None, pipe.get(hourkey))
-                pipeday: bytes | None = cast(bytes | None, pipe.get(daykey))
-                pipemonth: bytes | None = cast(bytes | None, pipe.get(monthkey))
-
-                mincnt = int(pipemin or 0)
-                hourcnt = int(pipehour or 0)
-                daycnt = int(pipeday or 0)
-                monthcnt = int(pipemonth or 0)
+                    watchkeys.extend((creditskey, creditsexpirekey))
+                pipe.watch(*watchkeys)
+                counts = dict(zip(watchkeys, pipe.mget(watchkeys)))
+
+                mincnt = int(counts[minkey] or 0)
+                hourcnt = int(counts[hourkey] or 0)
+                daycnt = int(counts[daykey] or 0)
+                monthcnt = int(counts[monthkey] or 0)
                 domainmincnt = None
                 if domainminlimit is not None:
-                    pipedomainmin = cast(bytes | None, pipe.get(domainminkey))
-                    domainmincnt = int(pipedomainmin or 0)
+                    domainmincnt = int(counts[domainminkey] or 0)
                 domainhourcnt = None
                 if domainhourlimit is not None:
-                    pipedomainhour = cast(bytes | None, pipe.get(domainhourkey))
-                    domainhourcnt = int(pipedomainhour or 0)
+                    domainhourcnt = int(counts[domainhourkey] or 0)
                 domaindaycnt = None
                 if domaindaylimit is not None:
-                    pipedomainday = cast(bytes | None, pipe.get(domaindaykey))
-                    domaindaycnt = int(pipedomainday or 0)
+                    domaindaycnt = int(counts[domaindaykey] or 0)
                 creditcnt, creditexpirecnt = 0, 0
                 if paid:
-                    pipecredits: bytes | None = cast(bytes | None, pipe.get(creditskey))
-                    pipecreditsexpire: bytes | None = cast(
-                        bytes | None, pipe.get(creditsexpirekey)
-                    )
-                    creditcnt = int(pipecredits or 0)
-                    creditexpirecnt = int(pipecreditsexpire or 0)
+                    creditcnt = int(counts[creditskey] or 0)
+                    creditexpirecnt = int(counts[creditsexpirekey] or 0)
 
                 daylimitok = daylimit is not None and daycnt < daylimit
 
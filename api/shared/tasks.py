@@ -2,11 +2,12 @@ import os
 import logging
 import sys
 from typing import Any
-from celery import Celery
+from celery import Celery, Task
 from celery.signals import after_setup_task_logger, after_setup_logger, task_prerun
 from celery.app.log import TaskFormatter  # type: ignore
 from .log import FORMAT, DATEFMT, LEVEL
 from . import config
+from .utils import load_task_arg
 
 MAX_QUEUE = 20
 MAX_CPU = 80
@@ -17,8 +18,21 @@ LOW_PRIORITY = 9
 
 TASKFORMAT = "%(asctime)s.%(msecs)03d %(levelname)s [%(process)d] %(module)s.%(funcName)s[%(task_id)s]:%(lineno)d: %(message)s"
 
+
+class RefArgsTask(Task):  # type: ignore
+    """Resolves arguments that run_task moved out of the message into the
+    task argument store before the task body runs."""
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        return super().__call__(
+            *[load_task_arg(a) for a in args],
+            **{k: load_task_arg(v) for k, v in kwargs.items()},
+        )
+
+
 tasks = Celery(
     "tasks",
+    task_cls=RefArgsTask,
     broker="%s://%s:%s@%s/%s"
     % (
         os.environ["queue_proto"],
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import msgpack
 import json
 import base64
@@ -8,6 +9,8 @@ import hashlib
 import requests
 import string
 import time
+import heapq
+import tempfile
 from functools import wraps
 import falcon
 import redis
@@ -18,8 +21,9 @@ from dateutil.tz import tzutc, tzlocal, tzoffset
 from io import StringIO, IOBase
 from random_words.random_words import Random as RandomWordDB
 from urllib.parse import urlparse
+from kombu.utils import json as kombu_json
 from html import escape as html_escape
-from typing import Tuple, Dict, List, Any, cast, Callable
+from typing import Tuple, Dict, List, Any, cast, Callable, IO, Iterator
 
 from .db import json_iter, json_obj, JsonObj, DB
 from .s3 import s3_write, s3_size
@@ -42,6 +46,14 @@ GIF = b"\x47\x49\x46\x38\x39\x61\x01\x00\x01\x00\x80\x01\x00\x00\x00\x00\xFF\xFF
 
 rdb: redis.StrictRedis | None = None  # type: ignore
 
+# per process limits; callers share the pool across threads and wait for a
+# free connection rather than each opening their own
+REDIS_POOL_SIZE = int(os.environ.get("redis_pool_size", 32))
+# seconds to wait for a connection when the pool is exhausted
+REDIS_POOL_TIMEOUT = float(os.environ.get("redis_pool_timeout", 30))
+# idle connections are pinged before use after this many seconds
+REDIS_CHECK_SECS = 30
+
 
 def check_plan_limits(db: Any, cid: str, check_type: str = "send", count: int = 1) -> None:
     """Check if the current company is within plan limits.
@@ -349,18 +361,6 @@ def get_funnels(
     return tagret, respret
 
 
-def insert_funnel_tag(
-    db: DB,
-    cid: str,
-    email: str,
-    tag: str,
-    funnels: Dict[str, List[JsonObj]],
-    funnelcounts: Dict[str, int],
-) -> None:
-    for funnel in funnels.get(tag, ()):
-        insert_funnel(db, cid, email, funnel, 0, funnelcounts)
-
-
 def funnel_next_time(m: JsonObj) -> datetime:
     offset = m["dayoffset"]
     days = m["days"]
@@ -441,8 +441,49 @@ def insert_funnel(
         funnelcounts[funnel["id"]] = funnelcounts.get(funnel["id"], 0) + 1
 
 
+def insert_funnel_bulk(
+    db: DB,
+    cid: str,
+    email_contact_ids: List[Tuple[str, int]],
+    funnel: JsonObj,
+    index: int,
+    funnelcounts: Dict[str, int] | None,
+) -> None:
+    if not len(email_contact_ids):
+        return
+
+    if not funnel.get("multiple", False):
+        # make sure they werent sent this message already
+        notsent = ""
+    else:
+        # make sure they arent about to be sent this message already
+        notsent = "and not q.sent"
+
+    # everyone enrolled together is due at the same time
+    ts = funnel_next_time(funnel["messages"][index])
+
+    cnt = db.execute(
+        f"""
+        insert into funnelqueue (email, rawhash, messageid, domain, ts, cid)
+        select c.email, c.contact_id, %s, split_part(c.email, '@', 2), %s, %s
+        from unnest(%s::text[], %s::bigint[]) c(email, contact_id)
+        where not exists (
+            select 1 from funnelqueue q where q.email = c.email and q.messageid = %s {notsent}
+        )
+    """,
+        funnel["messages"][index]["id"],
+        ts,
+        cid,
+        [email for email, _ in email_contact_ids],
+        [contact_id for _, contact_id in email_contact_ids],
+        funnel["messages"][index]["id"],
+    ).rowcount
+    if funnelcounts is not None and cnt:
+        funnelcounts[funnel["id"]] = funnelcounts.get(funnel["id"], 0) + cnt
+
+
 def incr_funnel_counts(db: DB, funnelcounts: Dict[str, int]) -> None:
-    for fid, cnt in funnelcounts.items():
+    for fid, cnt in sorted(funnelcounts.items()):
         db.execute(
             "update funnels set data = data || jsonb_build_object('count', (data->>'count')::integer + %s) where id = %s",
             cnt,
@@ -577,13 +618,31 @@ def redis_connect() -> Any:
     global rdb
     if rdb is None:
         rdb = redis.StrictRedis(
-            host=os.environ["redis_host"],
-            port=int(os.environ["redis_port"]),
-            password=os.environ["redis_pass"],
+            connection_pool=redis.BlockingConnectionPool(
+                host=os.environ["redis_host"],
+                port=int(os.environ["redis_port"]),
+                password=os.environ["redis_pass"],
+                max_connections=REDIS_POOL_SIZE,
+                timeout=REDIS_POOL_TIMEOUT,
+                socket_keepalive=True,
+                health_check_interval=REDIS_CHECK_SECS,
+            )
         )
     return rdb
 
 
+def pop_batch(rdb: redis.StrictRedis, lname: str, count: int) -> List[bytes]:  # type: ignore
+    """Takes up to count of the oldest items off an lpush queue in one
+    MULTI/EXEC so that any number of consumers can drain it in parallel
+    without seeing the same item twice."""
+    pipe = rdb.pipeline()
+    pipe.lrange(lname, -count, -1)
+    pipe.ltrim(lname, 0, -count - 1)
+    items = pipe.execute()[0]
+    items.reverse()
+    return items  # type: ignore
+
+
 def djb2(s: str) -> int:
     h = 5381
     for x in s.encode("utf-8"):
@@ -652,6 +711,73 @@ class MPDictReader(object):
             raise StopIteration()
 
 
+class ExternalSorter(object):
+    """Sorts items by key the way list.sort does, stable and optionally
+    reversed, keeping up to budget bytes of msgpack encoded items in memory
+    and spilling sorted runs to temporary files past that. Keys and items
+    must be msgpack serializable."""
+
+    def __init__(self, budget: int, reverse: bool = False) -> None:
+        self.budget = budget
+        self.reverse = reverse
+        self.count = 0
+        # (key, item) pairs are held packed and counted with their object
+        # overhead, so the budget is what they really take up; unpacked rows
+        # are several times larger
+        self._items: List[bytes] = []
+        self._size = 0
+        self._runs: List[IO[bytes]] = []
+
+    def add(self, key: Any, item: Any) -> None:
+        packed = msgpack.packb((key, item))
+        self._items.append(packed)
+        self._size += sys.getsizeof(packed)
+        self.count += 1
+        if self._size > self.budget:
+            self._spill()
+
+    def _sort(self) -> None:
+        self._items.sort(
+            key=lambda b: msgpack.unpackb(b, strict_map_key=False)[0],
+            reverse=self.reverse,
+        )
+
+    def _spill(self) -> None:
+        self._sort()
+        run = tempfile.TemporaryFile()
+        for packed in self._items:
+            run.write(packed)
+        run.seek(0)
+        self._runs.append(run)
+        self._items = []
+        self._size = 0
+
+    def _read_run(self, run: IO[bytes]) -> Iterator[Tuple[Any, Any]]:
+        try:
+            for key, item in msgpack.Unpacker(run, strict_map_key=False):
+                yield key, item
+        finally:
+            run.close()
+
+    def __iter__(self) -> Iterator[Any]:
+        if not self._runs:
+            self._sort()
+            for packed in self._items:
+                yield msgpack.unpackb(packed, strict_map_key=False)[1]
+            return
+
+        if self._items:
+            self._spill()
+        # merge keeps items from earlier runs first when keys are equal, so
+        # the result is still stable
+        for _, item in heapq.merge(
+            *[self._read_run(run) for run in self._runs],
+            key=lambda i: i[0],
+            reverse=self.reverse,
+        ):
+            yield item
+
+
 urlstartre = re.compile(r"^[a-zA-Z]+:")
 linkre = re.compile(r'(<\s*a\s+[^>]*href\s*=\s*")([^"]+)("[^>]*>)', re.I)
 imgre = re.compile(r'(<\s*img\s+[^>]*src\s*=\s*")(data:[^"]+)', re.I)
@@ -755,9 +881,54 @@ def unescape(s: str) -> str:
     return s
 
 
-# there is only one instance of chrome running so we must use a lock
-# to prevent concurrent access
+SCREENSHOT_URL = os.environ.get("screenshot_url", "http://screenshot:4000")
+
+# the screenshot service renders each request in its own browser tab; this
+# bounds how many it is asked to render at once across all workers
+SCREENSHOT_CONCURRENCY = max(1, int(os.environ.get("screenshot_concurrency", 4)))
+
+# advisory lock class ids: renders hold one of SCREENSHOT_CONCURRENCY slot
+# locks, and a lock keyed on the content hash so that identical content is
+# only rendered once at a time
 GEN_SCREENSHOT_LOCK = 48127569
+SCREENSHOT_CONTENT_LOCK = 48127570
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def screenshot_slot(db: DB) -> None:
+    """Waits for one of the screenshot render slots and holds it until the
+    current transaction ends."""
+    while True:
+        for slot in random.sample(
+            range(SCREENSHOT_CONCURRENCY), SCREENSHOT_CONCURRENCY
+        ):
+            if db.single(
+                "select pg_try_advisory_xact_lock(%s, %s)", GEN_SCREENSHOT_LOCK, slot
+            ):
+                return
+        time.sleep(0.2)
+
+
+def render_screenshot(html: str, width: int) -> bytes:
+    filename = "tmp/%s.html" % shortuuid.uuid()
+
+    s3_write(os.environ["s3_transferbucket"], filename, html.encode("utf-8"))
+
+    url = f"http://proxy/transfer/{filename}"
+
+    resp = requests.post(SCREENSHOT_URL, json={"url": url, "width": width}, timeout=15)
+    if resp.status_code > 299:
+        log.error("Screenshot error: %s", resp.text)
+    resp.raise_for_status()
+
+    # the image is cached for good under its content hash, so anything that
+    # isn't a PNG must fail here rather than be written
+    png = base64.b64decode(resp.text)
+    if not png.startswith(PNG_SIGNATURE):
+        raise Exception("Screenshot service returned no image for %s" % url)
+
+    return png
 
 
 def gen_screenshot(db: DB, id: str, table: str, beefreeonly: bool = False) -> None:
@@ -772,61 +943,59 @@ def gen_screenshot(db: DB, id: str, table: str, beefreeonly: bool = False) -> No
         if t.get("type") and t["type"] != "beefree":
             return
 
-    with db.transaction():
-        db.execute(f"select pg_advisory_xact_lock({GEN_SCREENSHOT_LOCK})")
-
-        imagebucket = os.environ["s3_imagebucket"]
-        company = db.companies.get(t["cid"])
-        if company is not None:
-            parentcompany = db.companies.get(company["cid"])
-            if parentcompany is not None:
-                imagebucket = parentcompany.get("s3_imagebucket", imagebucket)
-
-        if not t.get("type"):
-            defaultBodyType = t.get("bodyStyle", {}).get("bodyType", "fixed")
-            defaultBodyWidth = t.get("bodyStyle", {}).get("bodyWidth", 580)
-            hasfull = defaultBodyType != "fixed"
-            bodyWidth = defaultBodyWidth
-
-            for part in t.get("parts", []):
-                bodyWidth = max(bodyWidth, part.get("bodyWidth", defaultBodyWidth))
-                hasfull = hasfull or (part.get("bodyType", defaultBodyType) != "fixed")
-
-            if hasfull and bodyWidth < 1024:
-                bodyWidth = 1024
-            elif bodyWidth < 750:
-                bodyWidth = 750
-
-            html, _ = generate_html(
-                db, t, "ss", imagebucket, noopens=True, nolinks=True, screenshot=True
-            )
-        else:
-            parsed = json.loads(t["rawText"])
-            html = parsed["html"]
-            bodyWidth = 1024
+    imagebucket = os.environ["s3_imagebucket"]
+    company = db.companies.get(t["cid"])
+    if company is not None:
+        parentcompany = db.companies.get(company["cid"])
+        if parentcompany is not None:
+            imagebucket = parentcompany.get("s3_imagebucket", imagebucket)
 
-        filename = "tmp/%s.html" % shortuuid.uuid()
+    if not t.get("type"):
+        defaultBodyType = t.get("bodyStyle", {}).get("bodyType", "fixed")
+        defaultBodyWidth = t.get("bodyStyle", {}).get("bodyWidth", 580)
+        hasfull = defaultBodyType != "fixed"
+        bodyWidth = defaultBodyWidth
 
-        s3_write(os.environ["s3_transferbucket"], filename, html.encode("utf-8"))
+        for part in t.get("parts", []):
+            bodyWidth = max(bodyWidth, part.get("bodyWidth", defaultBodyWidth))
+            hasfull = hasfull or (part.get("bodyType", defaultBodyType) != "fixed")
 
-        url = f"http://proxy/transfer/{filename}"
+        if hasfull and bodyWidth < 1024:
+            bodyWidth = 1024
+        elif bodyWidth < 750:
+            bodyWidth = 750
 
-        resp = requests.post(
-            "http://screenshot:4000", json={"url": url, "width": bodyWidth}, timeout=15
+        html, _ = generate_html(
+            db, t, "ss", imagebucket, noopens=True, nolinks=True, screenshot=True
         )
-        if resp.status_code > 299:
-            log.error("Screenshot error: %s", resp.text)
-        resp.raise_for_status()
+    else:
+        parsed = json.loads(t["rawText"])
+        html = parsed["html"]
+        bodyWidth = 1024
+
+    # images are named for the content they show, so saving unchanged content
+    # or duplicating a template reuses the existing image without a render
+    contenthash = hashlib.md5(("%s\n%s" % (bodyWidth, html)).encode("utf-8"))
+    filename = "ss-%s.png" % contenthash.hexdigest()
+    url = f"{get_webroot()}/i/{filename}"
 
-        b = base64.b64decode(resp.text)
+    with db.transaction():
+        db.execute(
+            "select pg_advisory_xact_lock(%s, %s)",
+            SCREENSHOT_CONTENT_LOCK,
+            int.from_bytes(contenthash.digest()[:4], "big", signed=True),
+        )
 
-        filename = "%s.png" % (hashlib.md5(b).hexdigest(),)
+        # an empty image is one cached by an earlier failed render
         try:
-            s3_size(imagebucket, filename)
+            cached = s3_size(imagebucket, filename) > 0
         except:
-            s3_write(imagebucket, filename, b)
-        url = f"{get_webroot()}/i/{filename}"
+            cached = False
+        if not cached:
+            screenshot_slot(db)
+            s3_write(imagebucket, filename, render_screenshot(html, bodyWidth))
 
+    if t.get("image") != url:
         db[table].patch(id, {"image": url})
 
 
@@ -919,13 +1088,84 @@ class RandomWords(RandomWordDB):  # type: ignore
 
 randomwords = RandomWords()
 
+# links rows already registered by this process, keyed on
+# (campaign, url, index, track); cleared once it holds LINK_CACHE_SIZE entries
+LINK_CACHE_SIZE = 100000
+
+_link_cache: Dict[Tuple[str, str, int, bool], str] = {}
+
+linkplaceholderre = re.compile(r"\x00(\d+)\x00")
+
+
+def link_scope(campid: str) -> str:
+    """Returns the value stored in links.campaign for a body rendered for
+    campid. Transactional ids are unique per message, so their links are
+    shared by every message sent with the same tag."""
+    if len(campid) > 30:
+        _, tagid = parse_txnid(campid)
+        return "txn-%s" % tagid
+    return campid
+
+
+def register_links(
+    db: DB, campid: str, links: List[Tuple[str, int, bool]]
+) -> List[str]:
+    """Returns the links row id for each (url, index, track), inserting the
+    missing rows with one statement. New ids are derived from the link's
+    content so the same link always gets the same id; rows registered before
+    that keep their original id."""
+    scope = link_scope(campid)
+
+    keys = [(scope, url, index, track) for url, index, track in links]
+    missing = list(set(key for key in keys if key not in _link_cache))
+
+    if missing:
+        ids = [
+            shortuuid.uuid(name="link:%s:%s:%s:%s" % (scope, index, track, url))
+            for scope, url, index, track in missing
+        ]
+        rows = db.execute(
+            """with new (id, url, campaign, index, track, ord) as (
+                   select * from unnest(%s::text[], %s::text[], %s::text[], %s::int[], %s::bool[]) with ordinality
+               ), ins as (
+                   insert into links (id, url, campaign, index, track)
+                   select id, url, campaign, index, track from new
+                   on conflict do nothing
+               )
+               select coalesce(l.id, new.id) from new
+               left join links l on l.url = new.url and l.campaign = new.campaign and l.index = new.index and l.track = new.track
+               order by new.ord""",
+            ids,
+            [url for _, url, _, _ in missing],
+            [scope for scope, _, _, _ in missing],
+            [index for _, _, index, _ in missing],
+            [track for _, _, _, track in missing],
+        ).fetchall()
+
+        if len(_link_cache) + len(missing) > LINK_CACHE_SIZE:
+            _link_cache.clear()
+        for key, (id,) in zip(missing, rows):
+            _link_cache[key] = id
+
+    return [_link_cache[key] for key in keys]
+
+
+def resolve_links(
+    db: DB, campid: str, links: List[Tuple[str, int, bool]], html: str
+) -> str:
+    """Replaces the placeholders left by newlink with registered link ids."""
+    if not links:
+        return html
+    ids = register_links(db, campid, links)
+    return linkplaceholderre.sub(lambda m: ids[int(m.group(1))], html)
+
 
 def newlink(
-    db: DB,
     cid: str,
     webroot: str,
     campid: str,
     linkurls: List[str],
+    links: List[Tuple[str, int, bool]],
     nolinks: bool,
     m: re.Match[str],
 ) -> str:
@@ -966,15 +1206,9 @@ def newlink(
         url = "http://%s" % url
 
     if not nolinks:
-        l = db.single(
-            """insert into links (id, url, campaign, index, track) values (%s, %s, %s, %s, %s)
-                         on conflict (url, campaign, index, track) do update set track = excluded.track returning id""",
-            shortuuid.uuid(),
-            url,
-            campid,
-            len(linkurls),
-            track,
-        )
+        # registered in bulk by resolve_links once the whole body is scanned
+        l = "\x00%d\x00" % len(links)
+        links.append((url, len(linkurls), track))
     else:
         l = "nl"
 
@@ -1012,11 +1246,13 @@ def raw_to_html(
     webroot = "{{!!webroot}}"
 
     linkurls: List[str] = []
+    links: List[Tuple[str, int, bool]] = []
 
-    nlfunc = lambda m: newlink(db, cid, webroot, campid, linkurls, nolinks, m)
+    nlfunc = lambda m: newlink(cid, webroot, campid, linkurls, links, nolinks, m)
     localimgfunc = lambda m: localimgurl(m, webroot)
 
     html = linkre.sub(nlfunc, rawText)
+    html = resolve_links(db, campid, links, html)
     html = localimgre.sub(localimgfunc, html)
 
     if not bodystartre.search(html):
@@ -1326,8 +1562,9 @@ def parts_to_html(
         return "%s%s" % (htmltag, url)
 
     linkurls: List[str] = []
+    links: List[Tuple[str, int, bool]] = []
 
-    nlfunc = lambda m: newlink(db, cid, webroot, campid, linkurls, nolinks, m)
+    nlfunc = lambda m: newlink(cid, webroot, campid, linkurls, links, nolinks, m)
     localimgfunc = lambda m: localimgurl(m, imageroot)
 
     containerend = ""
@@ -1342,6 +1579,7 @@ def parts_to_html(
 
     if not form:
         basehtml = linkre.sub(nlfunc, basehtml)
+        basehtml = resolve_links(db, campid, links, basehtml)
 
     basehtml = socialre.sub(socialfunc, basehtml)
     basehtml = imgre.sub(imgurl, basehtml)
@@ -1647,9 +1885,63 @@ def user_log(
     )
 
 
+# task arguments that serialize larger than this are kept in redis once, keyed
+# by a hash of their content, and the message carries only the reference
+TASK_ARG_INLINE_BYTES = 2048
+# long enough to outlast any backlog in the task queue
+TASK_ARG_TTL = 2 * SECS_IN_DAY
+TASK_ARG_CACHE_SIZE = 64
+TASK_ARG_REF = "__taskarg__"
+
+_task_args_loaded: Dict[str, bytes] = {}
+
+
+def _task_arg_key(h: str) -> str:
+    return "taskarg-%s" % h
+
+
+def store_task_arg(arg: Any) -> Any:
+    """Returns arg unchanged if it is small enough to travel in the task
+    message, otherwise stores it and returns a reference for
+    load_task_arg."""
+    if not isinstance(arg, (dict, list, tuple)):
+        return arg
+    data = kombu_json.dumps(arg).encode("utf-8")
+    if len(data) < TASK_ARG_INLINE_BYTES:
+        return arg
+
+    h = hashlib.sha1(data).hexdigest()
+    # a fan-out passes the same document to every task, so after the first
+    # write the stored copy only has its ttl extended
+    rdb = redis_connect()
+    if not rdb.expire(_task_arg_key(h), TASK_ARG_TTL):
+        rdb.set(_task_arg_key(h), data, ex=TASK_ARG_TTL)
+    return {TASK_ARG_REF: h}
+
+
+def load_task_arg(arg: Any) -> Any:
+    if not isinstance(arg, dict) or len(arg) != 1 or TASK_ARG_REF not in arg:
+        return arg
+
+    h = arg[TASK_ARG_REF]
+    data = _task_args_loaded.get(h)
+    if data is None:
+        data = redis_connect().get(_task_arg_key(h))
+        if data is None:
+            raise Exception("task argument %s has expired" % h)
+        if len(_task_args_loaded) >= TASK_ARG_CACHE_SIZE:
+            del _task_args_loaded[next(iter(_task_args_loaded))]
+        _task_args_loaded[h] = data
+    # decoded fresh for each task since tasks are free to modify their
+    # arguments
+    return kombu_json.loads(data)
+
+
 def run_task(f: Any, *args: Any, **kwargs: Any) -> str | None:
     if not os.environ.get("SYNC_TASKS"):
         log.debug("Running %s with args = %s, kwargs = %s", f.name, args, kwargs)
+        args = tuple(store_task_arg(a) for a in args)
+        kwargs = {k: store_task_arg(v) for k, v in kwargs.items()}
         r = f.delay(*args, **kwargs)
         log.debug("%s dispatched (%s)", f.name, r.id)
         return cast(str, r.id)
@@ -1667,6 +1959,8 @@ def run_task_delay(f: Any, delay: int, *args: Any, **kwargs: Any) -> str | None:
             kwargs,
             delay,
         )
+        args = tuple(store_task_arg(a) for a in args)
+        kwargs = {k: store_task_arg(v) for k, v in kwargs.items()}
         r = f.apply_async(args=args, kwargs=kwargs, countdown=delay)
         log.debug("%s dispatched (%s)", f.name, r.id)
         return cast(str, r.id)
@@ -1,15 +1,73 @@
 import json
-from typing import List, Dict
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Any
+import redis
 import requests
-from .utils import run_task, run_task_delay, redis_connect, get_webhost
+from .utils import run_task, redis_connect, get_webhost
 from .tasks import tasks, NORMAL_PRIORITY
-from .db import DB, JsonObj
+from .db import DB, JsonObj, open_db
 from .log import get_logger
 
 log = get_logger()
 
+# events popped from an endpoint's queue per round
+WEBHOOK_BATCH_SIZE = 50
+# requests in flight to a single endpoint
+WEBHOOK_CONCURRENCY = 4
+WEBHOOK_CONNECT_TIMEOUT = 3.05
+WEBHOOK_READ_TIMEOUT = 10
+# total attempts per event, including the first
+WEBHOOK_MAX_ATTEMPTS = 3
+WEBHOOK_RETRY_DELAY = 20
+# consecutive failures before an endpoint's circuit opens, and the range of
+# the exponential backoff it stays open for
+WEBHOOK_BREAKER_FAILURES = 5
+WEBHOOK_BREAKER_MIN_SECS = 30
+WEBHOOK_BREAKER_MAX_SECS = 30 * 60
+# a drain task hands its endpoint back after this long so one busy endpoint
+# can't hold a worker indefinitely
+WEBHOOK_DRAIN_SECS = 60
+WEBHOOK_LOCK_SECS = 300
+# resthooks are cached per process for this long
+RESTHOOK_CACHE_SECS = 10
+
+# endpoint id -> url for each endpoint with events queued or waiting to be
+# retried; check_webhook_queues forgets endpoints once they have neither
+ENDPOINTS_KEY = "webhooks-endpoints"
+
+_resthook_cache: Dict[str, Tuple[float, Dict[str, List[JsonObj]]]] = {}
+
+_local = threading.local()
+
+
+def endpoint_id(url: str) -> str:
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+
+def _queue_key(eid: str) -> str:
+    return "webhooks-queue-%s" % eid
+
+
+def _retry_key(eid: str) -> str:
+    return "webhooks-retry-%s" % eid
+
+
+def _state_key(eid: str) -> str:
+    return "webhooks-state-%s" % eid
+
+
+def _lock_key(eid: str) -> str:
+    return "webhooks-lock-%s" % eid
+
+
+def get_resthooks(db: DB, cid: str) -> Dict[str, List[JsonObj]]:
+    cached = _resthook_cache.get(cid)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
 
-def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
     rh: Dict[str, List[JsonObj]] = {}
     oldcid = db.get_cid()
     try:
@@ -23,9 +81,17 @@ def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
     finally:
         db.set_cid(oldcid)
 
+    _resthook_cache[cid] = (time.monotonic() + RESTHOOK_CACHE_SECS, rh)
+    return rh
+
+
+def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
+    rh = get_resthooks(db, cid)
+
     rdb = redis_connect()
 
     msgs_by_url: Dict[str, List[JsonObj]] = {}
+    lastevents: Dict[str, str] = {}
 
     multieventtypes = {
         "open": ["open", "open_click"],
@@ -45,7 +111,7 @@ def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
             resteventtypes = multieventtypes.get(t, [t])
 
         for resteventtype in resteventtypes:
-            rdb.set("lastevent-%s-%s" % (cid, resteventtype), json.dumps(event))
+            lastevents["lastevent-%s-%s" % (cid, resteventtype)] = json.dumps(event)
 
             if resteventtype not in rh:
                 continue
@@ -57,50 +123,217 @@ def send_webhooks(db: DB, cid: str, events: List[JsonObj]) -> None:
                     {
                         "event": event,
                         "remove_id": h["id"],
+                        "attempts": 0,
                     }
                 )
 
+    if not lastevents and not msgs_by_url:
+        return
+
+    # the endpoint is registered in the same transaction as its events are
+    # queued, so it can't be pruned between the two
+    pipe = rdb.pipeline()
+    if lastevents:
+        pipe.mset(lastevents)
     for url, msgs in msgs_by_url.items():
-        run_task(send_webhooks_task, url, 0, msgs)
+        eid = endpoint_id(url)
+        pipe.hset(ENDPOINTS_KEY, eid, url)
+        pipe.rpush(_queue_key(eid), *[json.dumps(m) for m in msgs])
+    pipe.execute()
 
+    for url in msgs_by_url:
+        schedule_drain(url)
 
-@tasks.task(priority=NORMAL_PRIORITY)
-def send_webhooks_task(url: str, retries: int, msgs: List[JsonObj]) -> None:
-    db = None
 
-    to_retry = []
+def schedule_drain(url: str) -> None:
+    """Starts a drain task for the endpoint unless one is already queued or
+    running."""
+    rdb = redis_connect()
+    if rdb.set(_lock_key(endpoint_id(url)), "1", nx=True, ex=WEBHOOK_LOCK_SECS):
+        run_task(drain_webhooks, url)
+
+
+def _circuit_state(rdb: Any, eid: str) -> Tuple[int, float]:
+    """Returns the endpoint's consecutive failure count and the time its
+    circuit stays open until."""
+    failures, open_until = rdb.hmget(_state_key(eid), "failures", "open_until")
+    return int(failures or 0), float(open_until or 0)
+
+
+def _record_result(rdb: Any, eid: str, ok: bool) -> None:
+    key = _state_key(eid)
+    if ok:
+        rdb.delete(key)
+        return
+    failures = rdb.hincrby(key, "failures", 1)
+    if failures >= WEBHOOK_BREAKER_FAILURES:
+        backoff = min(
+            WEBHOOK_BREAKER_MIN_SECS
+            * 2 ** min(failures - WEBHOOK_BREAKER_FAILURES, 16),
+            WEBHOOK_BREAKER_MAX_SECS,
+        )
+        rdb.hset(key, "open_until", time.time() + backoff)
+        log.info("Webhook endpoint %s circuit open for %ss", eid, backoff)
+
+
+def _session() -> requests.Session:
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.max_redirects = 2
+        _local.session = session
+    return session
+
 
+def _post(url: str, msg: JsonObj) -> int | None:
+    """Returns the response status, or None if the request failed."""
+    event = msg["event"]
+    log.info("Webhook sending %s to %s", event["type"], url)
     try:
-        with requests.Session() as session:
-            session.max_redirects = 2
-            for msg in msgs:
-                event = msg["event"]
-                remove_id = msg["remove_id"]
-                log.info("Webhook sending %s to %s", event["type"], url)
-                try:
-                    r = session.post(
+        r = _session().post(
+            url,
+            json=event,
+            headers={"User-Agent": f"{get_webhost()} webhook"},
+            timeout=(WEBHOOK_CONNECT_TIMEOUT, WEBHOOK_READ_TIMEOUT),
+        )
+        return r.status_code
+    except Exception as e:
+        log.error("Error: %s", e)
+        return None
+
+
+def _promote_retries(rdb: Any, eid: str) -> None:
+    now = time.time()
+    due = rdb.zrangebyscore(_retry_key(eid), 0, now)
+    if due:
+        pipe = rdb.pipeline()
+        pipe.zrem(_retry_key(eid), *due)
+        pipe.rpush(_queue_key(eid), *due)
+        pipe.execute()
+
+
+def deliver_batch(url: str, msgs: List[JsonObj]) -> Tuple[List[JsonObj], List[str]]:
+    """Posts each message to url with bounded concurrency. Returns the
+    messages that failed and the resthook ids the endpoint asked to remove."""
+    failed: List[JsonObj] = []
+    removed: List[str] = []
+
+    with ThreadPoolExecutor(max_workers=WEBHOOK_CONCURRENCY) as pool:
+        for msg, status in zip(msgs, pool.map(lambda m: _post(url, m), msgs)):
+            if status == 410:
+                removed.append(msg["remove_id"])
+                log.info("Webhook returned status 410, removing %s", msg["remove_id"])
+            elif status is None or status >= 400:
+                if status is not None:
+                    log.error("Error: %s status from %s", status, url)
+                failed.append(msg)
+            else:
+                log.info("Webhook Success")
+
+    return failed, removed
+
+
+@tasks.task(priority=NORMAL_PRIORITY)
+def drain_webhooks(url: str) -> None:
+    rdb = redis_connect()
+    eid = endpoint_id(url)
+
+    try:
+        deadline = time.monotonic() + WEBHOOK_DRAIN_SECS
+        while time.monotonic() < deadline:
+            failures, open_until = _circuit_state(rdb, eid)
+            if open_until > time.time():
+                break
+            # a recovering endpoint gets a single probe event first
+            size = 1 if failures >= WEBHOOK_BREAKER_FAILURES else WEBHOOK_BATCH_SIZE
+
+            _promote_retries(rdb, eid)
+
+            pipe = rdb.pipeline()
+            pipe.lrange(_queue_key(eid), 0, size - 1)
+            pipe.ltrim(_queue_key(eid), size, -1)
+            raw, _ = pipe.execute()
+            if not raw:
+                break
+
+            msgs = [json.loads(r) for r in raw]
+
+            failed, removed = deliver_batch(url, msgs)
+
+            # count the endpoint as down only when nothing in the batch got
+            # through, so one bad event can't trip the breaker
+            _record_result(rdb, eid, len(failed) < len(msgs))
+
+            if removed:
+                with open_db() as db:
+                    for remove_id in set(removed):
+                        db.resthooks.remove(remove_id)
+
+            retry: Dict[str, float] = {}
+            for msg in failed:
+                msg["attempts"] = msg.get("attempts", 0) + 1
+                if msg["attempts"] < WEBHOOK_MAX_ATTEMPTS:
+                    retry[json.dumps(msg)] = time.time() + WEBHOOK_RETRY_DELAY * (
+                        2 ** (msg["attempts"] - 1)
+                    )
+                else:
+                    log.info(
+                        "Webhook %s to %s failed %s times, dropping",
+                        msg["event"]["type"],
                         url,
-                        json=event,
-                        headers={"User-Agent": f"{get_webhost()} webhook"},
-                        timeout=10,
+                        msg["attempts"],
                     )
+            if retry:
+                # the endpoint may have been pruned while its queue was empty
+                pipe = rdb.pipeline()
+                pipe.zadd(_retry_key(eid), retry)
+                pipe.hset(ENDPOINTS_KEY, eid, url)
+                pipe.execute()
 
-                    if r.status_code == 410 and "remove_id" in event:
-                        if db is None:
-                            db = DB()
-                        db.resthooks.remove(remove_id)
-                        log.info("Webhook returned status 410, removed %s", remove_id)
-                    else:
-                        r.raise_for_status()
-
-                        log.info("Webhook Success")
-                except Exception as e:
-                    log.error("Error: %s", e)
-                    if retries < 2:
-                        to_retry.append(msg)
-
-        if len(to_retry) > 0:
-            run_task_delay(send_webhooks_task, 20, url, retries + 1, to_retry)
+            rdb.expire(_lock_key(eid), WEBHOOK_LOCK_SECS)
     finally:
-        if db is not None:
-            db.close()
+        rdb.delete(_lock_key(eid))
+
+    # pick up anything queued while the lock was held; delayed retries and
+    # open circuits are left to check_webhook_queues
+    if rdb.llen(_queue_key(eid)) and _circuit_state(rdb, eid)[1] <= time.time():
+        schedule_drain(url)
+
+
+def _prune_endpoint(rdb: Any, eid: str) -> None:
+    """Forgets an endpoint that has nothing queued or waiting to be retried,
+    unless events are queued for it meanwhile."""
+    with rdb.pipeline() as pipe:
+        try:
+            pipe.watch(_queue_key(eid), _retry_key(eid))
+            if pipe.llen(_queue_key(eid)) or pipe.zcard(_retry_key(eid)):
+                return
+            pipe.multi()
+            pipe.hdel(ENDPOINTS_KEY, eid)
+            pipe.delete(_state_key(eid))
+            pipe.execute()
+        except redis.WatchError:
+            pass
+
+
+def check_webhook_queues() -> None:
+    """Restarts draining for endpoints with due retries, recovered circuits or
+    events left behind by a lost task, and prunes endpoints with nothing left
+    to send."""
+    rdb = redis_connect()
+    now = time.time()
+    for eid, url in rdb.hgetall(ENDPOINTS_KEY).items():
+        eid = eid.decode("utf-8")
+        pipe = rdb.pipeline(transaction=False)
+        pipe.llen(_queue_key(eid))
+        pipe.zcard(_retry_key(eid))
+        pipe.zcount(_retry_key(eid), 0, now)
+        queued, retrying, due = pipe.execute()
+        if _circuit_state(rdb, eid)[1] > now:
+            # an open circuit is remembered until it closes, even with
+            # nothing queued
+            continue
+        if queued or due:
+            schedule_drain(url.decode("utf-8"))
+        elif not retrying:
+            _prune_endpoint(rdb, eid)
@@ -832,20 +832,12 @@ class TxnTemplates(CRUDCollection):
 
     def __init__(self) -> None:
         self.domain = "txntemplates"
+        self.large = ["parts", "rawText"]
         self.useronly = True
         self.api = True
 
     def on_get(self, req: falcon.Request, resp: falcon.Response) -> None:
-        db = req.context["db"]
-
-        req.context["result"] = list(
-            json_iter(
-                db.execute(
-                    "select id, cid, data - 'parts' - 'rawText' from txntemplates where cid = %s",
-                    db.get_cid(),
-                )
-            )
-        )
+        self.get_result(req)
 
     def on_post(self, req: falcon.Request, resp: falcon.Response) -> None:
         CRUDCollection.on_post(self, req, resp)
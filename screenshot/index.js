@@ -25,7 +25,9 @@ async function captureScreenshotOfUrl (url, mobile = false, width = 580) {
     }
   }
 
-  const [tab] = await Cdp.List()
+  // each render gets a tab of its own so that concurrent requests don't
+  // navigate each other's pages
+  const tab = await Cdp.New({ host: '127.0.0.1' })
   const client = await Cdp({ host: '127.0.0.1', target: tab })
 
   const {
@@ -100,6 +102,7 @@ async function captureScreenshotOfUrl (url, mobile = false, width = 580) {
   }
 
   await client.close()
+  await Cdp.Close({ host: '127.0.0.1', id: tab.id })
 
   return result
 }
@@ -117,6 +120,10 @@ app.post('/', (req, res) => {
   }
   captureScreenshotOfUrl(req.body.url, req.body.mobile || false, req.body.width || 580)
     .then(data => {
+      if (data === undefined) {
+        res.status(500).send("Screenshot failed");
+        return;
+      }
       res.status(200).send(data);
     })
     .catch(err => {
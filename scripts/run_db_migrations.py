@@ -2,16 +2,22 @@
 
 import sys
 import os
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 INIT_LOCK = 605599291
+ONLINE_LOCK = 605599292
+ONLINE_POLL_SECS = 5
 
-from api.shared.db import DB
+from api.shared.db import DB, open_db
 from api.shared import contacts
 from api.migrations import fix_funnel_indexes, create_sp_event_table, add_monthly_limit, fix_templates_for_outlook, \
     remove_limit_incr, add_txnsends_msgid, webhooks_to_resthooks, add_resthooks_created, add_txnsettings_table, \
-    add_list_stats, add_list_unsubscribe_post, add_signupsettings_table, add_beefree_templates, add_savedrows_table
+    add_list_stats, add_list_unsubscribe_post, add_signupsettings_table, add_beefree_templates, add_savedrows_table, \
+    partition_stat_tables, add_delivery_rollups, add_supplist_digests, add_funnel_due_counts, \
+    add_list_deltas, add_contact_email_hash, add_search_indexes, \
+    add_promoted_fields, add_campaign_summaries, add_collection_indexes
 from api.shared.log import get_logger
 
 log = get_logger()
@@ -31,6 +37,16 @@ migration_list = [
     ('add_signupsettings_table', add_signupsettings_table),
     ('add_beefree_templates', add_beefree_templates),
     ('add_savedrows_table', add_savedrows_table),
+    ('partition_stat_tables', partition_stat_tables),
+    ('add_delivery_rollups', add_delivery_rollups),
+    ('add_supplist_digests', add_supplist_digests),
+    ('add_funnel_due_counts', add_funnel_due_counts),
+    ('add_list_deltas', add_list_deltas),
+    ('add_contact_email_hash', add_contact_email_hash),
+    ('add_search_indexes', add_search_indexes),
+    ('add_promoted_fields', add_promoted_fields),
+    ('add_campaign_summaries', add_campaign_summaries),
+    ('add_collection_indexes', add_collection_indexes),
 ]
 
 def run():
@@ -50,10 +66,37 @@ def run():
             for name, module in migration_list:
                 if not db.single("select ran_at from migrations where name = %s", name):
                     log.info(f"  Running %s...", name)
-                    module.run(db)
+                    if hasattr(module, 'run'):
+                        module.run(db)
                     db.execute("insert into migrations (name, ran_at) values (%s, now())", name)
                     log.info(f"  ...complete")
 
+        # Migrations with a run_online step do their slow work after the
+        # schema changes above are committed, in short transactions on a
+        # separate connection, so the tables stay in use while it runs. The
+        # lock is held in a transaction of its own so that it works through
+        # pgbouncer. Runners waiting for it poll with a try lock rather than
+        # block in pg_advisory_xact_lock: a blocked statement holds a snapshot,
+        # and create index concurrently waits for every older snapshot to go
+        # away, so the holder and the waiters would wait on each other forever.
+        while True:
+            with db.transaction():
+                locked = db.single(f"select pg_try_advisory_xact_lock({ONLINE_LOCK})")
+                if locked:
+                    with open_db() as workdb:
+                        for name, module in migration_list:
+                            if not hasattr(module, 'run_online'):
+                                continue
+                            online = name + ':online'
+                            if not workdb.single("select ran_at from migrations where name = %s", online):
+                                log.info(f"  Running %s...", online)
+                                module.run_online(workdb)
+                                workdb.execute("insert into migrations (name, ran_at) values (%s, now())", online)
+                                log.info(f"  ...complete")
+            if locked:
+                break
+            time.sleep(ONLINE_POLL_SECS)
+
         log.info("...finished")
     except:
         log.exception("Error running database migrations")
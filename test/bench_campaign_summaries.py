@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from api.shared.db import DB
+
+PREFIX = 'benchcs'
+BATCH = 20000
+
+OLD_STATS = """select ccid as cid,
+    sum(open::decimal)/nullif(sum(send), 0),
+    sum(complaint::decimal)/nullif(sum(send), 0),
+    max(complaint::decimal/nullif(send, 0)),
+    max(hard::decimal/nullif(send, 0)),
+    max(soft::decimal/nullif(send, 0))
+    from (
+      select coalesce(campaigns.cid, messages.cid) as ccid,
+      hourstats.campid id, sum(complaint) as complaint,
+      sum(open) as open, sum(send) as send, sum(hard) as hard, sum(soft) as soft
+      from hourstats
+      left join campaigns on campaigns.id = hourstats.campid
+      left join messages on messages.id = hourstats.campid
+      where hourstats.cid = %s
+      and (campaigns.data is null or (campaigns.data_sent_at >= %s and campaigns.data_sent_at <= %s))
+      and send+soft+hard+defercnt > 0
+      and ts >= %s and ts <= %s
+      group by ccid, hourstats.campid
+    ) tbl
+    group by cid"""
+
+NEW_STATS = """select ccid as cid,
+    sum(open::decimal)/nullif(sum(send), 0),
+    sum(complaint::decimal)/nullif(sum(send), 0),
+    max(complaint::decimal/nullif(send, 0)),
+    max(hard::decimal/nullif(send, 0)),
+    max(soft::decimal/nullif(send, 0))
+    from (
+      select coalesce(campaigns.cid, messages.cid) as ccid,
+      s.campid id, sum(delivered_complaint) as complaint,
+      sum(delivered_open) as open, sum(delivered_send) as send,
+      sum(delivered_hard) as hard, sum(delivered_soft) as soft
+      from (
+        select cid, campid, ts, delivered_rows, delivered_open, delivered_complaint, delivered_send, delivered_hard, delivered_soft
+        from campstats_hourly where ts >= %s and ts < %s
+        union all
+        select cid, campid, ts, delivered_rows, delivered_open, delivered_complaint, delivered_send, delivered_hard, delivered_soft
+        from campstats_daily where ts >= %s and ts < %s
+        union all
+        select cid, campid, ts, delivered_rows, delivered_open, delivered_complaint, delivered_send, delivered_hard, delivered_soft
+        from campstats_hourly where ts >= %s and ts <= %s
+      ) s
+      left join campaigns on campaigns.id = s.campid
+      left join messages on messages.id = s.campid
+      where s.cid = %s
+      and (campaigns.data is null or (campaigns.data_sent_at >= %s and campaigns.data_sent_at <= %s))
+      and delivered_rows > 0
+      group by ccid, s.campid
+    ) tbl
+    group by cid"""
+
+def cleanup(db):
+    db.execute("delete from hourstats where cid like %s", PREFIX + '%')
+    db.execute("delete from campaigns where cid like %s", PREFIX + '%')
+
+def populate(db, args, now):
+    db.execute("""insert into campaigns (id, cid, data)
+                  select %s || '-c' || i, %s || '-cust' || (i %% %s),
+                         jsonb_build_object('name', 'Campaign ' || i, 'sent_at', to_char(%s - (i %% %s) * interval '1 day', 'YYYY-MM-DD"T"HH24:MI:SS"Z"'))
+                  from generate_series(1, %s) i""",
+               PREFIX, PREFIX, args.customers, now, args.days, args.customers * args.campaigns)
+    # each campaign sends over a few days, spread over domain groups and ips;
+    # written in batches, as stats are, so the rollup triggers update each
+    # summary row a few times per transaction rather than thousands
+    for first in range(1, args.rows + 1, BATCH):
+        db.execute("""insert into hourstats (id, cid, campcid, ts, sinkid, domaingroupid, ip, settingsid, campid,
+                                             complaint, unsub, open, click, send, soft, hard, err, defercnt)
+                      select %s || '-h' || i, %s || '-admin', %s || '-cust' || (c %% %s),
+                             date_trunc('hour', %s - (c %% %s) * interval '1 day' + (random() * 72)::int * interval '1 hour'),
+                             'sink', 'dg' || (random() * %s)::int, 'ip' || (random() * %s)::int, 'settings', %s || '-c' || c,
+                             (random() < 0.01)::int, 0, (random() * 20)::int, 0, (random() * 200)::int,
+                             (random() * 5)::int, (random() * 2)::int, 0, (random() * 3)::int
+                      from (select i, 1 + (random() * (%s - 1))::int as c from generate_series(%s, %s) i) g
+                      on conflict do nothing""",
+                   PREFIX, PREFIX, PREFIX, args.customers, now, args.days, args.domaingroups, args.ips, PREFIX,
+                   args.customers * args.campaigns, first, min(first + BATCH - 1, args.rows))
+    db.execute("analyze hourstats")
+    db.execute("analyze campstats_hourly")
+    db.execute("analyze campstats_daily")
+
+def bounds(start, end):
+    firstday = start.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    lastday = end.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [start, firstday, firstday, lastday, lastday, end]
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_campaign_summaries', description='Compare the admin campaign stats report computed from hourstats with the same report from the per-campaign summaries')
+    parser.add_argument('--rows', type=int, default=2000000, help='Number of hourstats rows to generate')
+    parser.add_argument('--customers', type=int, default=300, help='Number of customer companies')
+    parser.add_argument('--campaigns', type=int, default=20, help='Campaigns per customer')
+    parser.add_argument('--days', type=int, default=60, help='Days the campaigns are spread over')
+    parser.add_argument('--domaingroups', type=int, default=20, help='Distinct domain groups')
+    parser.add_argument('--ips', type=int, default=8, help='Distinct sending ips')
+    args = parser.parse_args()
+
+    db = DB()
+    cleanup(db)
+
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    start = time.monotonic()
+    populate(db, args, now)
+    print('generated %s rows in %.1fs' % (db.single("select count(*) from hourstats where cid = %s", PREFIX + '-admin'), time.monotonic() - start))
+
+    try:
+        for days in (1, 7, 30, 60):
+            rangestart = now - timedelta(days=days, hours=7, minutes=30)
+            rangeend = now - timedelta(minutes=30)
+            sentrange = [rangestart.isoformat() + 'Z', rangeend.isoformat() + 'Z']
+
+            start = time.monotonic()
+            old = db.execute(OLD_STATS, PREFIX + '-admin', *sentrange, rangestart, rangeend).fetchall()
+            oldtime = time.monotonic() - start
+
+            start = time.monotonic()
+            new = db.execute(NEW_STATS, *bounds(rangestart, rangeend), PREFIX + '-admin', *sentrange).fetchall()
+            newtime = time.monotonic() - start
+
+            assert sorted(old) == sorted(new), 'summaries disagree with hourstats'
+            print('%2s days, %s companies: hourstats %.0fms, summaries %.0fms' % (days, len(new), oldtime * 1000, newtime * 1000))
+    finally:
+        cleanup(db)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from api.shared.db import DB
+from api.shared.segments import HASHLIMIT_CAP
+from api import funnels
+
+PREFIX = 'benchfq'
+
+OLD_COMPANIES = """select distinct cid from funnelqueue where not sent and cid like %s"""
+
+OLD_SCAN = """select mod(rawhash, %s) h, messageid,
+    case coalesce(a->>'msgroute', '')
+    when '' then f.data->>'route'
+    else a->>'msgroute' end r,
+    domain, count(email)
+    from funnelqueue q
+    inner join messages m on q.messageid = m.id and q.cid = m.cid
+    inner join funnels f on f.id = m.data->>'funnel' and m.cid = f.cid
+    left join jsonb_array_elements(f.data->'messages') a on a->>'id' = m.id
+    where ts <= %s and q.cid = %s and (not sent)
+    group by h, messageid, r, domain"""
+
+NEW_COMPANIES = """select distinct cid from funneldue where count > 0 and cid like %s"""
+
+NEW_SCAN = """select mod(bucket, %s) h, messageid, domain, sum(count)::bigint
+    from funneldue where cid = %s and count > 0
+    group by h, messageid, domain"""
+
+def cleanup(db):
+    db.execute("delete from funnelqueue where cid like %s", PREFIX + '%')
+    db.execute("delete from funneldue where cid like %s", PREFIX + '%')
+    db.execute("delete from messages where cid like %s", PREFIX + '%')
+    db.execute("delete from funnels where cid like %s", PREFIX + '%')
+
+def populate(db, args, now):
+    for c in range(args.companies):
+        cid = '%s%s' % (PREFIX, c)
+        msgs = ['%s-m%s' % (cid, m) for m in range(args.messages)]
+        db.execute("""insert into funnels (id, cid, data) values (%s, %s, jsonb_build_object('route', 'r1', 'messages', %s::jsonb))""",
+                   cid + '-f', cid, '[%s]' % ','.join('{"id": "%s"}' % m for m in msgs))
+        for m in msgs:
+            db.execute("""insert into messages (id, cid, data) values (%s, %s, jsonb_build_object('funnel', %s::text))""", m, cid, cid + '-f')
+
+    # a backlog of already due rows, and the rest scheduled over the coming
+    # days, the way funnel delays spread a queue out
+    db.execute("""insert into funnelqueue (email, rawhash, messageid, domain, ts, cid)
+                  select 'c' || i || '@d' || (i %% %s) || '.com', (i * 2654435761) %% 2147483647,
+                         %s || (i %% %s) || '-m' || ((i / %s) %% %s), 'd' || (i %% %s) || '.com',
+                         case when random() < %s then %s - random() * interval '1 day'
+                              else %s + random() * interval '%s days' end,
+                         %s || (i %% %s)
+                  from generate_series(1, %s) i""",
+               args.domains, PREFIX, args.companies, args.companies, args.messages, args.domains,
+               args.due, now, now, args.days, PREFIX, args.companies, args.rows)
+    db.execute("analyze funnelqueue")
+
+def old_tick(db, ts):
+    groups = 0
+    for cid, in list(db.execute(OLD_COMPANIES, PREFIX + '%')):
+        groups += len(db.execute(OLD_SCAN, HASHLIMIT_CAP, ts, cid).fetchall())
+    return groups
+
+def new_tick(db, ts):
+    promoted = funnels.promote_due_funnels(db, ts)
+    groups = 0
+    for cid, in list(db.execute(NEW_COMPANIES, PREFIX + '%')):
+        due = db.execute(NEW_SCAN, HASHLIMIT_CAP, cid).fetchall()
+        funnels.get_funnel_routes(db, cid, list(set(r[1] for r in due)))
+        groups += len(due)
+    return promoted, groups
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_funnel_dispatch', description='Compare the funnelqueue scan in check_funnels with due-time promotion into funneldue on a synthetic queue')
+    parser.add_argument('--rows', type=int, default=20000000, help='Number of funnelqueue rows to generate')
+    parser.add_argument('--companies', type=int, default=50, help='Number of companies with queued funnel messages')
+    parser.add_argument('--messages', type=int, default=10, help='Funnel messages per company')
+    parser.add_argument('--domains', type=int, default=200, help='Distinct recipient domains')
+    parser.add_argument('--due', type=float, default=0.02, help='Fraction of rows already due')
+    parser.add_argument('--days', type=int, default=30, help='Days the rest of the queue is spread over')
+    parser.add_argument('--ticks', type=int, default=3, help='Number of one minute ticks to time')
+    args = parser.parse_args()
+
+    db = DB()
+    cleanup(db)
+
+    now = datetime.utcnow()
+    start = time.monotonic()
+    populate(db, args, now)
+    print('generated %s rows in %.1fs' % (args.rows, time.monotonic() - start))
+
+    try:
+        start = time.monotonic()
+        promoted, groups = new_tick(db, now)
+        print('initial promotion: %s rows, %s groups in %.2fs' % (promoted, groups, time.monotonic() - start))
+
+        for i in range(1, args.ticks + 1):
+            ts = now + timedelta(minutes=i)
+
+            start = time.monotonic()
+            groups = old_tick(db, ts)
+            old = time.monotonic() - start
+
+            start = time.monotonic()
+            promoted, newgroups = new_tick(db, ts)
+            new = time.monotonic() - start
+
+            print('tick %s: scan %.2fs (%s groups), due index %.3fs (%s rows promoted, %s groups)' % (i, old, groups, new, promoted, newgroups))
+    finally:
+        cleanup(db)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import argparse
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from api.shared import db as dbmod
+from api.shared.db import DB
+from api.events import hourstats_insert, statmsgs_insert
+
+PREFIX = 'benchps'
+
+CAMPAIGN = """select id, cid, data - 'parts' - 'rawText' from campaigns where id = %s"""
+SETTINGS = """select cid from ses where id = %s"""
+
+def cleanup(db):
+    db.execute("delete from hourstats where cid like %s", PREFIX + '%')
+    db.execute("delete from statmsgs where cid like %s", PREFIX + '%')
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p))] * 1e6
+
+def run(db, args, ts):
+    times = {'campaign lookup': [], 'settings lookup': [], 'companies get': [], 'hourstats insert': [], 'statmsgs insert': []}
+    for i in range(args.events):
+        cid = '%s%s' % (PREFIX, i % args.companies)
+        camp = 'camp%s' % (i % 100)
+
+        start = time.perf_counter()
+        db.row(CAMPAIGN, camp)
+        times['campaign lookup'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        db.single(SETTINGS, 'settings%s' % (i % 10))
+        times['settings lookup'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        db.companies.get(cid)
+        times['companies get'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hourstats_insert(db, cid, cid, ts, 'ses', 'd%s.com' % (i % 50), '', 'settings', camp, 0, 0, 1, 0)
+        times['hourstats insert'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        statmsgs_insert(db, cid, ts, 'ses', 'd%s.com' % (i % 50), '', 'settings', camp, 'deferred', 'soft')
+        times['statmsgs insert'].append(time.perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_prepared_statements', description='Compare per-query latency of the tracking event write path with and without the prepared statement cache')
+    parser.add_argument('--events', type=int, default=20000, help='Number of events to write per run')
+    parser.add_argument('--companies', type=int, default=20, help='Number of companies the events are spread over')
+    args = parser.parse_args()
+
+    ts = datetime.utcnow()
+    try:
+        for label, prepare in (('plain', False), ('prepared', True)):
+            dbmod.PREPARE_STATEMENTS = prepare
+            # a fresh connection so nothing is left prepared from another run
+            db = DB()
+            db.conn.close()
+            db.close()
+            db = DB()
+            cleanup(db)
+            times = run(db, args, ts)
+            print(label)
+            for name, t in times.items():
+                t.sort()
+                print('  %-18s mean %6.0fus  p50 %6.0fus  p99 %6.0fus' % (name, sum(t) / len(t) * 1e6, percentile(t, 0.5), percentile(t, 0.99)))
+            db.close()
+    finally:
+        db = DB()
+        cleanup(db)
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('redis_host', 'localhost')
+os.environ.setdefault('redis_port', '6379')
+os.environ.setdefault('redis_pass', '')
+
+import redis
+
+from api.shared import utils, send
+
+PREFIX = 'benchredis'
+USER_LIMIT = 5000
+
+def rate_limit_old(rdb, key):
+    cnt = rdb.get(key)
+    if cnt is not None and int(cnt) >= USER_LIMIT:
+        return False
+    rdb.pipeline().incr(key).expire(key, 59).execute()
+    return True
+
+def rate_limit_new(rdb, key):
+    cnt, _ = rdb.pipeline().incr(key).expire(key, 59).execute()
+    return cnt <= USER_LIMIT
+
+def send_limit_old(rdb, cid, requested):
+    keys = ['%s-%s-%s' % (PREFIX, name, cid) for name in ('min', 'hour', 'day', 'month', 'dmin', 'dhour', 'dday')]
+    with rdb.pipeline() as pipe:
+        while True:
+            try:
+                for key in keys:
+                    pipe.watch(key)
+                counts = [int(pipe.get(key) or 0) for key in keys]
+                pipe.multi()
+                for key, cnt in zip(keys, counts):
+                    pipe.set(key, cnt + requested, 60)
+                pipe.execute()
+                return requested
+            except redis.WatchError:
+                continue
+
+def send_limit_new(rdb, cid, requested):
+    company = {'id': '%s-%s' % (PREFIX, cid), 'minlimit': 10**9, 'hourlimit': 10**9, 'daylimit': 10**9, 'monthlimit': 10**9, 'paid': False}
+    throttles = [{'route': 'route', 'domainsparsed': ['gmail.com'], 'minlimit': 10**9, 'hourlimit': 10**9, 'daylimit': 10**9}]
+    return send.check_send_limit(company, 'route', 'gmail.com', throttles, requested)
+
+def webhook_old(rdb, events):
+    for ev in events:
+        rdb.lpush(PREFIX + '-pending', json.dumps(ev))
+
+def webhook_new(rdb, events):
+    rdb.lpush(PREFIX + '-pending', *[json.dumps(ev) for ev in events])
+
+def run(workers, count, fn):
+    start = time.monotonic()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(fn, range(count)))
+    return time.monotonic() - start
+
+def cleanup(rdb):
+    keys = list(rdb.scan_iter(PREFIX + '*')) + list(rdb.scan_iter('sendrate*-' + PREFIX + '*'))
+    if keys:
+        rdb.delete(*keys)
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_redis', description='Compare one-command-at-a-time redis access on the event hot paths with the pipelined versions, under concurrent load against a local redis')
+    parser.add_argument('--requests', type=int, default=20000, help='Requests run through each rate limit check')
+    parser.add_argument('--sends', type=int, default=5000, help='Send limit checks')
+    parser.add_argument('--posts', type=int, default=500, help='Provider webhook posts')
+    parser.add_argument('--events', type=int, default=100, help='Events per webhook post')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent threads sharing the connection pool')
+    args = parser.parse_args()
+
+    rdb = utils.redis_connect()
+    rdb.ping()
+    cleanup(rdb)
+
+    events = [{'type': 'sp', 'eventtype': 'delivery', 'email': 'user%s@gmail.com' % i, 'campid': 'camp'} for i in range(args.events)]
+
+    try:
+        old = run(args.workers, args.requests, lambda i: rate_limit_old(rdb, '%s-rate-%s' % (PREFIX, i % 50)))
+        new = run(args.workers, args.requests, lambda i: rate_limit_new(rdb, '%s-rate-%s' % (PREFIX, i % 50 + 50)))
+        print('rate limit, %s requests: one at a time %.2fs, pipelined %.2fs' % (args.requests, old, new))
+
+        old = run(args.workers, args.sends, lambda i: send_limit_old(rdb, i % 50, 1))
+        new = run(args.workers, args.sends, lambda i: send_limit_new(rdb, i % 50, 1))
+        print('send limit, %s checks: one at a time %.2fs, pipelined %.2fs' % (args.sends, old, new))
+
+        old = run(args.workers, args.posts, lambda i: webhook_old(rdb, events))
+        new = run(args.workers, args.posts, lambda i: webhook_new(rdb, events))
+        assert rdb.llen(PREFIX + '-pending') == 2 * args.posts * args.events
+        print('webhooks, %s posts of %s events: one at a time %.2fs, pipelined %.2fs' % (args.posts, args.events, old, new))
+
+        pool = rdb.connection_pool
+        print('connections opened by %s threads: %s (pool size %s)' % (args.workers, len(pool._connections), utils.REDIS_POOL_SIZE))
+    finally:
+        cleanup(rdb)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import base64
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+for name in ('s3_imagebucket', 's3_transferbucket'):
+    os.environ.setdefault(name, tempfile.mkdtemp(prefix='benchss-'))
+os.environ.setdefault('webroot', 'http://localhost')
+
+from api.shared.db import DB
+from api.shared import utils
+
+PREFIX = 'benchss'
+
+# a 1x1 transparent png
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=')
+
+class StubRenderer(BaseHTTPRequestHandler):
+    """Stands in for the screenshot service: takes as long as a real render
+    and records how many renders it was asked for and how many ran at once."""
+
+    delay = 0.5
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+    renders = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        assert body['url'] and body['width']
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.renders += 1
+            cls.peak = max(cls.peak, cls.active)
+        time.sleep(cls.delay)
+        with cls.lock:
+            cls.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(base64.b64encode(PNG))
+
+    def log_message(self, format, *args):
+        pass
+
+def cleanup(db):
+    db.execute("delete from txntemplates where cid = %s", PREFIX)
+
+def populate(db, args):
+    # every template is saved twice, as a bulk duplicate would, and a few
+    # share content
+    ids = []
+    for i in range(args.templates):
+        html = '<html><body>Template %s</body></html>' % (i % args.distinct)
+        for copy in range(2):
+            id = '%s-%s-%s' % (PREFIX, i, copy)
+            db.execute("insert into txntemplates (id, cid, data) values (%s, %s, %s)",
+                       id, PREFIX, {'name': id, 'type': 'beefree', 'rawText': json.dumps({'html': html})})
+            ids.append(id)
+    return ids
+
+def render_all(ids, workers):
+    local = threading.local()
+    def work(id):
+        if not hasattr(local, 'db'):
+            local.db = DB()
+        utils.gen_screenshot(local.db, id, 'txntemplates', True)
+    start = time.monotonic()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(work, ids))
+    return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_screenshots', description='Generate template screenshots against a local stub renderer and report render concurrency and deduplication')
+    parser.add_argument('--templates', type=int, default=40, help='Number of templates to generate, each saved twice')
+    parser.add_argument('--distinct', type=int, default=30, help='Number of distinct template contents')
+    parser.add_argument('--workers', type=int, default=16, help='Number of concurrent task workers')
+    parser.add_argument('--delay', type=float, default=0.5, help='Seconds the stub takes per render')
+    args = parser.parse_args()
+
+    StubRenderer.delay = args.delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubRenderer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    utils.SCREENSHOT_URL = 'http://127.0.0.1:%s' % server.server_port
+
+    db = DB()
+    cleanup(db)
+    ids = populate(db, args)
+    distinct = min(args.templates, args.distinct)
+
+    try:
+        for concurrency in (1, utils.SCREENSHOT_CONCURRENCY):
+            for name in os.listdir(os.environ['s3_imagebucket']):
+                if name.startswith('ss-'):
+                    os.unlink(os.path.join(os.environ['s3_imagebucket'], name))
+            utils.SCREENSHOT_CONCURRENCY = concurrency
+            StubRenderer.renders = StubRenderer.peak = 0
+
+            elapsed = render_all(ids, args.workers)
+            assert StubRenderer.renders == distinct, 'rendered %s times for %s distinct templates' % (StubRenderer.renders, distinct)
+            assert StubRenderer.peak <= concurrency, 'renderer saw %s concurrent renders' % StubRenderer.peak
+            images = {t['image'] for t in db.txntemplates.find({}) if t['cid'] == PREFIX}
+            assert len(images) == distinct
+
+            again = render_all(ids, args.workers)
+            assert StubRenderer.renders == distinct, 'unchanged templates were rendered again'
+            print('concurrency %s: %s screenshots, %s renders in %.1fs (peak %s at once), unchanged resave %.2fs'
+                  % (concurrency, len(ids), StubRenderer.renders, elapsed, StubRenderer.peak, again))
+    finally:
+        cleanup(db)
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
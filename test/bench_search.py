@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import re
+import json
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from api.shared.db import DB
+from api.shared import contacts
+from api.shared.segments import _segment_rows_query
+from api import lists
+
+CID = 'benchsearch'
+LIST = 'benchsearch-list'
+
+CAMPAIGN_SEARCH = """select id from campaigns
+    where cid = %s and data->>'sent_at' is not null and data->>'hidden' is null
+    and (lower(data->>'name') ~ %s or lower(data->>'subject') ~ %s or lower(data->>'fromname') ~ %s)
+    order by data->>'sent_at' desc limit 100"""
+
+def cleanup(db):
+    db.execute("delete from campaigns where cid = %s", CID)
+    for table in ('contact_suppdigests', 'contact_send_logs', 'contact_click_logs', 'contact_open_logs',
+                  'contact_values', 'contact_supplists', 'contact_lists', 'contacts'):
+        db.execute(f'drop table if exists contacts."{table}_{CID}"')
+    db.execute("delete from contacts.contacts_hashlimit where cid = %s", CID)
+
+def populate(db, args):
+    db.execute("""insert into campaigns (id, cid, data)
+                  select %s || i, %s, jsonb_build_object(
+                      'name', 'Campaign ' || i || ' ' || md5(i::text),
+                      'subject', 'News for week ' || (i %% 52) || ' ' || md5((i * 7)::text),
+                      'fromname', 'Sender ' || (i %% 100),
+                      'sent_at', '2024-01-01T00:00:00Z')
+                  from generate_series(1, %s) i""", CID + '-', CID, args.campaigns)
+
+    contacts.initialize_cid(db, CID)
+    db.execute("update contacts.contacts_hashlimit set hashlimit = 1 where cid = %s", CID)
+    db.execute(f"""insert into contacts."contacts_{CID}" (email, added, props)
+                   select 'user' || i || '@d' || (i %% 500) || '.com', 1700000000 + i,
+                          jsonb_build_object('First Name', jsonb_build_array(md5(i::text)),
+                                             'City', jsonb_build_array('City ' || (i %% 5000)))
+                   from generate_series(1, %s) i""", args.contacts)
+    db.execute(f"""insert into contacts."contact_lists_{CID}" (list_id, contact_id)
+                   select %s, contact_id from contacts."contacts_{CID}" """, LIST)
+    db.execute(f"""insert into contacts."contact_values_{CID}" (contact_id, type, value)
+                   select contact_id, 'tag', 'tag' || (contact_id %% 1000) from contacts."contacts_{CID}" """)
+    db.execute("analyze campaigns")
+    for table in ('contacts', 'contact_lists', 'contact_values'):
+        db.execute(f'analyze contacts."{table}_{CID}"')
+
+def plan_indexes(db, sql, *args):
+    plan = db.single("explain (format json) " + sql, *args)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    found = set()
+    def walk(node):
+        if 'Index Name' in node:
+            found.add(node['Index Name'])
+        for child in node.get('Plans', ()):
+            walk(child)
+    walk(plan[0]['Plan'])
+    return found
+
+def check_plans(db, campaignterm, contactterm):
+    search = re.escape(campaignterm)
+    used = plan_indexes(db, CAMPAIGN_SEARCH, CID, search, search, search)
+    print('campaign search plan uses: %s' % ', '.join(sorted(used)))
+    for index in ('campaigns_name_search_idx', 'campaigns_subject_search_idx', 'campaigns_fromname_search_idx'):
+        assert index in used, 'campaign search does not use %s: %s' % (index, used)
+
+    sql, args = _segment_rows_query(CID, 0, [LIST], 1, None, False, contactterm)
+    used = plan_indexes(db, sql, *args)
+    print('contact search plan uses: %s' % ', '.join(sorted(used)))
+    for index in ('contacts_%s_search_idx' % CID, 'contact_values_%s_tag_search_idx' % CID):
+        assert index in used, 'contact search does not use %s: %s' % (index, used)
+    print('planner check passed: searches use the trigram indexes')
+
+def time_campaigns(db, terms, indexed):
+    db.execute("set enable_bitmapscan = %s" % ('on' if indexed else 'off'))
+    start = time.monotonic()
+    for term in terms:
+        search = re.escape(term)
+        db.execute(CAMPAIGN_SEARCH, CID, search, search, search).fetchall()
+    db.execute("reset enable_bitmapscan")
+    return (time.monotonic() - start) / len(terms)
+
+def time_contacts(db, terms, indexed):
+    find_search_text = lists.find_search_text
+    if not indexed:
+        lists.find_search_text = lambda segment: None
+    found = []
+    start = time.monotonic()
+    try:
+        for term in terms:
+            segment = lists.find_segment(LIST, {'operator': 'and', 'parts': [{'type': 'Info', 'prop': '!!*', 'operator': 'contains', 'value': term}]})
+            found.append(lists.do_list_find(db, CID, segment, {'id': 'Email'}, None, None, 0, [LIST], 1, []))
+    finally:
+        lists.find_search_text = find_search_text
+    return (time.monotonic() - start) / len(terms), found
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_search', description='Compare campaign and contact search latency with and without the trigram search indexes on a seeded tenant')
+    parser.add_argument('--campaigns', type=int, default=50000, help='Number of campaigns to generate')
+    parser.add_argument('--contacts', type=int, default=1000000, help='Number of contacts to generate')
+    args = parser.parse_args()
+
+    db = DB()
+    cleanup(db)
+
+    start = time.monotonic()
+    populate(db, args)
+    print('generated %s campaigns and %s contacts in %.1fs' % (args.campaigns, args.contacts, time.monotonic() - start))
+
+    # keystrokes of a search being typed, then a few complete terms
+    campaignterms = ['cam', 'camp', 'campa', 'campaign 12', 'week 7', 'sender 42', '3f2a']
+    contactterms = ['use', 'user', 'user123', 'city 42', 'tag99', 'd17.com', '3f2a']
+
+    try:
+        check_plans(db, campaignterms[-1], contactterms[-1])
+
+        old = time_campaigns(db, campaignterms, False)
+        new = time_campaigns(db, campaignterms, True)
+        print('campaign search: scan %.1fms, indexed %.1fms per query' % (old * 1000, new * 1000))
+
+        old, oldfound = time_contacts(db, contactterms, False)
+        new, newfound = time_contacts(db, contactterms, True)
+        assert oldfound == newfound, 'indexed contact search returned different results'
+        print('contact search: scan %.1fms, indexed %.1fms per query' % (old * 1000, new * 1000))
+    finally:
+        cleanup(db)
+
+if __name__ == '__main__':
+    main()
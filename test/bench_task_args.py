@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import redis
+from api.shared.tasks import tasks
+from api.shared.utils import store_task_arg, load_task_arg, TASK_ARG_REF
+from api.funnels import send_message
+
+QUEUE = 'bench-taskargs'
+
+def make_lists(count):
+    return [{
+        'id': 'l%s' % i,
+        'cid': 'benchcid',
+        'name': 'List number %s for the task argument benchmark' % i,
+        'count': 1000 + i,
+        'active30': 100 + i,
+        'used_properties': ['Email', 'First Name', 'Last Name', 'Company', 'Phone', 'City'],
+        'created': '2024-01-01T00:00:00Z',
+        'tags': ['tag%s' % t for t in range(5)],
+    } for i in range(count)]
+
+def broker_memory(broker):
+    return broker.info('memory')['used_memory']
+
+def purge(broker):
+    with tasks.connection_for_write() as conn:
+        conn.default_channel.queue_purge(QUEUE)
+    for key in broker.scan_iter('taskarg-*'):
+        broker.delete(key)
+
+def fan_out(args, alllists, store):
+    start = time.monotonic()
+    for i in range(args.tasks):
+        params = ('benchcid', i % args.hashlimit, 'm%s' % (i % 10), 'd%s.com' % (i % 200), args.hashlimit, alllists, '2024-01-01T00:00:00Z', 100)
+        if store:
+            params = tuple(store_task_arg(p) for p in params)
+        send_message.apply_async(args=params, queue=QUEUE)
+    return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_task_args', description='Compare broker memory and enqueue time of a send_message fan-out with list documents inline and in the task argument store')
+    parser.add_argument('--tasks', type=int, default=10000, help='Number of tasks to enqueue')
+    parser.add_argument('--lists', type=int, default=50, help='Number of list documents passed to each task')
+    parser.add_argument('--hashlimit', type=int, default=20, help='Hash buckets per company')
+    args = parser.parse_args()
+
+    broker = redis.Redis.from_url(tasks.conf.broker_url)
+    alllists = make_lists(args.lists)
+
+    ref = store_task_arg(alllists)
+    assert ref.keys() == {TASK_ARG_REF} and load_task_arg(ref) == alllists
+
+    for label, store in (('inline', False), ('store', True)):
+        purge(broker)
+        before = broker_memory(broker)
+        elapsed = fan_out(args, alllists, store)
+        used = broker_memory(broker) - before
+        print('%s: %s tasks enqueued in %.2fs (%.0f/s), broker memory +%.1f MB' % (label, args.tasks, elapsed, args.tasks / elapsed, used / 1024 / 1024))
+    purge(broker)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import argparse
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from api.shared import webhooks
+
+def make_handler(delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_webhooks', description='Compare sequential and batched webhook delivery against a local stub endpoint')
+    parser.add_argument('--events', type=int, default=200, help='Number of events to deliver')
+    parser.add_argument('--delay', type=float, default=0.05, help='Stub endpoint response time in seconds')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/hook' % server.server_address[1]
+
+    msgs = [{'event': {'type': 'open', 'n': i}, 'remove_id': 'bench', 'attempts': 0} for i in range(args.events)]
+
+    # previous behaviour: one request at a time over a single session
+    start = time.monotonic()
+    with requests.Session() as session:
+        session.max_redirects = 2
+        for msg in msgs:
+            session.post(url, json=msg['event'], timeout=10).raise_for_status()
+    sequential = time.monotonic() - start
+
+    start = time.monotonic()
+    for i in range(0, len(msgs), webhooks.WEBHOOK_BATCH_SIZE):
+        failed, _ = webhooks.deliver_batch(url, msgs[i:i + webhooks.WEBHOOK_BATCH_SIZE])
+        assert not failed
+    batched = time.monotonic() - start
+
+    server.shutdown()
+
+    print('events: %s, endpoint delay: %.0fms' % (args.events, args.delay * 1000))
+    print('sequential: %.2fs (%.1f events/s)' % (sequential, args.events / sequential))
+    print('batched:    %.2fs (%.1f events/s)' % (batched, args.events / batched))
+
+if __name__ == '__main__':
+    main()
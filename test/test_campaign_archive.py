@@ -0,0 +1,128 @@
+import test_base
+import os
+import zipfile
+from datetime import datetime, timedelta
+from api import campaigns
+from api.campaigns import start_archival, ARCHIVE_MAX_ATTEMPTS
+
+class TestCampaignArchive(test_base.TestBase):
+
+    def create_sent_campaign(self, name, emails):
+        cid = self.user_cookie['cid']
+
+        self.db.set_cid(cid)
+        campid = self.db.campaigns.add({
+            'name': name,
+            'sent_at': (datetime.utcnow() - timedelta(days=400)).isoformat() + 'Z',
+        })
+        self.db.set_cid(None)
+
+        for email in emails:
+            self.db.execute(f"""insert into contacts."contacts_{cid}" (email, added, props) values (%s, 0, '{{}}')
+                                on conflict do nothing""", email)
+        self.db.execute(f"""insert into contacts."contact_send_logs_{cid}" (contact_id, campid)
+                            select contact_id, %s from contacts."contacts_{cid}" where email = any(%s)""", campid, emails)
+        for email in emails[:3]:
+            self.db.execute("insert into camplogs (campid, email, cmd, ts) values (%s, %s, 'open', now())", campid, email)
+
+        return cid, campid
+
+    def camp(self, campid):
+        return self.db.single("select data from campaigns where id = %s", campid)
+
+    def test_archive(self):
+        emails = ['archive%s@petpsychic.com' % i for i in range(10)]
+        cid, campid = self.create_sent_campaign('test_archive', emails)
+
+        # a contact deleted while the archive is written doesn't make it fail
+        # verification against the rows that are left
+        write = campaigns.write_campaign_export
+        def write_then_delete(db, *args):
+            ret = write(db, *args)
+            db.execute(f"""delete from contacts."contacts_{cid}" where email = %s""", emails[-1])
+            return ret
+        campaigns.write_campaign_export = write_then_delete
+        try:
+            start_archival(self.db)
+        finally:
+            campaigns.write_campaign_export = write
+
+        camp = self.camp(campid)
+        assert camp['archived']
+        assert 'archive_stage' not in camp
+        assert 'archive_claimed_at' not in camp
+        assert 'archive_attempts' not in camp
+        assert camp['archive_count'] == 10
+
+        assert self.db.single("select count(*) from camplogs where campid = %s", campid) == 0
+
+        with zipfile.ZipFile(os.path.join(os.environ['s3_databucket'], camp['archive_key'])) as z:
+            assert sorted(z.namelist()) == ['delivered.csv', 'opened.csv']
+            assert len(z.read('delivered.csv').decode('utf-8').splitlines()) == 11
+
+    def test_verify_failure(self):
+        emails = ['failarchive%s@petpsychic.com' % i for i in range(5)]
+        cid, campid = self.create_sent_campaign('test_verify_failure', emails)
+
+        verify = campaigns.verify_archive
+        checked = []
+        def fail_verify(camp):
+            # the chain only comes back to the campaign if the failed
+            # attempt released its claim
+            checked.append(self.camp(camp['id']).get('archive_attempts'))
+            return 'simulated failure'
+        campaigns.verify_archive = fail_verify
+        try:
+            start_archival(self.db)
+        finally:
+            campaigns.verify_archive = verify
+
+        assert checked == list(range(1, ARCHIVE_MAX_ATTEMPTS + 1))
+
+        camp = self.camp(campid)
+        assert camp['archived']
+        assert camp['archive_error'] == 'simulated failure'
+        assert camp['archive_attempts'] == ARCHIVE_MAX_ATTEMPTS
+        assert 'archive_stage' not in camp
+        assert 'archive_claimed_at' not in camp
+        assert 'archive_key' not in camp
+
+        # the logs were never deleted, and are left to the usual retention
+        assert self.db.single("select count(*) from camplogs where campid = %s", campid) == 3
+
+    def test_export_failure(self):
+        emails = ['exportfail%s@petpsychic.com' % i for i in range(5)]
+        cid, campid = self.create_sent_campaign('test_export_failure', emails)
+
+        write = campaigns.write_campaign_export
+        def fail_write(db, *args):
+            raise Exception('simulated export failure')
+        campaigns.write_campaign_export = fail_write
+        try:
+            # the first attempt runs in the archival chain, which records the
+            # error and leaves the claim to lapse
+            start_archival(self.db)
+            camp = self.camp(campid)
+            assert camp['archive_attempts'] == 1
+            assert camp['archive_error'] == 'simulated export failure'
+
+            # later attempts once the lease has run out
+            for attempt in range(2, ARCHIVE_MAX_ATTEMPTS + 1):
+                try:
+                    campaigns.archive_campaign(self.db, campid)
+                    assert False
+                except Exception as e:
+                    assert str(e) == 'simulated export failure'
+                    self.db.campaigns.patch(campid, {'archive_error': str(e)})
+                assert self.camp(campid)['archive_attempts'] == attempt
+
+            campaigns.archive_campaign(self.db, campid)
+        finally:
+            campaigns.write_campaign_export = write
+
+        camp = self.camp(campid)
+        assert camp['archive_attempts'] == ARCHIVE_MAX_ATTEMPTS
+        assert camp['archive_error'] == 'simulated export failure'
+        assert 'archive_stage' not in camp
+        assert 'archive_claimed_at' not in camp
+        assert self.db.single("select count(*) from camplogs where campid = %s", campid) == 3
@@ -1,8 +1,11 @@
 import test_base
+from datetime import datetime
+from api import funnels
+from api.shared import contacts
 
 class TestFormPost(test_base.TestBase):
 
-    def test_post(self):
+    def create_form(self):
         result = self.user_post('/api/funnels', json={
             "name": "Form Test",
             "type": "responders",
@@ -62,8 +65,10 @@ class TestFormPost(test_base.TestBase):
             'submitmsg': 'test',
         })
 
-        formid = result['id']
-        lid = result['list']
+        return fid, result['id'], result['list']
+
+    def test_post(self):
+        fid, formid, lid = self.create_form()
 
         result = self.user_post(f'/api/postform/{formid}.json', body="Name=test+name&Email=hello%2Btest%40petpsychic.com")
         assert result == {
@@ -78,4 +83,56 @@ class TestFormPost(test_base.TestBase):
         assert lst['used_properties'] == ['Email', 'Name']
         assert frm['submits'] == 1
         assert frm['submits_uniq'] == 1
-        assert funnel['count'] == 1
\ No newline at end of file
+        assert funnel['count'] == 1
+    def test_partial_failure(self):
+        fid, formid, lid = self.create_form()
+        cid = self.user_cookie['cid']
+
+        self.db.execute("insert into formcookies (formid, uid, viewed_at) values (%s, 'gooduid', now()), (%s, 'baduid', now())", formid, formid)
+
+        def sub(email, uid):
+            return {
+                'form': formid,
+                'cid': cid,
+                'list': lid,
+                'funnel': fid,
+                'data': {'Email': email},
+                'tags': ['form partial'],
+                'uid': uid,
+                'ts': datetime.utcnow().isoformat() + 'Z',
+            }
+        good = sub('good@petpsychic.com', 'gooduid')
+        bad = sub('bad@petpsychic.com', 'baduid')
+
+        # the failure comes after the contact was added to the list, which
+        # has to be undone with it
+        update_tags = contacts.update_tags
+        def fail_update_tags(db, cid, emails, *args, **kwargs):
+            if bad['data']['Email'] in emails:
+                raise Exception('simulated failure')
+            return update_tags(db, cid, emails, *args, **kwargs)
+        contacts.update_tags = fail_update_tags
+        try:
+            failed = funnels.write_form_submits(self.db, [good, bad])
+        finally:
+            contacts.update_tags = update_tags
+
+        assert failed == [bad]
+
+        emails = [e for e, in self.db.execute(f"""select email from contacts."contacts_{cid}" """)]
+        assert emails == ['good@petpsychic.com']
+        assert self.db.lists.get(lid)['count'] == 1
+        assert self.db.funnels.get(fid)['count'] == 1
+
+        frm = self.db.forms.get(formid)
+        assert frm['submits'] == 1
+        assert frm['submits_uniq'] == 1
+
+        submitted = dict(self.db.execute("select uid, submitted_at is not null from formcookies where formid = %s", formid))
+        assert submitted == {'gooduid': True, 'baduid': False}
+
+        # the retry writes the failed submission
+        assert funnels.write_form_submits(self.db, failed) == []
+        assert self.db.lists.get(lid)['count'] == 2
+        assert self.db.forms.get(formid)['submits'] == 2
+        assert dict(self.db.execute("select uid, submitted_at is not null from formcookies where formid = %s", formid))['baduid']
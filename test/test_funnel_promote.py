@@ -0,0 +1,97 @@
+import test_base
+from datetime import datetime, timedelta
+from api.shared.db import open_db
+from api.funnels import promote_due_funnels, CHECK_FUNNELS_LOCK
+
+class TestFunnelPromote(test_base.TestBase):
+
+    def add_message(self, fid):
+        result = self.user_post('/api/messages', json={
+            "who": "all",
+            "days": [True, True, True, True, True, True, True],
+            "type": "wysiwyg",
+            "funnel": fid,
+            "subject": "Promote Test",
+            "funnelid": fid,
+            "suppsegs": [],
+            "supptags": [],
+            "bodyStyle": {},
+            "dayoffset": -240,
+            "preheader": "",
+            "supplists": [],
+            "initialize": False,
+            "openaddtags": [],
+            "openremtags": [],
+            "sendaddtags": [],
+            "sendremtags": [],
+            "clickaddtags": [],
+            "clickremtags": [],
+            "rawText": ""
+        })
+        return result['id']
+
+    def queue(self, cid, msgid, count, ts):
+        self.db.execute("""insert into funnelqueue (email, rawhash, messageid, ts, cid, domain)
+                           select 'promote' || i || '@example.com', i, %s, %s, %s, 'example.com'
+                           from generate_series(1, %s) i""", msgid, ts, cid, count)
+
+    def due(self, msgid):
+        return self.db.single("select coalesce(sum(count), 0) from funneldue where messageid = %s", msgid)
+
+    def test_promote(self):
+        cid = self.user_cookie['cid']
+
+        result = self.user_post('/api/funnels', json={
+            "name": "Promote",
+            "tags": [],
+            "type": "tags",
+            "count": 0,
+            "active": True,
+            "replyto": "",
+            "exittags": [],
+            "fromname": "Test",
+            "messages": [],
+            "multiple": False,
+            "fromemail": "",
+            "returnpath": "test@edcom.ok"
+        })
+        fid = result['id']
+        msgid = self.add_message(fid)
+        deletedid = self.add_message(fid)
+
+        now = datetime.utcnow()
+        self.queue(cid, msgid, 20, now - timedelta(minutes=5))
+        self.queue(cid, deletedid, 5, now - timedelta(minutes=5))
+        # not due yet
+        self.queue(cid, msgid, 7, now + timedelta(days=1))
+
+        # a tick that overlaps another one promotes nothing
+        with open_db() as other:
+            with other.transaction():
+                other.execute(f"select pg_advisory_xact_lock({CHECK_FUNNELS_LOCK})")
+                assert promote_due_funnels(self.db, now) is None
+        assert self.due(msgid) == 0
+
+        # rows held by a promotion that is still running are left to it
+        with open_db() as other:
+            with other.transaction():
+                other.execute("select from funnelqueue where messageid = %s and rawhash <= 5 for update", msgid)
+                promote_due_funnels(self.db, now)
+                assert self.due(msgid) == 15
+        promote_due_funnels(self.db, now)
+        assert self.due(msgid) == 20
+
+        # each row is counted once however many ticks see it
+        promote_due_funnels(self.db, now)
+        assert self.due(msgid) == 20
+        assert self.db.single("select count(*) from funnelqueue where messageid = %s and due", msgid) == 20
+
+        promote_due_funnels(self.db, now + timedelta(days=2))
+        assert self.due(msgid) == 27
+
+        # counts for deleted messages are dropped
+        assert self.due(deletedid) == 5
+        self.user_delete(f'/api/messages/{deletedid}')
+        promote_due_funnels(self.db, now)
+        assert self.db.single("select count(*) from funneldue where messageid = %s", deletedid) == 0
+        assert self.due(msgid) == 27
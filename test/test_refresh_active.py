@@ -1,6 +1,9 @@
 import test_base
+import threading
+import time
 from datetime import datetime, timedelta
-from api.shared.contacts import update
+from api.shared.db import open_db
+from api.shared.contacts import update, rollup_list_deltas, LIST_ROLLUP_LOCK
 from api.shared.utils import get_os, get_browser, get_device, unix_time_secs
 from api.lists import refresh_active_counts
 
@@ -49,6 +52,53 @@ class TestRefreshActive(test_base.TestBase):
         assert lst['active60'] == 1
         assert lst['active90'] == 1
 
+    def test_pending_deltas(self):
+        result = self.user_post('/api/lists', json={
+            "name": "test_pending_deltas"
+        })
+
+        lid = result['id']
+
+        email = 'erin@petpsychic.com'
+
+        self.user_post(f'/api/lists/{lid}/feed', json={
+            'email': email,
+            'data': {
+                'First Name': 'Erin',
+                'Last Name': 'Test'
+            }
+        })
+
+        cid = self.user_cookie['cid']
+
+        # a bounce that has been written to the contact but whose list delta
+        # is still waiting for a rollup
+        self.db.execute(f"""update contacts."contacts_{cid}" set props = props || '{{"Bounced": ["true"]}}' where email = %s""", email)
+        self.db.execute("""insert into list_deltas (list_id, property, active30, active60, active90, bounced, complained, unsubscribed, soft_bounced)
+                           values (%s, 'Bounced', 0, 0, 0, 1, 0, 0, 0)""", lid)
+
+        # the recount waits for a rollup that is already running
+        locked = threading.Event()
+        def hold_lock():
+            with open_db() as other:
+                with other.transaction():
+                    other.execute(f"select pg_advisory_xact_lock({LIST_ROLLUP_LOCK})")
+                    locked.set()
+                    time.sleep(1)
+        t = threading.Thread(target=hold_lock)
+        t.start()
+        locked.wait()
+        refresh_active_counts()
+        t.join()
+
+        assert self.db.lists.get(lid)['bounced'] == 1
+
+        # the delta is part of the recount and isn't applied again
+        rollup_list_deltas(self.db)
+
+        assert self.db.lists.get(lid)['bounced'] == 1
+        assert self.db.single("select count(*) from list_deltas where list_id = %s", lid) == 0
+
     def create_broadcast(self, lid, name):
         return self.user_post('/api/broadcasts', json={
             'name': name,
@@ -0,0 +1,115 @@
+import test_base
+from api.shared import contacts
+
+class TestSendLogs(test_base.TestBase):
+
+    def add_funnel(self, name, type, tags):
+        result = self.user_post('/api/funnels', json={
+            "name": name,
+            "tags": tags,
+            "type": type,
+            "count": 0,
+            "active": True,
+            "replyto": "",
+            "exittags": [],
+            "fromname": "Test",
+            "messages": [],
+            "multiple": False,
+            "fromemail": "",
+            "returnpath": "test@edcom.ok"
+        })
+        return result['id']
+
+    def add_message(self, fid, sendaddtags=[], sendremtags=[]):
+        result = self.user_post('/api/messages', json={
+            "who": "all",
+            "days": [True, True, True, True, True, True, True],
+            "type": "wysiwyg",
+            "funnel": fid,
+            "subject": "Send Log Test",
+            "funnelid": fid,
+            "suppsegs": [],
+            "supptags": [],
+            "bodyStyle": {},
+            "dayoffset": -240,
+            "preheader": "",
+            "supplists": [],
+            "initialize": False,
+            "openaddtags": [],
+            "openremtags": [],
+            "sendaddtags": sendaddtags,
+            "sendremtags": sendremtags,
+            "clickaddtags": [],
+            "clickremtags": [],
+            "rawText": ""
+        })
+        return result['id']
+
+    def set_messages(self, fid, msgids):
+        self.user_patch(f'/api/funnels/{fid}', json={
+            "messages": [
+                {
+                    "id": msgid,
+                    "replyto": "",
+                    "whennum": 1,
+                    "fromname": "Test",
+                    "whentime": "",
+                    "whentype": "days",
+                    "fromemail": "",
+                    "returnpath": "test@edcom.ok"
+                }
+                for msgid in msgids
+            ]
+        })
+
+    def tag_count(self, cid, tag):
+        return self.db.single("select count from alltags where cid = %s and tag = %s", cid, tag)
+
+    def tagged(self, cid, tag):
+        return self.db.single(f"""select count(*) from contacts."contact_values_{cid}" where type = 'tag' and value = %s""", tag)
+
+    def queued(self, msgid):
+        return self.db.single("select count(*) from funnelqueue where messageid = %s", msgid)
+
+    def test_batches(self):
+        cid = self.user_cookie['cid']
+
+        # the send enrols its contacts in the next message of its own funnel,
+        # and its tag enrols them in a tag funnel
+        fid = self.add_funnel('Send Logs', 'responders', [])
+        msgid = self.add_message(fid, sendaddtags=['sendlog sent'], sendremtags=['sendlog old'])
+        nextid = self.add_message(fid)
+        self.set_messages(fid, [msgid, nextid])
+
+        tagfid = self.add_funnel('Send Log Tags', 'tags', ['sendlog sent'])
+        tagmsgid = self.add_message(tagfid)
+        self.set_messages(tagfid, [tagmsgid])
+
+        emails = ['sendlog%s@petpsychic.com' % i for i in range(25)]
+        self.db.execute(f"""insert into contacts."contacts_{cid}" (email, added, props)
+                            select unnest(%s::text[]), 0, '{{}}'""", emails)
+        self.db.execute(f"""insert into contacts."contact_values_{cid}" (contact_id, type, value)
+                            select contact_id, 'tag', 'sendlog old' from contacts."contacts_{cid}" where email = any(%s)""", emails)
+        self.db.execute("""insert into alltags (cid, tag, added, count) values (%s, 'sendlog sent', now(), 0), (%s, 'sendlog old', now(), 25)""", cid, cid)
+
+        batchsize = contacts.SEND_LOG_BATCH_SIZE
+        contacts.SEND_LOG_BATCH_SIZE = 10
+        try:
+            contacts.add_send(self.db, msgid, emails[:15])
+            # a send log file that is processed again, plus the rest of the
+            # contacts, only counts the new ones
+            contacts.add_send(self.db, msgid, emails)
+            contacts.add_send(self.db, msgid, emails)
+        finally:
+            contacts.SEND_LOG_BATCH_SIZE = batchsize
+
+        assert self.db.single(f"""select count(*) from contacts."contact_send_logs_{cid}" where campid = %s""", msgid) == 25
+
+        assert self.tagged(cid, 'sendlog sent') == 25
+        assert self.tagged(cid, 'sendlog old') == 0
+        assert self.tag_count(cid, 'sendlog sent') == 25
+        assert self.tag_count(cid, 'sendlog old') == 0
+
+        assert self.queued(nextid) == 25
+        assert self.queued(tagmsgid) == 25
+        assert self.db.funnels.get(tagfid)['count'] == 25
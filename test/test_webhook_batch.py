@@ -0,0 +1,174 @@
+import test_base
+import json
+import time
+from api import events
+from api.shared import contacts
+from api.shared.utils import redis_connect
+
+LNAME = 'test-webhooks-pending'
+
+class TestWebhookBatch(test_base.TestBase):
+
+    def setUp(self):
+        super(TestWebhookBatch, self).setUp()
+        self.rdb = redis_connect()
+        self.rdb.delete(LNAME)
+
+    def create_campaign(self, name, emails):
+        cid = self.user_cookie['cid']
+
+        self.db.set_cid(cid)
+        lid = self.db.lists.add({'name': name, 'count': len(emails)})
+        campid = self.db.campaigns.add({
+            'name': name,
+            'delivered': 0,
+            'send': 0,
+            'hard': 0,
+            'soft': 0,
+        })
+        self.db.set_cid(None)
+
+        self.db.execute(f"""insert into contacts."contacts_{cid}" (email, added, props)
+                            select unnest(%s::text[]), 0, '{{}}'""", emails)
+        self.db.execute(f"""insert into contacts."contact_lists_{cid}" (list_id, contact_id)
+                            select %s, contact_id from contacts."contacts_{cid}" where email = any(%s)""", lid, emails)
+
+        return cid, lid, campid
+
+    def sp(self, event_id, campid, email, eventtype, bounceclass=''):
+        return {
+            'type': 'sp',
+            'event_id': event_id,
+            'eventtype': eventtype,
+            'bounceclass': bounceclass,
+            'ip': '1.2.3.4',
+            'msg': '' if eventtype == 'delivery' else 'simulated %s' % eventtype,
+            'email': email,
+            'domain': email.split('@')[1],
+            'sinkid': 'sink',
+            'ts': str(int(time.time())),
+            'settingsid': 'settings',
+            'usercid': self.user_cookie['cid'],
+            'campid': campid,
+            'is_camp': True,
+            'trackingid': 'track-%s' % event_id,
+        }
+
+    def props(self, cid, email):
+        return self.db.single(f"""select props from contacts."contacts_{cid}" where email = %s""", email)
+
+    def claimed(self, ids):
+        return sorted(id for id, in self.db.execute("select id from sparkpost_events where id = any(%s)", ids))
+
+    def test_bounces(self):
+        emails = ['batch%s@petpsychic.com' % i for i in range(4)]
+        cid, lid, campid = self.create_campaign('test_bounces', emails)
+
+        # another consumer has already taken this one
+        self.db.execute("insert into sparkpost_events (id) values ('bounces-taken')")
+
+        objs = [
+            self.sp('bounces-1', campid, emails[0], 'delivery'),
+            self.sp('bounces-1', campid, emails[0], 'delivery'),
+            self.sp('bounces-taken', campid, emails[0], 'delivery'),
+            self.sp('bounces-2', campid, emails[1], 'bounce', '10'),
+            self.sp('bounces-3', campid, emails[1], 'bounce', '10'),
+            self.sp('bounces-4', campid, emails[2], 'spam_complaint'),
+            self.sp('bounces-5', campid, emails[3], 'bounce', '20'),
+        ]
+        events.process_webhook_batch(self.db, self.rdb, LNAME, objs)
+
+        assert self.rdb.llen(LNAME) == 0
+
+        camp = self.db.campaigns.get(campid)
+        assert camp['send'] == 1
+        assert camp['hard'] == 2
+        assert camp['soft'] == 1
+        assert camp['bounced'] == 1
+        assert camp['complained'] == 1
+
+        assert sorted(self.db.execute("select email, cmd from camplogs where campid = %s", campid)) == [
+            (emails[1], 'bounce'), (emails[2], 'complaint'), (emails[3], 'soft'),
+        ]
+
+        assert self.props(cid, emails[1]) == {'Bounced': ['true']}
+        assert self.props(cid, emails[2]) == {'Complained': ['true']}
+        assert self.props(cid, emails[3]) == {'Soft Bounced': ['true']}
+
+        assert sorted(self.db.execute("select email, complained, bounced from unsublogs where cid = %s and email = any(%s)", cid, emails)) == [
+            (emails[1], False, True), (emails[2], True, False),
+        ]
+
+        contacts.rollup_list_deltas(self.db)
+        lst = self.db.lists.get(lid)
+        assert lst['bounced'] == 1
+        assert lst['complained'] == 1
+        assert lst['soft_bounced'] == 1
+        assert 'Bounced' in lst['used_properties']
+
+        # the same events again are all duplicates
+        events.process_webhook_batch(self.db, self.rdb, LNAME, objs)
+        camp = self.db.campaigns.get(campid)
+        assert camp['hard'] == 2
+        assert camp['bounced'] == 1
+
+    def test_failures(self):
+        emails = ['batchfail%s@petpsychic.com' % i for i in range(2)]
+        cid, lid, campid = self.create_campaign('test_failures', emails)
+
+        good = self.sp('failures-1', campid, emails[0], 'bounce', '10')
+        bad = self.sp('failures-2', campid, emails[1], 'bounce', '10')
+
+        # an event that fails is retried on its own, and the rest of the
+        # batch is written
+        add_contact_event = events.WebhookBatch.add_contact_event
+        def fail_event(batch, campcid, campid, is_camp, email, *args):
+            add_contact_event(batch, campcid, campid, is_camp, email, *args)
+            if email == emails[1]:
+                raise Exception('simulated failure')
+        events.WebhookBatch.add_contact_event = fail_event
+        try:
+            events.process_webhook_batch(self.db, self.rdb, LNAME, [good, bad])
+        finally:
+            events.WebhookBatch.add_contact_event = add_contact_event
+
+        assert self.claimed(['failures-1', 'failures-2']) == ['failures-1']
+        assert self.props(cid, emails[0]) == {'Bounced': ['true']}
+        assert self.props(cid, emails[1]) == {}
+        assert self.db.campaigns.get(campid)['bounced'] == 1
+
+        retry = [json.loads(i) for i in self.rdb.lrange(LNAME, 0, -1)]
+        assert [obj['event_id'] for obj in retry] == ['failures-2']
+        assert retry[0]['attempts'] == 1
+
+        # a batch that can't be written is retried whole
+        self.rdb.delete(LNAME)
+        objs = [self.sp('failures-3', campid, emails[0], 'delivery')] + retry
+        flush = events.WebhookBatch.flush
+        def fail_flush(batch):
+            flush(batch)
+            raise Exception('simulated failure')
+        events.WebhookBatch.flush = fail_flush
+        try:
+            events.process_webhook_batch(self.db, self.rdb, LNAME, objs)
+            assert False
+        except Exception as e:
+            assert str(e) == 'simulated failure'
+        finally:
+            events.WebhookBatch.flush = flush
+
+        assert self.claimed(['failures-2', 'failures-3']) == []
+        assert self.props(cid, emails[1]) == {}
+        camp = self.db.campaigns.get(campid)
+        assert camp['send'] == 0
+        assert camp['bounced'] == 1
+
+        retry = [json.loads(i) for i in self.rdb.lrange(LNAME, 0, -1)]
+        assert sorted(obj['event_id'] for obj in retry) == ['failures-2', 'failures-3']
+
+        events.process_webhook_batch(self.db, self.rdb, LNAME, retry)
+        assert self.claimed(['failures-2', 'failures-3']) == ['failures-2', 'failures-3']
+        assert self.props(cid, emails[1]) == {'Bounced': ['true']}
+        camp = self.db.campaigns.get(campid)
+        assert camp['send'] == 1
+        assert camp['bounced'] == 2